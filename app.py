@@ -1,11 +1,26 @@
 import streamlit as st
+import html
 import os
 import json
-from book_recommender import get_book_recommendations, extract_books_from_response
+import uuid
+from book_filters import BookFilter, get_filter_stats
+from book_recommender import RecommendationStream, enhance_prompt, get_http_session, warm_up
+from cover_images import get_thumbnail_cache, start_cover_server
+from retrieval import GENRES
+from routing import get_router
+from shared_state import get_state_backend
+from conversation import ConversationSession, hash_session_id, load_session, save_session
+from speculation import SPECULATIVE_DEFAULT, FollowupPrefetcher, get_speculation_stats
+from telemetry import get_telemetry, start_metrics_server
 from dotenv import load_dotenv
 
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
+# Prometheus scrape endpoint, only when NOVELQUEST_METRICS_PORT is set
+start_metrics_server()
+# Cover thumbnails with long-lived cache headers, only when NOVELQUEST_COVER_PORT is set
+# (cards link to them only with NOVELQUEST_COVER_BASE_URL, otherwise they are inlined)
+start_cover_server()
 
 # Configure page
 st.set_page_config(
@@ -16,20 +31,307 @@ st.set_page_config(
 )
 
 # Session state initialization
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+# session_id is the key of this conversation in the shared backend, and so a
+# secret: it only goes in the URL (?sid=) when the user shares the
+# conversation, and only a shared conversation can be opened that way.
+# Opening a link copies the conversation into a new session, so the link
+# stays read-only and every viewer continues their own fork. Unshared
+# conversations aren't written to the backend: with the id kept out of the
+# URL, nothing could find them again from another replica.
+# Everywhere else (the scheduler's fair queue, traces) its hash user_id stands in.
+shared_state = get_state_backend()
+if 'session_id' not in st.session_state:
+    requested = st.query_params.get("sid") if shared_state else None
+    saved = load_session(shared_state, requested, shared_only=True) if requested else None
+    if requested:
+        # the URL now shows this session, which isn't shared (yet)
+        del st.query_params["sid"]
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.shared = False
+    st.session_state.user_id = hash_session_id(st.session_state.session_id)
+    # Role-based chat history, sent as real turns with follow-ups
+    st.session_state.conversation, st.session_state.books = saved or (ConversationSession(), [])
     
 if 'books' not in st.session_state:
     st.session_state.books = []
 
-# Define genre options
-genre_options = [
-    "Fiction", "Non-Fiction", "Fantasy", "Science Fiction", "Mystery", 
-    "Romance", "Thriller", "Historical Fiction", "Biography", 
-    "Young Adult", "Horror", "Adventure", "Classics", "Literary Fiction",
-    "Poetry", "Self-Help", "Psychological Thriller", "Suspense", "Comedy",
-    "Drama", "Satire", "Memoir", "Crime", "Action", "Philosophy"
-]
+# Thumbnail src per cover URL, so reruns don't go back to the thumbnail cache
+if 'cover_srcs' not in st.session_state:
+    st.session_state.cover_srcs = {}
+
+# Speculative follow-ups for the current results, when that is switched on
+if 'prefetcher' not in st.session_state:
+    st.session_state.prefetcher = None
+
+# Define genre options (the same list the retrieval index uses for its genre bitmask)
+genre_options = list(GENRES)
+
+CARD_STYLE = "border: 1px solid rgba(49, 51, 63, 0.2); border-radius: 0.5rem; padding: 1rem; margin-bottom: 1rem;"
+COVER_STYLE = "width: 150px; height: 225px; object-fit: cover; display: block; margin-bottom: 15px;"
+
+@st.cache_data(max_entries=500, show_spinner=False)
+def card_html(book_fields, cover_src):
+    """
+    The whole card as one HTML block. Pure, so reruns that show the same
+    books (filter tweaks, typing a follow-up) reuse the markup instead of
+    rebuilding a dozen elements per card.
+    """
+    book = dict(book_fields)
+    text = lambda key, default="": html.escape(str(book.get(key) or default))
+    details = [f"<b>Author:</b> {text('author')}", f"<b>Genre:</b> {text('genre')}",
+               f"<b>Price:</b> {text('price', '₹499')}"]
+    if book.get('pages'):
+        details.append(f"<b>Pages:</b> {text('pages')}")
+    if book.get('year'):
+        details.append(f"<b>First published:</b> {text('year')}")
+    # Amazon link (now using Amazon.in)
+    link = ""
+    if book.get('amazon_link'):
+        link = f"<p><a href=\"{text('amazon_link')}\" target=\"_blank\">Buy on Amazon India</a></p>"
+    return (
+        f"<div style=\"{CARD_STYLE}\">"
+        f"<h3>{text('name')}</h3>"
+        f"<div style=\"display: flex; gap: 1rem;\">"
+        f"<img src=\"{html.escape(cover_src)}\" style=\"{COVER_STYLE}\" alt=\"Cover art for {text('name')}\"/>"
+        f"<div>{'<br>'.join(details)}</div>"
+        f"</div>"
+        f"<details><summary>Description &amp; Details</summary>"
+        f"<p><b>Description:</b> {text('description')}</p>"
+        f"<p><b>Why you'll like it:</b> {text('ai_reasoning')}</p>"
+        f"</details>"
+        f"{link}"
+        f"</div>"
+    )
+
+def cover_src_for(book):
+    """The card's <img src>, remembered for the session once the thumbnail is settled."""
+    cover_srcs = st.session_state.cover_srcs
+    cover_src = cover_srcs.get(book["cover_url"])
+    if cover_src is None:
+        # our cached thumbnail instead of OpenLibrary's full-size cover
+        cover_src = get_thumbnail_cache().src(book["cover_url"], session=get_http_session())
+        # the original URL means the download didn't finish in time, so look again next run
+        if cover_src != book["cover_url"]:
+            cover_srcs[book["cover_url"]] = cover_src
+    return cover_src
+
+def render_book_card(book):
+    """Render one recommendation card."""
+    with get_telemetry().span("render", book=book["name"]):
+        fields = tuple(sorted((key, value) for key, value in book.items() if isinstance(value, (str, int, float))))
+        st.markdown(card_html(fields, cover_src_for(book)), unsafe_allow_html=True)
+
+def save_shared_session():
+    """Write a shared conversation and its results to the shared backend, for every worker and link holder."""
+    if shared_state is None or not st.session_state.shared:
+        return
+    try:
+        save_session(shared_state, st.session_state.session_id, st.session_state.conversation,
+                     st.session_state.books, shared=True)
+    except Exception as e:
+        print(f"Could not save the session to the shared backend: {e}")
+
+def show_books(books):
+    """
+    Store a new result set, keeping remembered thumbnails only for its books.
+    Speculative follow-ups for the old results are dropped.
+    """
+    st.session_state.books = books
+    if st.session_state.prefetcher is not None:
+        st.session_state.prefetcher.discard()
+        st.session_state.prefetcher = None
+    urls = {book["cover_url"] for book in books}
+    st.session_state.cover_srcs = {url: src for url, src in st.session_state.cover_srcs.items() if url in urls}
+
+def stream_book_cards(stream, spinner_text):
+    """
+    Render cards from a RecommendationStream as each book arrives and return
+    the stream. The preview is cleared afterwards, the results section
+    renders the final list.
+    """
+    cols_per_row = 2
+    preview = st.empty()
+    with preview.container():
+        with st.spinner(spinner_text):
+            cols = None
+            for idx, book in enumerate(stream):
+                if idx % cols_per_row == 0:
+                    cols = st.columns(cols_per_row)
+                with cols[idx % cols_per_row]:
+                    render_book_card(book)
+    preview.empty()
+    if stream.stepped_down_from:
+        st.caption(f"Lots of requests right now, so this is {stream.num_results} books instead of "
+                   f"{stream.stepped_down_from}. Ask again in a bit for the full list.")
+    return stream
+
+def filter_from_sliders(page_range, year_range):
+    """Slider ends ('100', '700+', 1950, 2025) mean no bound on that side."""
+    return BookFilter(
+        min_pages=None if page_range[0] == '100' else int(page_range[0].rstrip('+')),
+        max_pages=None if page_range[1] == '700+' else int(page_range[1]),
+        min_year=None if year_range[0] == 1950 else year_range[0],
+        max_year=None if year_range[1] == 2025 else year_range[1],
+    )
+
+def show_filter_report():
+    stats = get_filter_stats().stats()
+    if stats["checked"]:
+        st.caption(
+            f"Filters checked {stats['checked']} books: {stats['rejected_pages']} rejected for page count, "
+            f"{stats['rejected_year']} for year, {stats['unverified']} couldn't be verified. "
+            f"{stats['refill_requests']} refills asked for {stats['refill_books']} books instead of "
+            f"{stats['refill_books'] + stats['requery_books_avoided']}."
+        )
+
+def debug_enabled():
+    """The debug panel shows with NOVELQUEST_DEBUG=1, never because of the URL."""
+    return os.getenv("NOVELQUEST_DEBUG") == "1"
+
+def show_debug_panel():
+    """Waterfall of the last request's stages, plus counters and per-stage averages."""
+    telemetry = get_telemetry()
+    traces = telemetry.recent_traces()
+    with st.expander("Debug: request timings", expanded=False):
+        if not traces:
+            st.write("No requests yet.")
+        else:
+            trace = traces[0]
+            total = max(trace["duration"] or 0, 1e-6)
+            st.markdown(
+                f"**{trace['name']}** `{trace['trace_id']}` took {trace['duration']:.2f}s "
+                f"(source: {trace['attributes'].get('source', 'unknown')})"
+            )
+            rows = []
+            for span in trace["spans"]:
+                left = min(span["offset"] / total, 1) * 100
+                width = max(span["duration"] / total * 100, 0.5)
+                label = html.escape(span["name"] + (f" ({span['book']})" if span.get("book") else ""))
+                rows.append(
+                    f"<div style='display:flex;align-items:center;font-size:12px;'>"
+                    f"<div style='width:240px;overflow:hidden;white-space:nowrap;'>{label}</div>"
+                    f"<div style='flex:1;position:relative;height:12px;'>"
+                    f"<div style='position:absolute;left:{left:.1f}%;width:{width:.1f}%;height:12px;"
+                    f"background:#4e79a7;'></div></div>"
+                    f"<div style='width:70px;text-align:right;'>{span['duration'] * 1000:.0f} ms</div></div>"
+                )
+            st.markdown("".join(rows), unsafe_allow_html=True)
+        snapshot = telemetry.snapshot()
+        st.json({"counters": snapshot["counters"], "stages": snapshot["stages"],
+                 "speculation": get_speculation_stats().stats(), "routing": get_router().stats(),
+                 "model_latency": get_router().latency.report()}, expanded=False)
+
+@st.fragment
+def show_results(book_filter, num_results, fresh_results, speculative):
+    """
+    The follow-up box and the recommendations. A fragment, so typing or
+    sending a follow-up reruns only this part of the page.
+    """
+    with get_telemetry().span("fragment_run"):
+        # Display "Continue the Conversation" before recommendations
+        if st.session_state.books:
+            st.markdown("### Continue the Conversation")
+            st.write("Not satisfied with these recommendations? Ask follow-up questions or refine your search!")
+            
+            if shared_state is not None:
+                if not st.session_state.shared and st.button("Share this conversation", key="share"):
+                    st.session_state.shared = True
+                    st.query_params["sid"] = st.session_state.session_id
+                    save_shared_session()
+                if st.session_state.shared:
+                    st.caption("Shared: anyone with this page's link can open this conversation.")
+            
+            followup_input = st.text_input("Your follow-up question:", key="followup")
+            # filled in after a send, so it describes the follow-up just made
+            context_caption = st.empty()
+            prefetched = None
+            if st.button("Send", key="send_followup") and followup_input and api_key:
+                try:
+                    prefetcher = st.session_state.prefetcher
+                    with get_telemetry().trace("followup", user_id=st.session_state.user_id) as trace:
+                        # a close enough speculative follow-up answers right away
+                        if prefetcher is not None and prefetcher.serves(
+                                st.session_state.books, num_results, book_filter, not fresh_results):
+                            prefetched = prefetcher.take(followup_input)
+                        if prefetched is not None:
+                            response, new_books, st.session_state.conversation.last_context_stats = prefetched
+                            trace.attributes["source"] = "prefetched"
+                        else:
+                            # The previous conversation goes along as chat history
+                            stream = stream_book_cards(
+                                RecommendationStream(
+                                    followup_input, api_key, num_results=num_results,
+                                    session=st.session_state.conversation,
+                                    use_cache=not fresh_results, user_id=st.session_state.user_id,
+                                    book_filter=book_filter
+                                ),
+                                "Getting more recommendations..."
+                            )
+                            response, new_books = stream.response_text, stream.books
+                        
+                    # no st.rerun() here: the cards below already render the new books
+                    if new_books:
+                        show_books(new_books)
+                        st.session_state.conversation.record_turn(followup_input, response, new_books)
+                        save_shared_session()
+                    else:
+                        st.warning("I couldn't find new recommendations. Please try a different question.")
+                except Exception as e:
+                    st.error(f"An error occurred: {str(e)}")
+                    if "429" in str(e):
+                        st.warning("You've reached the API rate limit. Please try again in a few minutes.")
+                    elif "request deadline" in str(e):
+                        st.warning("Gemini is answering slowly right now. Please try again.")
+            
+            context_stats = st.session_state.conversation.last_context_stats
+            if context_stats:
+                context_caption.caption(
+                    f"Last follow-up sent {context_stats['verbatim'] + context_stats['compacted']} of "
+                    f"{context_stats['turns']} earlier turns (~{context_stats['tokens']} tokens)"
+                    + (" and was answered from a prefetched result" if prefetched else "")
+                )
+            
+            # Display recommendations after the conversation section
+            st.markdown("## Your Personalized Book Recommendations")
+            if book_filter.active:
+                show_filter_report()
+            
+            cols_per_row = 2
+            
+            # start every thumbnail download before the first card waits for its own
+            for book in st.session_state.books:
+                if book["cover_url"] not in st.session_state.cover_srcs:
+                    get_thumbnail_cache().prefetch(book["cover_url"], get_http_session())
+            
+            # Create rows of books
+            for i in range(0, len(st.session_state.books), cols_per_row):
+                cols = st.columns(cols_per_row)
+                
+                for j in range(cols_per_row):
+                    idx = i + j
+                    if idx < len(st.session_state.books):
+                        book = st.session_state.books[idx]
+                        with cols[j]:
+                            render_book_card(book)
+            
+            # likely follow-ups start generating once the cards are up
+            prefetcher = st.session_state.prefetcher
+            if speculative and api_key:
+                if prefetcher is None or not prefetcher.serves(
+                        st.session_state.books, num_results, book_filter, not fresh_results):
+                    if prefetcher is not None:
+                        prefetcher.discard()
+                    st.session_state.prefetcher = FollowupPrefetcher(
+                        st.session_state.conversation, st.session_state.books, api_key, num_results=num_results,
+                        book_filter=book_filter, use_cache=not fresh_results, user_id=st.session_state.user_id
+                    ).start()
+            elif prefetcher is not None:
+                prefetcher.discard()
+                st.session_state.prefetcher = None
+
+        # inside the fragment, so it also catches up after a follow-up
+        if debug_enabled():
+            show_debug_panel()
 
 def main():
     # Header
@@ -43,61 +345,75 @@ def main():
         st.markdown("<h2>What book are you looking for?</h2>", unsafe_allow_html=True)
         st.write("Describe the perfect book you're looking for in detail. The more specific, the better!")
         
-        # Filters header - more minimalist
-        st.markdown("### Filters")
-        
-        # Put all filters in a single line with custom CSS class
-        st.markdown('<div class="filter-row">', unsafe_allow_html=True)
-        
-        # Create columns for the filters in a single row
-        filter_cols = st.columns(3)
-        
-        with filter_cols[0]:
-            # Page range filter (single slider with predefined values)
-            page_range = st.select_slider(
-                "Number of Pages:",
-                options=['100', '150', '200', '250', '300', '350', '400', '450', '500', '550', '600', '650', '700+'],
-                value=('100', '700+')
-            )
-        
-        with filter_cols[1]:
-            # Publication year filter
-            year_range = st.slider("Year Published:", 1950, 2025, (1950, 2025))
-        
-        with filter_cols[2]:
-            # Number of results slider - clean minimalist style like reference
-            num_results = st.slider(
-                "Number of results:", 
-                min_value=1, 
-                max_value=10, 
-                value=5, 
-                step=1,
-                key="number_results_slider"
-            )
-        
-        st.markdown('</div>', unsafe_allow_html=True)
-        
-        # Genre selection using a collapsible section
-        with st.expander("Advanced Filters", expanded=False):
-            st.markdown("#### Select Genres")
-            # Create a 5-column layout for genres
-            genre_cols = st.columns(5)
-            selected_genres = []
-            
-            # Distribute genres across the columns
-            for i, genre in enumerate(genre_options):
-                col_index = i % 5
-                with genre_cols[col_index]:
-                    if st.checkbox(genre, key=f"genre_{genre}"):
-                        selected_genres.append(genre)
-        
-        # Book search form
+        # Filters and the prompt share one form, so moving a slider or ticking a
+        # genre doesn't rerun the app; they apply when the form is submitted
         with st.form(key="book_search_form"):
+            # Filters header - more minimalist
+            st.markdown("### Filters")
+            
+            # Put all filters in a single line with custom CSS class
+            st.markdown('<div class="filter-row">', unsafe_allow_html=True)
+            
+            # Create columns for the filters in a single row
+            filter_cols = st.columns(3)
+            
+            with filter_cols[0]:
+                # Page range filter (single slider with predefined values)
+                page_range = st.select_slider(
+                    "Number of Pages:",
+                    options=['100', '150', '200', '250', '300', '350', '400', '450', '500', '550', '600', '650', '700+'],
+                    value=('100', '700+')
+                )
+            
+            with filter_cols[1]:
+                # Publication year filter
+                year_range = st.slider("Year Published:", 1950, 2025, (1950, 2025))
+            
+            with filter_cols[2]:
+                # Number of results slider - clean minimalist style like reference
+                num_results = st.slider(
+                    "Number of results:", 
+                    min_value=1, 
+                    max_value=10, 
+                    value=5, 
+                    step=1,
+                    key="number_results_slider"
+                )
+            
+            st.markdown('</div>', unsafe_allow_html=True)
+            
+            # Genre selection using a collapsible section
+            with st.expander("Advanced Filters", expanded=False):
+                st.markdown("#### Select Genres")
+                # Create a 5-column layout for genres
+                genre_cols = st.columns(5)
+                selected_genres = []
+                
+                # Distribute genres across the columns
+                for i, genre in enumerate(genre_options):
+                    col_index = i % 5
+                    with genre_cols[col_index]:
+                        if st.checkbox(genre, key=f"genre_{genre}"):
+                            selected_genres.append(genre)
+            
+            # Book search
             user_prompt = st.text_area(
                 "What kind of book are you looking for?",
                 height=120,
                 placeholder="Example: I want a mystery book with a female detective who solves cold cases in a small town. I prefer books with witty dialogue and unexpected plot twists. I'd like it to be set in modern times."
             )
+            fresh_results = st.checkbox(
+                "Always get fresh results",
+                help="Skip previously cached recommendations for the same search.",
+                key="fresh_results"
+            )
+            speculative = st.checkbox(
+                "Prefetch likely follow-ups",
+                value=SPECULATIVE_DEFAULT,
+                help="Ask for common refinements (more like the first book, shorter, newer) in the background, "
+                     "so those follow-ups come back instantly. Uses extra API quota.",
+                key="speculative"
+            )
             
             col1, col2 = st.columns(2)
             with col1:
@@ -105,130 +421,47 @@ def main():
             with col2:
                 clear_button = st.form_submit_button(label="Clear Results", use_container_width=True)
         
+        book_filter = filter_from_sliders(page_range, year_range)
+
         # Handle clear button
         if clear_button:
-            st.session_state.chat_history = []
-            st.session_state.books = []
+            st.session_state.conversation.clear()
+            show_books([])
+            save_shared_session()
         
         # Handle form submission
         if submit_button and user_prompt and api_key:
-            with st.spinner("🔍 Searching for your perfect books..."):
-                try:
-                    # Add filters to prompt
-                    filter_prompt = ""
-                    if page_range != ('100', '700+'):
-                        filter_prompt += f" The book should be between {page_range[0]} and {page_range[1]} pages."
-                    
-                    if year_range != (1950, 2025):
-                        filter_prompt += f" The book should be published between {year_range[0]} and {year_range[1]}."
+            try:
+                # Add filters to prompt; pages and years are also checked
+                # against real metadata afterwards
+                enhanced_prompt = enhance_prompt(user_prompt, book_filter, selected_genres)
                     
-                    if selected_genres:
-                        filter_prompt += f" The book should be in one or more of these genres: {', '.join(selected_genres)}."
+                # Get AI response with specified number of results, showing each book
+                # as soon as it is generated (cached searches skip the API)
+                with get_telemetry().trace("search", user_id=st.session_state.user_id):
+                    stream = stream_book_cards(
+                        RecommendationStream(
+                            enhanced_prompt, api_key, num_results=num_results, use_cache=not fresh_results,
+                            user_id=st.session_state.user_id, book_filter=book_filter, genres=selected_genres
+                        ),
+                        "🔍 Searching for your perfect books..."
+                    )
+                response, books = stream.response_text, stream.books
                     
-                    enhanced_prompt = user_prompt + filter_prompt
-                    
-                    # Get AI response with specified number of results
-                    response = get_book_recommendations(enhanced_prompt, api_key, num_results=num_results)
-                    
-                    # Extract books from response
-                    books = extract_books_from_response(response)
-                    
-                    if books:
-                        st.session_state.books = books
-                        st.session_state.chat_history.append({"role": "user", "content": enhanced_prompt})
-                        st.session_state.chat_history.append({"role": "assistant", "content": response})
-                    else:
-                        st.error("Sorry, I couldn't extract book recommendations from the AI response. Please try again with a different description.")
-                except Exception as e:
-                    st.error(f"An error occurred: {str(e)}")
-                    if "429" in str(e):
-                        st.warning("You've reached the API rate limit. Please try again in a few minutes or check your Gemini API quota at https://ai.google.dev/")
+                if books:
+                    show_books(books)
+                    st.session_state.conversation.record_turn(enhanced_prompt, response, books)
+                    save_shared_session()
+                else:
+                    st.error("Sorry, I couldn't extract book recommendations from the AI response. Please try again with a different description.")
+            except Exception as e:
+                st.error(f"An error occurred: {str(e)}")
+                if "429" in str(e):
+                    st.warning("You've reached the API rate limit. Please try again in a few minutes or check your Gemini API quota at https://ai.google.dev/")
+                elif "request deadline" in str(e):
+                    st.warning("Gemini is answering slowly right now. Please try again.")
         
-        # Display "Continue the Conversation" before recommendations
-        if st.session_state.books:
-            st.markdown("### Continue the Conversation")
-            st.write("Not satisfied with these recommendations? Ask follow-up questions or refine your search!")
-            
-            followup_input = st.text_input("Your follow-up question:", key="followup")
-            if st.button("Send", key="send_followup") and followup_input and api_key:
-                with st.spinner("Getting more recommendations..."):
-                    try:
-                        # Create context from previous conversation
-                        context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in st.session_state.chat_history])
-                        response = get_book_recommendations(followup_input, api_key, num_results=num_results, context=context)
-                        
-                        new_books = extract_books_from_response(response)
-                        
-                        if new_books:
-                            st.session_state.books = new_books
-                            st.session_state.chat_history.append({"role": "user", "content": followup_input})
-                            st.session_state.chat_history.append({"role": "assistant", "content": response})
-                            st.rerun()
-                        else:
-                            st.warning("I couldn't find new recommendations. Please try a different question.")
-                    except Exception as e:
-                        st.error(f"An error occurred: {str(e)}")
-                        if "429" in str(e):
-                            st.warning("You've reached the API rate limit. Please try again in a few minutes.")
-            
-            # Display recommendations after the conversation section
-            st.markdown("## Your Personalized Book Recommendations")
-            
-            cols_per_row = 2
-            
-            # Create rows of books
-            for i in range(0, len(st.session_state.books), cols_per_row):
-                cols = st.columns(cols_per_row)
-                
-                for j in range(cols_per_row):
-                    idx = i + j
-                    if idx < len(st.session_state.books):
-                        book = st.session_state.books[idx]
-                        with cols[j]:
-                            with st.container(border=True):
-                                st.subheader(book["name"])
-                                
-                                # Book details in a two-column layout
-                                img_col, info_col = st.columns([1, 3], gap="small")
-                                
-                                with img_col:
-                                    st.markdown(
-                                        f"""
-                                        <div style="
-                                            width: 150px;    /* fixed display width */
-                                            height: 225px;   /* fixed display height */
-                                            overflow: hidden;
-                                            margin-bottom: 15px;
-                                        ">
-                                            
-                                        <img
-                                            src="{book['cover_url']}"
-                                            style="
-                                            width: 150px;
-                                            height: 225px;
-                                            object-fit: cover;   /* crop & fill the box */
-                                            display: block;
-                                            "
-                                            alt="Cover art for {book['name']}"
-                                        />
-                                        </div>
-                                        """,
-                                        unsafe_allow_html=True,
-                                    )
-                                
-                                with info_col:
-                                    st.markdown(f"**Author:** {book['author']}")
-                                    st.markdown(f"**Genre:** {book['genre']}")
-                                    st.markdown(f"**Price:** {book.get('price', '₹499')}")
-                                
-                                # Description and reasoning in a single column
-                                with st.expander("Description & Details", expanded=False):
-                                    st.markdown(f"**Description:** {book['description']}")
-                                    st.markdown(f"**Why you'll like it:** {book['ai_reasoning']}")
-                                
-                                # Amazon link (now using Amazon.in)
-                                if 'amazon_link' in book and book['amazon_link']:
-                                    st.markdown(f"[Buy on Amazon India]({book['amazon_link']})")
+        show_results(book_filter, num_results, fresh_results, speculative)
     
     with tab2:
         # About tab with minimalist style like the reference image
@@ -262,4 +495,8 @@ GEMINI_API_KEY=your_actual_api_key_here
         """)
         st.markdown("Get your API key from [Google AI Studio](https://ai.google.dev/)")
     else:
-        main()
+        with get_telemetry().span("script_run"):
+            main()
+        # the page is up: import the Gemini SDK and build the model in the
+        # background (once per process) so the first search doesn't wait on them
+        warm_up(api_key, num_results=st.session_state.get("number_results_slider", 5))
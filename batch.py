@@ -0,0 +1,184 @@
+"""
+Headless batch runner: recommendations for a JSONL file of prompts.
+
+Each input line is a JSON object:
+
+    {"id": "cozy-01", "prompt": "Cozy village mysteries", "num_results": 5,
+     "min_pages": 200, "max_pages": 400, "min_year": 1990, "max_year": null, "genres": ["Mystery"]}
+
+Only "prompt" is required; "id" defaults to the line number. Results are
+appended to the output JSONL as each prompt finishes, and finished ids go to
+a checkpoint file next to it, so running the same command again after a
+crash only does the prompts that are left (failed prompts are retried too).
+
+    python batch.py prompts.jsonl results.jsonl --concurrency 4 --requests-per-minute 15
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from book_filters import BookFilter
+from book_recommender import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, enhance_prompt, recommend_books
+from scheduler import BURST, REQUESTS_PER_MINUTE, RequestScheduler, set_scheduler
+from shared_state import get_state_backend
+
+DEFAULT_CONCURRENCY = 4
+PROGRESS_EVERY = 10
+
+def load_prompts(input_path):
+    """The input jobs as dicts with an "id", in file order. Bad lines raise ValueError."""
+    jobs = []
+    seen = set()
+    with open(input_path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{input_path}:{line_no}: not valid JSON ({e})")
+            if not isinstance(job, dict) or not str(job.get("prompt", "")).strip():
+                raise ValueError(f"{input_path}:{line_no}: needs a non-empty \"prompt\"")
+            job["id"] = str(job.get("id", line_no))
+            if job["id"] in seen:
+                raise ValueError(f"{input_path}:{line_no}: duplicate id {job['id']!r}")
+            seen.add(job["id"])
+            jobs.append(job)
+    return jobs
+
+def checkpoint_path_for(output_path):
+    return output_path + ".checkpoint"
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+def _drop_partial_line(path):
+    """A crash mid-write can leave half a line at the end of the output; cut it off."""
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+def run_job(job, api_key, use_cache=True, output_format=DEFAULT_OUTPUT_FORMAT):
+    """Recommendations for one input job, as the output record."""
+    book_filter = BookFilter(job.get("min_pages"), job.get("max_pages"), job.get("min_year"), job.get("max_year"))
+    genres = job.get("genres") or None
+    prompt = enhance_prompt(job["prompt"], book_filter, genres)
+    start = time.perf_counter()
+    _, books = recommend_books(
+        prompt, api_key, num_results=int(job.get("num_results", 5)), use_cache=use_cache,
+        output_format=output_format, user_id=f"batch:{job['id']}", book_filter=book_filter, genres=genres,
+        # a batch fills the queue by design and wants full answers, not fast ones
+        step_down=False
+    )
+    return {
+        "id": job["id"],
+        "prompt": job["prompt"],
+        "books": books,
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+    }
+
+def run_batch(input_path, output_path, api_key, concurrency=DEFAULT_CONCURRENCY,
+              requests_per_minute=REQUESTS_PER_MINUTE, burst=BURST, use_cache=True,
+              output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Process every prompt not yet in the checkpoint. Returns a summary with
+    completed/failed/skipped counts and throughput in prompts per minute.
+    """
+    jobs = load_prompts(input_path)
+    checkpoint_path = checkpoint_path_for(output_path)
+    done_ids = load_checkpoint(checkpoint_path)
+    pending = [job for job in jobs if job["id"] not in done_ids]
+    print(f"{len(jobs)} prompts, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+
+    # one scheduler for the whole run: it enforces the rate limit and the
+    # number of upstream calls in flight (and shares the quota with the app
+    # workers when NOVELQUEST_SHARED_STATE is set)
+    scheduler = RequestScheduler(requests_per_minute=requests_per_minute, burst=burst, max_concurrent=concurrency,
+                                 backend=get_state_backend())
+    set_scheduler(scheduler)
+    _drop_partial_line(output_path)
+
+    write_lock = threading.Lock()
+    completed, failed = 0, []
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output, \
+            open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+        futures = {pool.submit(run_job, job, api_key, use_cache, output_format): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                failed.append(job["id"])
+                print(f"[{job['id']}] failed: {e}", file=sys.stderr)
+                continue
+            with write_lock:
+                # the result is on disk before its id is checkpointed
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                checkpoint.write(job["id"] + "\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            completed += 1
+            if completed % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{completed}/{len(pending)} done, {completed / elapsed * 60:.1f} prompts/min")
+
+    elapsed = time.perf_counter() - start
+    metrics = scheduler.metrics()
+    summary = {
+        "total": len(jobs),
+        "skipped": len(jobs) - len(pending),
+        "completed": completed,
+        "failed": failed,
+        "elapsed_seconds": round(elapsed, 2),
+        "prompts_per_minute": round(completed / elapsed * 60, 2) if elapsed and completed else 0.0,
+        "retries": metrics["retries"],
+        "rate_limit_wait_seconds": round(metrics["rate_limit_wait_seconds"], 2),
+    }
+    print(f"Finished {completed} prompts in {elapsed:.1f}s ({summary['prompts_per_minute']} prompts/min), "
+          f"{len(failed)} failed, {metrics['retries']} retries, "
+          f"{metrics['rate_limit_wait_seconds']:.1f}s waiting on the rate limit")
+    if failed:
+        print(f"Failed ids (run again to retry): {', '.join(failed)}")
+    return summary
+
+def main():
+    # the same .env the app reads, for the API key
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run NovelQuest recommendations for a JSONL file of prompts.")
+    parser.add_argument("input", help="JSONL file with one prompt object per line")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE)
+    parser.add_argument("--burst", type=int, default=BURST)
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT)
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse cached responses")
+    parser.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"))
+    args = parser.parse_args()
+    if not args.api_key:
+        parser.error("set GEMINI_API_KEY or pass --api-key")
+
+    summary = run_batch(
+        args.input, args.output, args.api_key, concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute, burst=args.burst,
+        use_cache=not args.no_cache, output_format=args.format,
+    )
+    sys.exit(1 if summary["failed"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+"""
+Standalone benchmark script for NovelQuest's hot paths.
+Runs offline, no API key or network needed.
+Run with: python benchmark.py [section ...] [--fixtures DIR] [--save FILE] [--baseline FILE]
+
+--baseline compares the end-to-end results with a file written by --save
+and exits with status 1 when they got worse by more than REGRESSION_TOLERANCE.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from book_parser import parse_book_fields, parse_book_json
+from catalog import BookCatalog
+from conversation import estimate_tokens
+from routing import percentile
+import numpy as np
+import book_filters
+import book_recommender
+import catalog
+import cover_cache
+import cover_images
+import replay
+import response_cache
+import retrieval
+import routing
+import scheduler
+import telemetry
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# rough generation model for gemini-2.0-flash, used to turn tokens into time
+OUTPUT_TOKENS_PER_SECOND = 200
+TIME_TO_FIRST_TOKEN = 0.4
+
+# the regexes book_recommender used before book_parser, kept for comparison
+LEGACY_BOOK_PATTERN = r"(?:Book\s*\d*:?\s*)?Name:\s*(.*?)[\r\n]+\s*Author:\s*(.*?)[\r\n]+\s*Genre:\s*(.*?)[\r\n]+\s*Price:\s*(.*?)[\r\n]+\s*ai_reasoning:\s*(.*?)[\r\n]+\s*(?:Amazon Link:)?.*?[\r\n]+\s*description:\s*(.*?)(?=\s*(?:Book\s*\d*:?\s*)?Name:|\Z)"
+LEGACY_FALLBACK_PATTERN = r"(?:.*?)(?:name|title|book):\s*(.*?)[\r\n]+.*?(?:author|by|writer):\s*(.*?)[\r\n]+.*?(?:genre|category|type):\s*(.*?)[\r\n]+.*?(?:price|cost):\s*(.*?)[\r\n]+.*?(?:reason|why|recommendation):\s*(.*?)[\r\n]+.*?(?:description|about|summary):\s*(.*?)(?=(?:.*?(?:name|title|book):)|$)"
+
+def legacy_parse(text):
+    matches = re.findall(LEGACY_BOOK_PATTERN, text, re.DOTALL)
+    if not matches:
+        matches = re.findall(LEGACY_FALLBACK_PATTERN, text, re.DOTALL | re.IGNORECASE)
+    return matches
+
+def well_formed_input(n):
+    return "\n\n".join(
+        f"Book {i}:\nName: Title {i}\nAuthor: Author {i}\nGenre: Mystery, Thriller\nPrice: ₹399\n"
+        f"ai_reasoning: {'Because it fits. ' * 5}\nAmazon Link:\ndescription: {'Some plot. ' * 15}"
+        for i in range(n)
+    ) + "\n\nWhat do you think of these? Would you like me to refine the suggestions?"
+
+def missing_price_input(n):
+    """Every book lacks Price:, so the strict pattern fails and the fallback runs."""
+    return "".join(
+        f"Name: Title {i}\nAuthor: Author {i}\nGenre: Drama\nai_reasoning: reason\ndescription: plot plot plot\n"
+        for i in range(n)
+    )
+
+def label_soup_input(n):
+    """Lots of labels and no newlines, the worst case for the lazy .*? groups."""
+    return "name: title: by: cost: " * n
+
+ADVERSARIAL_INPUTS = {
+    "well formed": well_formed_input,
+    "missing price": missing_price_input,
+    "label soup": label_soup_input,
+}
+
+def time_call(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_parser():
+    """Parse time per input size. Linear scaling keeps µs/KB flat as inputs grow."""
+    print("Parser scaling (book_parser.parse_book_fields)")
+    print(f"{'input':<15}{'units':>8}{'KB':>10}{'ms':>10}{'µs/KB':>10}")
+    for name, make_input in ADVERSARIAL_INPUTS.items():
+        for n in (10, 100, 1000, 10000):
+            text = make_input(n)
+            elapsed = time_call(parse_book_fields, text)
+            kb = len(text.encode("utf-8")) / 1024
+            print(f"{name:<15}{n:>8}{kb:>10.1f}{elapsed * 1000:>10.2f}{elapsed * 1e6 / kb:>10.1f}")
+
+    # the old regexes backtrack exponentially on malformed books, so only tiny sizes are timed
+    print("\nLegacy regexes on the same inputs")
+    for name, make_input in ADVERSARIAL_INPUTS.items():
+        sizes = {"well formed": (10, 100, 1000), "missing price": (1, 2, 3), "label soup": (5, 10, 20)}[name]
+        for n in sizes:
+            text = make_input(n)
+            elapsed = time_call(legacy_parse, text, repeat=1)
+            kb = len(text.encode("utf-8")) / 1024
+            print(f"{name:<15}{n:>8}{kb:>10.1f}{elapsed * 1000:>10.2f}{elapsed * 1e6 / kb:>10.1f}")
+
+def bench_output_formats():
+    """Compare recorded text and JSON responses for the same books: size, parse time, estimated latency."""
+    print("\nText vs JSON output (recorded responses in fixtures/responses)")
+    print(f"{'response':<20}{'format':>8}{'tokens':>8}{'parse ms':>10}{'est. gen s':>12}")
+    totals = {"text": 0, "json": 0}
+    for text_path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "responses", "*.txt"))):
+        json_path = text_path[:-4] + ".json"
+        if not os.path.exists(json_path):
+            continue
+        name = os.path.basename(text_path)[:-4]
+        for fmt, path, parse in (("text", text_path, parse_book_fields), ("json", json_path, parse_book_json)):
+            with open(path, encoding="utf-8") as f:
+                body = f.read()
+            tokens = estimate_tokens(body)
+            totals[fmt] += tokens
+            parse_ms = time_call(parse, body, repeat=20) * 1000
+            generation = TIME_TO_FIRST_TOKEN + tokens / OUTPUT_TOKENS_PER_SECOND
+            print(f"{name:<20}{fmt:>8}{tokens:>8}{parse_ms:>10.3f}{generation:>12.2f}")
+    if totals["text"]:
+        change = totals["json"] / totals["text"] - 1
+        print(f"JSON output: {change:+.0%} estimated output tokens compared to text output")
+
+CATALOG_WORKS = 100000
+_SYLLABLES = ("ka", "lor", "men", "tha", "ri", "os", "ve", "dun", "shi", "pa", "el", "gor", "an", "wyn", "ta",
+              "mi", "ber", "qu", "is", "do", "ne", "fal", "ru", "ch", "ost", "ly", "ar", "zen", "hu", "ix")
+
+def synthetic_works_dump(path, n):
+    """Write n works in OpenLibrary's dump format with made-up, varied titles."""
+    rng = random.Random(7)
+    vocabulary = ["".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(20000)]
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            title = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(2, 6)))
+            record = {"key": f"/works/OL{i}W", "title": title, "covers": [i + 1], "first_publish_date": "1999"}
+            f.write(f"/type/work\t/works/OL{i}W\t1\t2023-01-01\t{json.dumps(record)}\n")
+
+def bench_catalog(n=CATALOG_WORKS):
+    """Ingest throughput and exact/fuzzy lookup latency for the local catalog."""
+    print(f"\nLocal catalog with {n} works")
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_path = os.path.join(tmp, "works.txt")
+        synthetic_works_dump(dump_path, n)
+        catalog = BookCatalog(os.path.join(tmp, "catalog.sqlite3"))
+        start = time.perf_counter()
+        catalog.ingest(dump_path)
+        catalog.finalize()
+        elapsed = time.perf_counter() - start
+        print(f"ingest + index: {elapsed:.1f}s ({n / elapsed:,.0f} works/s), "
+              f"{os.path.getsize(catalog.db_path) / 2 ** 20:.1f} MB on disk")
+
+        titles = [row[0] for row in catalog._db.execute("SELECT title FROM books ORDER BY RANDOM() LIMIT 200")]
+        # one dropped letter per title, so the exact key misses
+        typos = [title[:3] + title[4:] for title in titles]
+        for label, queries in (("exact", titles), ("fuzzy", typos)):
+            timings = []
+            found = 0
+            for title in queries:
+                start = time.perf_counter()
+                found += catalog.lookup(title) is not None
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label:<8}p50 {timings[len(timings) // 2] * 1e6:>8.0f} µs   "
+                  f"p95 {timings[int(len(timings) * 0.95)] * 1e6:>8.0f} µs   found {found}/{len(queries)}")
+        catalog.close()
+
+def bench_rerank_output():
+    """Estimated output of a full generation vs re-ranking the same books from the corpus."""
+    print("\nFull generation vs retrieval re-rank (same books, estimated output)")
+    print(f"{'response':<20}{'full tok':>10}{'rerank tok':>12}{'full s':>8}{'rerank s':>10}")
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "responses", "*.txt"))):
+        name = os.path.basename(path)[:-4]
+        with open(path, encoding="utf-8") as f:
+            body = f.read()
+        books, _ = parse_book_fields(body)
+        # the re-rank answer keeps only what the corpus can't supply
+        rerank = "\n\n".join(
+            f"Name: {b['name']}\nAuthor: {b['author']}\nPrice: {b['price']}\nai_reasoning: {b['ai_reasoning']}"
+            for b in books
+        )
+        full_tokens, rerank_tokens = estimate_tokens(body), estimate_tokens(rerank)
+        print(f"{name:<20}{full_tokens:>10}{rerank_tokens:>12}"
+              f"{TIME_TO_FIRST_TOKEN + full_tokens / OUTPUT_TOKENS_PER_SECOND:>8.2f}"
+              f"{TIME_TO_FIRST_TOKEN + rerank_tokens / OUTPUT_TOKENS_PER_SECOND:>10.2f}")
+
+RETRIEVAL_SIZES = (10000, 100000, 1000000)
+
+def synthetic_retrieval_index(index_dir, n):
+    """Random unit vectors and 1-3 random genres per book, in the layout build_index writes."""
+    rng = np.random.default_rng(7)
+    dims = retrieval.DIMENSIONS
+    vectors = np.lib.format.open_memmap(os.path.join(index_dir, "vectors.npy"), mode="w+",
+                                        dtype=retrieval.VECTOR_DTYPE, shape=(n, dims))
+    with open(os.path.join(index_dir, "books.jsonl"), "wb") as books, \
+            open(os.path.join(index_dir, "offsets.u64"), "wb") as offsets, \
+            open(os.path.join(index_dir, "genres.u32"), "wb") as genres:
+        for start in range(0, n, 100000):
+            size = min(100000, n - start)
+            block = rng.standard_normal((size, dims), dtype=np.float32)
+            vectors[start:start + size] = block / np.linalg.norm(block, axis=1, keepdims=True)
+            masks = np.zeros(size, dtype=np.uint32)
+            for _ in range(3):
+                masks |= (1 << rng.integers(0, len(retrieval.GENRES), size)).astype(np.uint32)
+            genres.write(masks.tobytes())
+            lines = [f'{{"name": "Book {i}", "author": "", "genre": "", "description": ""}}\n'.encode()
+                     for i in range(start, start + size)]
+            positions = np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.uint64) + np.uint64(books.tell())
+            offsets.write(positions.tobytes())
+            books.write(b"".join(lines))
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(index_dir, "idf.npy"), np.ones(dims, dtype=np.float32))
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump({"version": retrieval.INDEX_VERSION, "count": n, "dimensions": dims,
+                   "genres": list(retrieval.GENRES)}, f)
+
+def bench_retrieval(sizes=RETRIEVAL_SIZES):
+    """Top-15 query latency over the memory-mapped index, with and without a genre pre-filter."""
+    print(f"\nRetrieval query latency ({retrieval.DIMENSIONS}-dim {np.dtype(retrieval.VECTOR_DTYPE).name}, top 15)")
+    print(f"{'books':>10}{'MB':>8}{'all p50 ms':>12}{'all p95 ms':>12}{'1 genre p50':>13}{'1 genre p95':>13}")
+    queries = ["psychological thriller with an unreliable narrator", "desert planet politics and betrayal",
+               "cozy village mystery with a retired detective", "epic fantasy heist with metal magic"]
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            synthetic_retrieval_index(tmp, n)
+            index = retrieval.RetrievalIndex(tmp)
+            row = [n, os.path.getsize(os.path.join(tmp, "vectors.npy")) / 2 ** 20]
+            for genres in (None, ["Horror"]):
+                index.search(queries[0], k=15, genres=genres)
+                timings = []
+                for _ in range(5):
+                    for query in queries:
+                        start = time.perf_counter()
+                        index.search(query, k=15, genres=genres)
+                        timings.append(time.perf_counter() - start)
+                timings.sort()
+                row += [timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000]
+            index.close()
+        print(f"{row[0]:>10}{row[1]:>8.0f}{row[2]:>12.1f}{row[3]:>12.1f}{row[4]:>13.1f}{row[5]:>13.1f}")
+
+E2E_RESULT_COUNTS = (1, 3, 5, 10)
+E2E_QUERIES = 8
+# the fake upstreams run at this fraction of real Gemini/OpenLibrary timing,
+# so the whole section takes seconds; our own overhead isn't scaled
+E2E_TIME_SCALE = 0.05
+E2E_TOPICS = ("cozy village mysteries", "hard science fiction about first contact", "gothic novels in old houses",
+              "literary fiction about siblings", "epic fantasy with political intrigue", "heist thrillers")
+REGRESSION_TOLERANCE = 0.25
+
+def e2e_profiles(scale=E2E_TIME_SCALE):
+    gemini = replay.UpstreamProfile(latency=TIME_TO_FIRST_TOKEN * scale, jitter=0.2 * scale,
+                                    tokens_per_second=OUTPUT_TOKENS_PER_SECOND / scale, seed=1)
+    openlibrary = replay.UpstreamProfile(latency=0.25 * scale, jitter=0.25 * scale, seed=2)
+    return gemini, openlibrary
+
+def _fresh_state():
+    """Nothing answered from caches or local indexes, so every query does the full work."""
+    catalog.set_catalog(None)
+    retrieval.set_retrieval_index(None)
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    book_filters.set_metadata_cache(book_filters.MetadataCache(db_path=None))
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    scheduler.set_scheduler(scheduler.RequestScheduler(requests_per_minute=60000, burst=100))
+
+def bench_end_to_end(fixtures_dir=None, queries=E2E_QUERIES):
+    """
+    recommend_books and RecommendationStream against fake (or replayed)
+    Gemini and OpenLibrary: p50/p95 latency, time to the first streamed book,
+    parse throughput and peak memory per query, for 1-10 results.
+    """
+    source = f"replaying {fixtures_dir}" if fixtures_dir else "fake upstreams"
+    print(f"\nEnd to end, {source} at {E2E_TIME_SCALE:g}x real upstream timing, {queries} queries per size")
+    print(f"{'results':>8}{'p50 ms':>9}{'p95 ms':>9}{'stream 1st p50':>16}{'stream p95':>12}"
+          f"{'parse/s':>10}{'peak KB':>9}")
+    gemini_profile, openlibrary_profile = e2e_profiles()
+    replay.use_offline_upstreams(fixtures_dir, gemini_profile, openlibrary_profile)
+    results = {}
+    try:
+        for n in E2E_RESULT_COUNTS:
+            results[str(n)] = row = _end_to_end_row(n, queries)
+            print(f"{n:>8}{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}{row['stream_first_p50_ms']:>16.0f}"
+                  f"{row['stream_p95_ms']:>12.0f}{row['parse_per_second']:>10.0f}{row['peak_kb']:>9.0f}")
+    finally:
+        replay.use_upstreams(None, None)
+    return results
+
+def _end_to_end_row(n, queries):
+    # the app's progress prints would drown the table
+    with contextlib.redirect_stdout(io.StringIO()):
+        _fresh_state()
+        batch, first_book, streamed = [], [], []
+        for i in range(queries):
+            prompt = f"{E2E_TOPICS[i % len(E2E_TOPICS)]} #{n}-{i}"
+            start = time.perf_counter()
+            book_recommender.recommend_books(prompt, "key", num_results=n, use_cache=False)
+            batch.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            first = None
+            for _ in book_recommender.RecommendationStream(f"{prompt} streamed", "key", num_results=n,
+                                                           use_cache=False):
+                first = first or time.perf_counter() - start
+            first_book.append(first)
+            streamed.append(time.perf_counter() - start)
+
+        response = replay.fake_gemini_text(book_recommender.build_system_prompt(n), E2E_TOPICS[0])
+        parse_seconds = time_call(book_recommender.parse_books, response, repeat=50)
+
+        _fresh_state()
+        tracemalloc.start()
+        book_recommender.recommend_books(f"{E2E_TOPICS[0]} memory #{n}", "key", num_results=n, use_cache=False)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": percentile(batch, 0.5) * 1000,
+        "p95_ms": percentile(batch, 0.95) * 1000,
+        "stream_first_p50_ms": percentile(first_book, 0.5) * 1000,
+        "stream_p95_ms": percentile(streamed, 0.95) * 1000,
+        "parse_per_second": 1 / parse_seconds,
+        "peak_kb": peak / 1024,
+    }
+
+def compare_with_baseline(results, baseline_path, tolerance=REGRESSION_TOLERANCE):
+    """Regressions beyond tolerance against a saved run, as printable lines."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["end_to_end"]
+    regressions = []
+    for n, row in results.items():
+        before = baseline.get(n)
+        if not before:
+            continue
+        for metric in ("p95_ms", "stream_p95_ms", "peak_kb"):
+            if row[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{n} results: {metric} {before[metric]:.0f} -> {row[metric]:.0f}")
+        if row["parse_per_second"] < before["parse_per_second"] * (1 - tolerance):
+            regressions.append(f"{n} results: parse_per_second {before['parse_per_second']:.0f} -> "
+                               f"{row['parse_per_second']:.0f}")
+    return regressions
+
+UI_REPEATS = 5
+# what the user does, in order: (label, how to do it on an AppTest)
+UI_INTERACTIONS = (
+    ("first load", lambda at: at),
+    ("search, 10 books", lambda at: _form_button(at, "Find Books").click()),
+    ("move year slider", lambda at: next(s for s in at.slider if s.label == "Year Published:").set_value((1960, 2025))),
+    ("tick a genre", lambda at: at.checkbox(key="genre_Mystery").check()),
+    ("type follow-up", lambda at: at.text_input(key="followup").input("shorter ones")),
+    ("send follow-up", lambda at: at.button(key="send_followup").click()),
+)
+
+def _form_button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+def _script_seconds():
+    stages = telemetry.get_telemetry().snapshot()["stages"]
+    return [stages.get(name, {}).get("total_seconds", 0.0) for name in ("script_run", "fragment_run")]
+
+def bench_streamlit(repeats=UI_REPEATS):
+    """
+    Script time per interaction in app.py, run headless with AppTest against
+    the fake upstreams. AppTest reruns the whole script for every
+    interaction; in a browser the sliders and genres sit in the search form
+    and don't rerun anything until it is submitted, and the follow-up box
+    only reruns the results fragment, so that column is what they cost there.
+    """
+    from streamlit.testing.v1 import AppTest
+    print(f"\nStreamlit script time per interaction (median of {repeats})")
+    print(f"{'interaction':<20}{'full rerun ms':>15}{'fragment ms':>13}")
+    os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+    gemini_profile, openlibrary_profile = e2e_profiles()
+    replay.use_offline_upstreams(None, gemini_profile, openlibrary_profile)
+    timings = {label: ([], []) for label, _ in UI_INTERACTIONS}
+    try:
+        with tempfile.TemporaryDirectory() as thumbnail_dir:
+            for i in range(repeats):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _fresh_state()
+                    thumbnails = cover_images.ThumbnailCache(os.path.join(thumbnail_dir, str(i)))
+                    cover_images.set_thumbnail_cache(thumbnails)
+                    app = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                                            default_timeout=60)
+                    for label, interact in UI_INTERACTIONS:
+                        if label == "search, 10 books":
+                            app.text_area[0].input(f"{E2E_TOPICS[i % len(E2E_TOPICS)]} #{i}")
+                            app.slider(key="number_results_slider").set_value(10)
+                        before = _script_seconds()
+                        interact(app).run()
+                        after = _script_seconds()
+                        if app.exception:
+                            raise RuntimeError(f"app.py failed on {label}: {app.exception[0].value}")
+                        timings[label][0].append(after[0] - before[0])
+                        timings[label][1].append(after[1] - before[1])
+                thumbnails.close()
+        cover_images.set_thumbnail_cache(None)
+    finally:
+        replay.use_upstreams(None, None)
+    for label, (full, fragment) in timings.items():
+        print(f"{label:<20}{percentile(full, 0.5) * 1000:>15.0f}{percentile(fragment, 0.5) * 1000:>13.0f}")
+
+STARTUP_REPEATS = 5
+# what a cold process pays: (label, code timed after the interpreter is up)
+STARTUP_STEPS = (
+    ("import app", "import app"),
+    ("import book_recommender", "import book_recommender"),
+    ("warm-up (SDK + model)", "import book_recommender; book_recommender.warm_up('offline-benchmark').join()"),
+)
+
+def _cold_seconds(code):
+    """Wall time of code in a fresh interpreter, the interpreter's own startup excluded."""
+    script = f"import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+    env = dict(os.environ, GEMINI_API_KEY=os.getenv("GEMINI_API_KEY") or "offline-benchmark")
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+def _slowest_imports(module, top=8):
+    """The top-level imports of module that took longest, from python -X importtime."""
+    env = dict(os.environ, GEMINI_API_KEY=os.getenv("GEMINI_API_KEY") or "offline-benchmark")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                            text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # two spaces of indent per nesting level: keep the direct imports
+        if len(name) - len(name.lstrip()) <= 3 and name.strip() != module:
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def bench_startup(repeats=STARTUP_REPEATS):
+    """Cold start: what importing the app costs, and what the warm-up moves off the first search."""
+    print(f"\nCold start (median of {repeats} fresh interpreters)")
+    print(f"{'step':<26}{'ms':>8}")
+    for label, code in STARTUP_STEPS:
+        timings = [_cold_seconds(code) for _ in range(repeats)]
+        print(f"{label:<26}{percentile(timings, 0.5) * 1000:>8.0f}")
+    print("\nslowest imports under app (cumulative ms)")
+    for micros, name in _slowest_imports("app"):
+        print(f"  {name:<32}{micros / 1000:>8.0f}")
+
+ROUTING_REQUESTS = 200
+# a heavy-tailed upstream: most answers are quick, TAIL_SHARE take TAIL_FACTOR times longer
+ROUTING_LATENCY = 0.02
+TAIL_SHARE = 0.05
+TAIL_FACTOR = 20
+
+class _TailModel:
+    """Fake Gemini model with a heavy latency tail, the hedge model a bit faster."""
+    _random = random.Random(3)
+
+    def __init__(self, model_name, generation_config=None, system_instruction=None):
+        self.model_name = model_name
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        latency = ROUTING_LATENCY * (0.7 if self.model_name.endswith("lite") else 1.0)
+        if self._random.random() < TAIL_SHARE:
+            latency *= TAIL_FACTOR
+        time.sleep(latency * (0.8 + 0.4 * self._random.random()))
+        return replay._Response("Name: Benchmark Book")
+
+def bench_routing(requests=ROUTING_REQUESTS):
+    """Latency of sequential generations against a heavy-tailed fake, with and without hedging."""
+    print(f"\nModel routing, {requests} requests, {TAIL_SHARE:.0%} of them {TAIL_FACTOR}x slower")
+    print(f"{'setup':<28}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}{'hedged':>8}{'hedge won':>11}")
+    setups = (
+        ("no hedging", ["gemini-2.0-flash"], False),
+        ("hedge on the same model", ["gemini-2.0-flash"], True),
+        ("hedge on a faster model", ["gemini-2.0-flash", "gemini-2.0-flash-lite"], True),
+    )
+    book_recommender.set_model_factory(_TailModel)
+    # configuring imports the SDK even for fakes; not part of any request's time
+    book_recommender.configure_genai("offline-benchmark")
+    try:
+        for label, models, hedging in setups:
+            # the time-scaled upstream is far below the production floor and defaults
+            router = routing.ModelRouter(models=models, hedging=hedging, min_hedge_delay=0.0,
+                                         default_hedge_delays={"response": ROUTING_LATENCY * 3},
+                                         step_down_queue_depth=0, spare_token=lambda: True)
+            routing.set_router(router)
+            timings = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(requests):
+                    start = time.perf_counter()
+                    book_recommender.get_book_recommendations(f"query {i}", "offline-benchmark")
+                    timings.append(time.perf_counter() - start)
+            stats = router.stats()
+            print(f"{label:<28}" + "".join(f"{percentile(timings, f) * 1000:>8.0f}" for f in (0.5, 0.95, 0.99))
+                  + f"{max(timings) * 1000:>8.0f}{stats['hedge_rate']:>8.1%}{stats['hedge_win_rate']:>11.0%}")
+    finally:
+        book_recommender.set_model_factory(None)
+        routing.set_router(None)
+
+SECTIONS = ("parser", "formats", "catalog", "rerank", "retrieval", "end_to_end", "streamlit", "startup", "routing")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline NovelQuest benchmarks.")
+    parser.add_argument("sections", nargs="*", choices=SECTIONS, help="sections to run (default: all)")
+    parser.add_argument("--fixtures", help="replay recorded fixtures (see replay.py) in the end-to-end runs")
+    parser.add_argument("--save", help="write the end-to-end results to this JSON file")
+    parser.add_argument("--baseline", help="fail if end-to-end results regressed against this JSON file")
+    args = parser.parse_args()
+    sections = args.sections or SECTIONS
+
+    if "parser" in sections:
+        bench_parser()
+    if "formats" in sections:
+        bench_output_formats()
+    if "catalog" in sections:
+        bench_catalog()
+    if "rerank" in sections:
+        bench_rerank_output()
+    if "retrieval" in sections:
+        bench_retrieval()
+    if "streamlit" in sections:
+        bench_streamlit()
+    if "startup" in sections:
+        bench_startup()
+    if "routing" in sections:
+        bench_routing()
+    if "end_to_end" in sections or args.save or args.baseline:
+        results = bench_end_to_end(args.fixtures)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump({"end_to_end": results}, f, indent=2)
+        if args.baseline:
+            regressions = compare_with_baseline(results, args.baseline)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            if regressions:
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Page-count and publication-year filters, checked against real metadata.
+
+The sliders in the app used to be sentences in the prompt, which the model
+is free to ignore. BookFilter checks each recommended book's pages and first
+publication year (from the local catalog or cached OpenLibrary search data)
+and rejects the ones outside the range. Books nobody has metadata for are
+kept and counted as unverified.
+"""
+
+import json
+import os
+import threading
+
+from cover_cache import MISSING, CoverCache
+from shared_state import get_state_backend
+
+METADATA_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metadata.sqlite3")
+
+_metadata_cache = None
+_filter_stats = None
+_lock = threading.Lock()
+
+class MetadataCache(CoverCache):
+    """
+    Pages/year per title+author. The same memory, shared backend and SQLite
+    layers as the cover cache, but its own file, key namespace and stats, so
+    filter lookups don't show up as cover hits. get() returns the metadata
+    dict ({} when OpenLibrary knew nothing) or MISSING.
+    """
+
+    def __init__(self, db_path=METADATA_DB_PATH, backend=None, **settings):
+        super().__init__(db_path=db_path, backend=backend, namespace="metadata", **settings)
+
+    def get(self, title, author):
+        cached = super().get(title, author)
+        if cached is MISSING:
+            return MISSING
+        return json.loads(cached) if cached else {}
+
+    def put(self, title, author, metadata):
+        """Store what is known about a book; nothing known expires sooner, like a missing cover."""
+        super().put(title, author, json.dumps(metadata) if metadata else None)
+
+class BookFilter:
+    """Inclusive page and year bounds; None means no bound on that side."""
+
+    def __init__(self, min_pages=None, max_pages=None, min_year=None, max_year=None):
+        self.min_pages = min_pages
+        self.max_pages = max_pages
+        self.min_year = min_year
+        self.max_year = max_year
+
+    @property
+    def active(self):
+        return any(bound is not None for bound in (self.min_pages, self.max_pages, self.min_year, self.max_year))
+
+    def key(self):
+        """Part of the response cache key, None when nothing is filtered."""
+        if not self.active:
+            return None
+        return {"pages": [self.min_pages, self.max_pages], "years": [self.min_year, self.max_year]}
+
+    def describe(self):
+        """The filter as prompt sentences, so the model aims for it in the first place."""
+        text = ""
+        text += _range_sentence("The book should have", self.min_pages, self.max_pages, "pages")
+        text += _range_sentence("The book should be published", self.min_year, self.max_year, None)
+        return text
+
+    def check(self, book):
+        """
+        Return "ok", "unverified", "pages" or "year" (the failed check) for a
+        book dict with optional "pages" and "year" fields.
+        """
+        pages, year = book.get("pages"), book.get("year")
+        if pages is not None:
+            if (self.min_pages is not None and pages < self.min_pages) or \
+                    (self.max_pages is not None and pages > self.max_pages):
+                return "pages"
+        if year is not None:
+            if (self.min_year is not None and year < self.min_year) or \
+                    (self.max_year is not None and year > self.max_year):
+                return "year"
+        needs_pages = self.min_pages is not None or self.max_pages is not None
+        needs_year = self.min_year is not None or self.max_year is not None
+        if (needs_pages and pages is None) or (needs_year and year is None):
+            return "unverified"
+        return "ok"
+
+def _range_sentence(prefix, low, high, unit):
+    unit = f" {unit}" if unit else ""
+    if low is not None and high is not None:
+        return f" {prefix} between {low} and {high}{unit}."
+    if low is not None:
+        return f" {prefix} {'at least' if unit else 'in or after'} {low}{unit}."
+    if high is not None:
+        return f" {prefix} {'at most' if unit else 'in or before'} {high}{unit}."
+    return ""
+
+def metadata_from_doc(doc):
+    """Pages and year from an OpenLibrary search doc, as stored in the metadata cache."""
+    if not doc:
+        return None
+    pages = doc.get("number_of_pages_median")
+    year = doc.get("first_publish_year")
+    return {
+        "pages": pages if isinstance(pages, int) and pages > 0 else None,
+        "year": year if isinstance(year, int) else None,
+    }
+
+class FilterStats:
+    """Counts how often the filter had to step in and what the refills cost."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "checked": 0,
+            "passed": 0,
+            "unverified": 0,
+            "rejected_pages": 0,
+            "rejected_year": 0,
+            "refill_requests": 0,
+            "refill_books": 0,
+            # books a full re-query would have asked for instead of the refills
+            "requery_books_avoided": 0,
+        }
+
+    def record(self, verdict):
+        with self._lock:
+            self._counters["checked"] += 1
+            if verdict == "ok":
+                self._counters["passed"] += 1
+            elif verdict == "unverified":
+                self._counters["unverified"] += 1
+            else:
+                self._counters[f"rejected_{verdict}"] += 1
+
+    def record_refill(self, requested, num_results):
+        with self._lock:
+            self._counters["refill_requests"] += 1
+            self._counters["refill_books"] += requested
+            self._counters["requery_books_avoided"] += num_results - requested
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        rejected = stats["rejected_pages"] + stats["rejected_year"]
+        stats["rejection_rate"] = rejected / stats["checked"] if stats["checked"] else 0.0
+        stats["verified_rate"] = (stats["checked"] - stats["unverified"]) / stats["checked"] if stats["checked"] else 0.0
+        return stats
+
+def get_metadata_cache():
+    """Return the process-wide MetadataCache, creating it on first use."""
+    global _metadata_cache
+    with _lock:
+        if _metadata_cache is None:
+            _metadata_cache = MetadataCache(db_path=os.getenv("NOVELQUEST_METADATA_DB", METADATA_DB_PATH),
+                                            backend=get_state_backend())
+        return _metadata_cache
+
+def set_metadata_cache(cache):
+    global _metadata_cache
+    with _lock:
+        _metadata_cache = cache
+
+def cache_metadata(title, author, doc):
+    """Store what an OpenLibrary search doc says about pages and year; returns it."""
+    metadata = metadata_from_doc(doc)
+    get_metadata_cache().put(title, author, metadata)
+    return metadata
+
+def get_filter_stats():
+    global _filter_stats
+    with _lock:
+        if _filter_stats is None:
+            _filter_stats = FilterStats()
+        return _filter_stats
+
+def set_filter_stats(stats):
+    global _filter_stats
+    with _lock:
+        _filter_stats = stats
@@ -0,0 +1,381 @@
+"""
+Parsers for the model's book listings.
+
+Text mode: each line is looked at once, a "Label: value" line either sets a
+field or starts the next book, anything else continues the previous
+multi-line field. That keeps parsing linear in the response size, even for
+malformed output, and it works the same whether the text arrives whole or in
+stream chunks.
+
+JSON mode: the model answers with an array matching BOOK_JSON_SCHEMA, which
+is decoded with the json module and validated field by field.
+"""
+
+import json
+import re
+
+FIELDS = ("name", "author", "genre", "price", "ai_reasoning", "description")
+REQUIRED_FIELDS = ("name", "author")
+MULTILINE_FIELDS = ("ai_reasoning", "description")
+
+# label (lowercased, "_" as space) -> field. The first group is the format we
+# ask for, the rest is what the model drifts into when it ignores it.
+STRICT_LABELS = {
+    "name": "name",
+    "author": "author",
+    "genre": "genre",
+    "price": "price",
+    "ai reasoning": "ai_reasoning",
+    "amazon link": "amazon_link",
+    "description": "description",
+}
+LOOSE_LABELS = {
+    "title": "name",
+    "book": "name",
+    "book name": "name",
+    "book title": "name",
+    "by": "author",
+    "authors": "author",
+    "writer": "author",
+    "genres": "genre",
+    "category": "genre",
+    "type": "genre",
+    "cost": "price",
+    "approximate price": "price",
+    "reason": "ai_reasoning",
+    "reasoning": "ai_reasoning",
+    "why": "ai_reasoning",
+    "why you'll like it": "ai_reasoning",
+    "recommendation": "ai_reasoning",
+    "amazon": "amazon_link",
+    "link": "amazon_link",
+    "about": "description",
+    "summary": "description",
+    "synopsis": "description",
+}
+
+# labels are short, so the colon is only looked for near the start of a line
+MAX_LABEL_LENGTH = 30
+
+CONVERSATIONAL_QUESTIONS = (
+    "What do you think of these?",
+    "Are these the kind of books you're looking for?",
+    "Would you like me to refine the suggestions based on any specific preferences?",
+)
+
+_LIST_MARKER = re.compile(r"(?:\d{1,3}[.)]\s+)?")
+_BOOK_NUMBER = re.compile(r"book\s*\d{1,3}")
+
+def strip_conversational_trailer(text):
+    """Cut the text at the first stock chatbot question, if any."""
+    cut = len(text)
+    for question in CONVERSATIONAL_QUESTIONS:
+        pos = text.find(question)
+        if pos != -1 and pos < cut:
+            cut = pos
+    return text[:cut].strip()
+
+def split_label(line):
+    """
+    Split "Label: value" into (field, value, strict). field is "separator"
+    for "Book 3:" lines and None when the line isn't a known label.
+    """
+    stripped = line.lstrip(" \t>*#-•")
+    stripped = stripped[_LIST_MARKER.match(stripped).end():]
+    colon = stripped.find(":", 0, MAX_LABEL_LENGTH)
+    if colon == -1:
+        return None, line, False
+
+    label = stripped[:colon].strip(" *_").replace("_", " ").lower()
+    label = " ".join(label.split())
+    value = stripped[colon + 1:].strip()
+    if value.startswith("**") or value.startswith("__"):
+        value = value[2:].strip()
+
+    if label in STRICT_LABELS:
+        return STRICT_LABELS[label], value, True
+    if label in LOOSE_LABELS:
+        return LOOSE_LABELS[label], value, False
+    if _BOOK_NUMBER.fullmatch(label):
+        # "Book 2:" on its own line separates books, "Book 2: Dune" names one
+        return ("separator", value, True) if not value else ("name", value, False)
+    return None, line, False
+
+class BookParser:
+    """
+    Incremental parser. feed() text as it arrives and get back the books that
+    are known to be complete; close() flushes the last one. Every book seen,
+    kept or dropped, gets an entry in diagnostics.
+    """
+
+    def __init__(self):
+        self.diagnostics = []
+        self._pending = []
+        self._line_no = 0
+        self._current = None
+        self._last_field = None
+
+    def feed(self, text):
+        # a partial line waits in _pending until its newline arrives
+        self._pending.append(text)
+        if "\n" not in text:
+            return []
+        lines = "".join(self._pending).split("\n")
+        self._pending = [lines.pop()]
+        finished = []
+        for line in lines:
+            book = self._handle_line(line.rstrip("\r"))
+            if book:
+                finished.append(book)
+        return finished
+
+    def close(self):
+        finished = []
+        tail = "".join(self._pending)
+        self._pending = []
+        if tail:
+            book = self._handle_line(tail.rstrip("\r"))
+            if book:
+                finished.append(book)
+        book = self._finish_book()
+        if book:
+            finished.append(book)
+        return finished
+
+    def _handle_line(self, line):
+        self._line_no += 1
+        field, value, strict = split_label(line)
+
+        if field is not None and not strict and self._is_repeat_inside_text(field):
+            # e.g. "Type: ..." inside a description that already has a genre
+            field = None
+        if field is None:
+            # continuation of the previous field, or text outside any book
+            if self._current is not None and line.strip() and self._accepts_continuation():
+                self._current["fields"][self._last_field].append(line.strip())
+            return None
+
+        if field == "separator":
+            return self._finish_book()
+
+        starts_new_book = (
+            self._current is None
+            or (field == "name" and self._current["fields"])
+            or field in self._current["fields"]
+        )
+        finished = None
+        if starts_new_book:
+            finished = self._finish_book()
+            self._current = {"fields": {}, "line": self._line_no, "loose_labels": []}
+
+        if not strict:
+            self._current["loose_labels"].append(line.split(":", 1)[0].strip())
+        # parts are joined once the book is finished
+        self._current["fields"][field] = [value]
+        self._last_field = field
+        return finished
+
+    def _is_repeat_inside_text(self, field):
+        return (
+            self._current is not None
+            and field != "name"
+            and field in self._current["fields"]
+            and self._last_field in MULTILINE_FIELDS
+        )
+
+    def _accepts_continuation(self):
+        if self._last_field in MULTILINE_FIELDS:
+            return True
+        # "Name:" with the value on the next line
+        return self._last_field is not None and not any(self._current["fields"][self._last_field])
+
+    def _finish_book(self):
+        current, self._current, self._last_field = self._current, None, None
+        if current is None:
+            return None
+
+        fields = {field: "\n".join(parts).strip() for field, parts in current["fields"].items()}
+        missing = [field for field in FIELDS if not fields.get(field)]
+        book = {field: fields.get(field, "") for field in FIELDS}
+        for field in MULTILINE_FIELDS:
+            book[field] = strip_conversational_trailer(book[field])
+
+        kept = all(fields.get(field) for field in REQUIRED_FIELDS)
+        self.diagnostics.append({
+            "index": len(self.diagnostics),
+            "line": current["line"],
+            "name": book["name"],
+            "status": "ok" if not missing else ("incomplete" if kept else "dropped"),
+            "missing_fields": missing,
+            "loose_labels": current["loose_labels"],
+        })
+        return book if kept else None
+
+def parse_book_fields(text):
+    """Parse a full response. Returns (list of field dicts, diagnostics)."""
+    parser = BookParser()
+    books = parser.feed(text)
+    books.extend(parser.close())
+    return books, parser.diagnostics
+
+# declared to Gemini as response_schema in JSON mode
+BOOK_JSON_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "author": {"type": "string"},
+            "genre": {"type": "string"},
+            "price": {"type": "string"},
+            "ai_reasoning": {"type": "string"},
+            "description": {"type": "string"},
+        },
+        "required": list(FIELDS),
+    },
+}
+
+_JSON_SPECIAL = re.compile(r'[{}\[\]"\\]')
+
+def validate_book_json(item, index=0):
+    """
+    Check one decoded book object against BOOK_JSON_SCHEMA.
+    Returns (fields or None, diagnostics entry).
+    """
+    if not isinstance(item, dict):
+        return None, {"index": index, "line": None, "name": "", "status": "dropped",
+                      "missing_fields": list(FIELDS), "loose_labels": [], "error": "not an object"}
+
+    fields = {}
+    for field in FIELDS:
+        value = item.get(field, "")
+        if isinstance(value, list):
+            value = ", ".join(str(v) for v in value)
+        elif not isinstance(value, str):
+            value = str(value)
+        fields[field] = value.strip()
+    for field in MULTILINE_FIELDS:
+        fields[field] = strip_conversational_trailer(fields[field])
+
+    missing = [field for field in FIELDS if not fields[field]]
+    kept = all(fields[field] for field in REQUIRED_FIELDS)
+    diagnostic = {
+        "index": index,
+        "line": None,
+        "name": fields["name"],
+        "status": "ok" if not missing else ("incomplete" if kept else "dropped"),
+        "missing_fields": missing,
+        "loose_labels": [],
+    }
+    return (fields if kept else None), diagnostic
+
+def parse_book_json(text):
+    """
+    Parse a JSON-mode response. Returns (list of field dicts, diagnostics);
+    raises ValueError when the text isn't a JSON array of books.
+    """
+    data = json.loads(text)
+    if isinstance(data, dict) and isinstance(data.get("books"), list):
+        data = data["books"]
+    if not isinstance(data, list):
+        raise ValueError("expected a JSON array of books")
+
+    books, diagnostics = [], []
+    for index, item in enumerate(data):
+        fields, diagnostic = validate_book_json(item, index)
+        diagnostics.append(diagnostic)
+        if fields:
+            books.append(fields)
+    return books, diagnostics
+
+class JsonBookParser:
+    """
+    Incremental parser for a streamed JSON array of books, with the same
+    feed()/close() interface as BookParser. Each object is decoded as soon
+    as its closing brace arrives. Like parse_book_json it also takes the
+    array wrapped as {"books": [...]}.
+    """
+
+    def __init__(self):
+        self.diagnostics = []
+        self._buffer = ""
+        self._pos = 0
+        # open brackets; the array of a {"books": [...]} wrapper is "books"
+        self._stack = []
+        self._in_string = False
+        self._key_start = None
+        self._key = None
+        self._object_start = None
+
+    def feed(self, text):
+        self._buffer += text
+        finished = []
+        for match in _JSON_SPECIAL.finditer(self._buffer, self._pos):
+            char, pos = match.group(), match.start()
+            if pos < self._pos:
+                # the character after a backslash
+                continue
+            self._pos = pos + 1
+            if self._in_string:
+                if char == "\\":
+                    self._pos = pos + 2
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = self._buffer[self._key_start + 1:pos]
+                        self._key_start = None
+            elif char == '"':
+                self._in_string = True
+                if self._stack == ["{"]:
+                    # a string in the wrapper: the last one before "[" is that array's key
+                    self._key_start = pos
+            elif char in "[{":
+                if char == "{" and self._in_books():
+                    self._object_start = pos
+                if char == "[" and self._stack == ["{"] and self._key == "books":
+                    char = "books"
+                self._stack.append(char)
+            elif self._stack:
+                self._stack.pop()
+                if char == "}" and self._object_start is not None and self._in_books():
+                    fields = self._finish_object(self._buffer[self._object_start:pos + 1])
+                    if fields:
+                        finished.append(fields)
+                    self._object_start = None
+
+        # only an unfinished object or wrapper key needs to be kept around
+        starts = [start for start in (self._object_start, self._key_start) if start is not None]
+        keep_from = min(starts) if starts else min(self._pos, len(self._buffer))
+        self._buffer = self._buffer[keep_from:]
+        self._pos -= keep_from
+        if self._object_start is not None:
+            self._object_start -= keep_from
+        if self._key_start is not None:
+            self._key_start -= keep_from
+        return finished
+
+    def _in_books(self):
+        """Whether the innermost open bracket is the array of books."""
+        return self._stack in (["["], ["{", "books"])
+
+    def close(self):
+        if self._object_start is not None:
+            self.diagnostics.append({
+                "index": len(self.diagnostics), "line": None, "name": "", "status": "dropped",
+                "missing_fields": list(FIELDS), "loose_labels": [], "error": "truncated object",
+            })
+        return []
+
+    def _finish_object(self, raw):
+        index = len(self.diagnostics)
+        try:
+            item = json.loads(raw)
+        except ValueError as e:
+            self.diagnostics.append({
+                "index": index, "line": None, "name": "", "status": "dropped",
+                "missing_fields": list(FIELDS), "loose_labels": [], "error": str(e),
+            })
+            return None
+        fields, diagnostic = validate_book_json(item, index)
+        self.diagnostics.append(diagnostic)
+        return fields
@@ -1,13 +1,115 @@
 import os
-import re
-import google.generativeai as genai
+import functools
 import time
 import urllib.parse
-import requests
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from book_filters import BookFilter, cache_metadata, get_filter_stats, get_metadata_cache
+from book_parser import BOOK_JSON_SCHEMA, BookParser, JsonBookParser, parse_book_fields, parse_book_json
+from catalog import get_catalog
+from conversation import estimate_tokens, truncate_to_tokens
+from cover_cache import MISSING, get_cover_cache, make_cover_key
+# PLACEHOLDER_COVER_URL is the bundled "No cover" image, as a data URI
+from cover_images import PLACEHOLDER_COVER_URL, thumbnail_stats
+from response_cache import get_response_cache, make_response_key
+from retrieval import get_retrieval_index
+from routing import MODELS, get_router
+from scheduler import get_scheduler
+from telemetry import get_telemetry
+
+# the primary model (NOVELQUEST_MODELS); routing.py hedges slow requests on the next one
+MODEL_NAME = MODELS[0]
+GENERATION_CONFIG = {
+    "temperature": 0.5,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 2048,
+    "response_mime_type": "text/plain",
+}
+# "json" asks Gemini for an array matching BOOK_JSON_SCHEMA instead of the
+# Name:/Author: text format; text is still used when the JSON doesn't validate
+OUTPUT_FORMATS = ("text", "json")
+DEFAULT_OUTPUT_FORMAT = os.getenv("NOVELQUEST_OUTPUT_FORMAT", "text")
+JSON_GENERATION_CONFIG = {
+    **GENERATION_CONFIG,
+    "response_mime_type": "application/json",
+    "response_schema": BOOK_JSON_SCHEMA,
+}
+
+OPENLIBRARY_SEARCH_URL = "https://openlibrary.org/search.json"
+
+# cover lookups for one response run side by side, bounded by these
+COVER_LOOKUP_WORKERS = 10
+COVER_LOOKUP_TIMEOUT = 5
+COVER_BATCH_DEADLINE = 6
+
+# how many times the books that failed a filter are asked for again
+MAX_REFILL_ROUNDS = 2
+
+# retrieval fast path: the local corpus supplies candidates and the model
+# only picks among them, so it writes a few lines per book instead of a page
+RERANK_CANDIDATES_PER_BOOK = 3
+# hash collisions alone give unrelated text a cosine of up to ~0.07
+MIN_RETRIEVAL_SIMILARITY = 0.1
+CATALOG_PICK_REASONING = "Picked from our catalog as one of the closest matches to your request."
+RERANK_DESCRIPTION_TOKENS = 60
+RERANK_GENERATION_CONFIG = {**GENERATION_CONFIG, "max_output_tokens": 1024}
+
+# google.generativeai, imported by load_genai on first use: it is most of a
+# cold start, and pages without a search never need it
+genai = None
+_genai_lock = threading.Lock()
+_warm_up_started = False
+_http_session = None
+_cover_executor = None
+_configured_api_key = None
+_models = {}
+_models_lock = threading.Lock()
+# builds models instead of genai.GenerativeModel when set (see replay.py)
+_model_factory = None
+
+def load_genai():
+    """Import the Gemini SDK the first time it is needed and return it."""
+    global genai
+    with _genai_lock:
+        if genai is None:
+            with get_telemetry().span("sdk_import"):
+                import google.generativeai
+            genai = google.generativeai
+    return genai
 
 def configure_genai(api_key):
-    """Configure the Gemini API with the provided API key."""
-    genai.configure(api_key=api_key)
+    """Configure the Gemini API with the provided API key (once per key)."""
+    global _configured_api_key
+    if api_key != _configured_api_key:
+        load_genai().configure(api_key=api_key)
+        _configured_api_key = api_key
+
+def warm_up(api_key, num_results=5, output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Import the SDK, build the model for these settings and open the HTTP
+    session on a background thread, once per process, so the first search
+    doesn't pay for them. The app calls it after the page has rendered.
+    Returns the thread, or None when there was nothing to do.
+    """
+    global _warm_up_started
+    with _genai_lock:
+        if _warm_up_started or not api_key:
+            return None
+        _warm_up_started = True
+
+    def run():
+        try:
+            with get_telemetry().span("warm_up"):
+                get_model(api_key, num_results, output_format)
+                get_http_session()
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name="warm-up")
+    thread.start()
+    return thread
     
 def generate_amazon_in_link(book_title, author):
     """Generate a valid Amazon India search link for a book."""
@@ -15,48 +117,278 @@ def generate_amazon_in_link(book_title, author):
     encoded_query = urllib.parse.quote(query)
     return f"https://www.amazon.in/s?k={encoded_query}"
 
-def fetch_cover_via_openlibrary(title, author):
+def get_http_session():
+    """Return the shared pooled HTTP session used for OpenLibrary calls."""
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=COVER_LOOKUP_WORKERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _http_session = session
+    return _http_session
+
+def set_http_session(session):
+    """Swap the OpenLibrary session, e.g. for a recording or replaying one. None goes back to the default."""
+    global _http_session
+    _http_session = session
+
+def set_model_factory(factory):
+    """
+    Build models with factory(model_name=..., generation_config=...,
+    system_instruction=...) instead of genai.GenerativeModel. None goes back
+    to Gemini. Already built models are dropped.
+    """
+    global _model_factory
+    with _models_lock:
+        _model_factory = factory
+        _models.clear()
+
+def search_openlibrary(title, author):
+    """
+    First OpenLibrary search result for title+author, or None when there is
+    none. Network errors are raised.
+    """
+    resp = get_http_session().get(
+        OPENLIBRARY_SEARCH_URL,
+        params={"title": title, "author": author, "limit": 1},
+        timeout=COVER_LOOKUP_TIMEOUT
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    docs = data.get("docs", [])
+    return docs[0] if docs else None
+
+def cover_url_from_doc(doc):
+    """Medium cover URL from a search result's cover_i or ISBN, else None."""
+    if not doc:
+        return None
+    # try cover_i
+    if doc.get("cover_i"):
+        cover_id = doc["cover_i"]
+        return f"https://covers.openlibrary.org/b/id/{cover_id}-M.jpg"
+    #fallback to ISBN
+    if doc.get("isbn"):
+        isbn = doc["isbn"][0]
+        return f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg"
+    return None
+
+def search_openlibrary_cover(title, author):
     """
     Search OpenLibrary for title+author, grab the first cover_i or ISBN.
+    Returns None when OpenLibrary has no cover; network errors are raised.
+    """
+    return cover_url_from_doc(search_openlibrary(title, author))
+
+def fetch_cover_via_openlibrary(title, author):
     """
+    Cover URL for title+author, served from the cover cache when possible.
+    Only real answers are cached, failed lookups are retried next time.
+    The same search result also fills the metadata cache used by filters.
+    """
+    cache = get_cover_cache()
+    cached = cache.get(title, author)
+    telemetry = get_telemetry()
+    if cached is not MISSING:
+        telemetry.increment("cover_lookups", source="cache")
+        return cached
+    telemetry.increment("cover_lookups", source="openlibrary")
     try:
-        resp = requests.get(
-            "https://openlibrary.org/search.json",
-            params={"title": title, "author": author, "limit": 1},
-            timeout=5
+        with telemetry.span("cover_lookup", book=title):
+            doc = search_openlibrary(title, author)
+    except Exception:
+        telemetry.increment("cover_lookup_errors")
+        return None
+    cache_metadata(title, author, doc)
+    cover_url = cover_url_from_doc(doc)
+    cache.put(title, author, cover_url)
+    return cover_url
+
+def get_cover_executor():
+    """Return the shared thread pool that runs cover lookups."""
+    global _cover_executor
+    if _cover_executor is None:
+        _cover_executor = ThreadPoolExecutor(max_workers=COVER_LOOKUP_WORKERS, thread_name_prefix="cover")
+    return _cover_executor
+
+def enrich_from_catalog(book):
+    """
+    Fill in work_key, isbn, pages and year from the local catalog, and the
+    cover when the catalog has one. Returns True if the cover was resolved.
+    """
+    catalog = get_catalog()
+    if catalog is None:
+        return False
+    match = catalog.lookup(book["name"], book["author"])
+    if match is None:
+        return False
+    for field in ("work_key", "isbn", "pages", "year"):
+        book[field] = match[field]
+    if match["cover_url"]:
+        book["cover_url"] = match["cover_url"]
+        return True
+    return False
+
+def book_identity(book):
+    """Catalog work when known, else normalized title+author. Used to drop duplicates."""
+    return book.get("work_key") or make_cover_key(book["name"], book["author"])
+
+def dedupe_books(books):
+    seen = set()
+    unique = []
+    for book in books:
+        identity = book_identity(book)
+        if identity not in seen:
+            seen.add(identity)
+            unique.append(book)
+    if len(unique) < len(books):
+        print(f"Dropped {len(books) - len(unique)} duplicate books")
+    return unique
+
+def start_cover_lookup(book):
+    """
+    Start looking up the cover for one book and return the future. Books the
+    local catalog knows get an already finished future, no network call.
+    """
+    if enrich_from_catalog(book):
+        get_telemetry().increment("cover_lookups", source="catalog")
+        future = Future()
+        future.set_result(book["cover_url"])
+        return future
+    return get_cover_executor().submit(get_telemetry().bind(fetch_cover_via_openlibrary), book["name"], book["author"])
+
+def resolve_book_metadata(book):
+    """
+    Fill in missing pages/year from the metadata cache (filled by cover
+    lookups), searching OpenLibrary only when nothing is cached.
+    """
+    if book.get("pages") is not None and book.get("year") is not None:
+        return book
+    metadata = get_metadata_cache().get(book["name"], book["author"])
+    if metadata is MISSING:
+        try:
+            with get_telemetry().span("metadata_lookup", book=book["name"]):
+                doc = search_openlibrary(book["name"], book["author"])
+            metadata = cache_metadata(book["name"], book["author"], doc)
+        except Exception:
+            return book
+    for field, value in (metadata or {}).items():
+        if book.get(field) is None:
+            book[field] = value
+    return book
+
+def filter_books(books, book_filter):
+    """
+    Split books into (kept, rejected) by book_filter. Unverifiable books are
+    kept. Every verdict goes into the filter stats.
+    """
+    if book_filter is None or not book_filter.active or not books:
+        return list(books), []
+    with get_telemetry().span("filter", books=len(books)):
+        list(get_cover_executor().map(get_telemetry().bind(resolve_book_metadata), books))
+    stats = get_filter_stats()
+    kept, rejected = [], []
+    for book in books:
+        verdict = book_filter.check(book)
+        stats.record(verdict)
+        (rejected if verdict in ("pages", "year") else kept).append(book)
+    return kept, rejected
+
+def exclusion_prompt(user_prompt, books):
+    """The original request plus a list of books not to suggest again."""
+    if not books:
+        return user_prompt
+    listed = "; ".join(f"{book['name']} by {book['author']}" for book in books)
+    return f"{user_prompt}\n\nDo not recommend any of these books: {listed}."
+
+def refill_books(user_prompt, api_key, book_filter, kept, seen, num_results, context=None, session=None,
+                 user_id="anonymous", may_refill=None):
+    """
+    Ask for only the books still missing after filtering, excluding every book
+    already seen, until num_results pass or MAX_REFILL_ROUNDS run out.
+    may_refill() is asked before each round, so a caller with a budget
+    (speculation) can stop them; the estimated tokens of the rounds sent
+    are added up in the trace's refill_tokens.
+    Returns the new books that passed; kept and seen are extended in place.
+    """
+    added = []
+    stats = get_filter_stats()
+    for _ in range(MAX_REFILL_ROUNDS):
+        shortfall = num_results - len(kept)
+        if shortfall <= 0 or (may_refill is not None and not may_refill()):
+            break
+        print(f"Filters left {len(kept)}/{num_results} books, asking for {shortfall} more")
+        stats.record_refill(shortfall, num_results)
+        prompt = exclusion_prompt(user_prompt, seen)
+        response_text = get_scheduler().run(
+            user_id, None, get_book_recommendations,
+            prompt, api_key, num_results=shortfall, context=context, session=session
         )
-        data = resp.json()
-        docs = data.get("docs", [])
-        if not docs:
-            return None
+        trace = get_telemetry().current_trace()
+        if trace is not None:
+            context_tokens = (session.last_context_stats or {}).get("tokens", 0) if session is not None else 0
+            trace.attributes["refill_tokens"] = (trace.attributes.get("refill_tokens", 0) + context_tokens
+                                                 + estimate_tokens(prompt) + estimate_tokens(response_text))
+        seen_ids = {book_identity(book) for book in seen}
+        fresh = [book for book in extract_books_from_response(response_text) if book_identity(book) not in seen_ids]
+        seen.extend(fresh)
+        passed, _ = filter_books(fresh, book_filter)
+        kept.extend(passed[:shortfall])
+        added.extend(passed[:shortfall])
+    return added
 
-        doc = docs[0]
-        # try cover_i
-        if doc.get("cover_i"):
-            cover_id = doc["cover_i"]
-            return f"https://covers.openlibrary.org/b/id/{cover_id}-M.jpg"
-        #fallback to ISBN
-        if doc.get("isbn"):
-            isbn = doc["isbn"][0]
-            return f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg"
-    except Exception:
-        pass
-    return None
+def fetch_covers_concurrently(books, deadline=COVER_BATCH_DEADLINE):
+    """
+    Resolve cover_url for every book in parallel. Lookups still running when
+    the batch deadline passes are abandoned and get the placeholder cover.
+    """
+    if not books:
+        return books
 
-def get_book_recommendations(user_prompt, api_key, num_results=5, context=None):
-    """Get book recommendations from Gemini API based on user prompt."""
-    configure_genai(api_key)
-    
-    generation_config = {
-        "temperature": 0.5,
-        "top_p": 0.95,
-        "top_k": 40,
-        "max_output_tokens": 2048,  
-        "response_mime_type": "text/plain",
-    }
-    
-    
-    system_prompt = f"""You are an AI that recommends books. Your task is to suggest exactly {num_results} books that match the user's description **very closely**. 
+    telemetry = get_telemetry()
+    with telemetry.span("covers", books=len(books)):
+        futures = {start_cover_lookup(book): book for book in books}
+        done, not_done = wait(futures, timeout=deadline)
+    # don't wait for stragglers, they finish (or time out) on their own
+    for future in not_done:
+        future.cancel()
+
+    for future, book in futures.items():
+        cover_url = None
+        if future in done:
+            try:
+                cover_url = future.result()
+            except Exception:
+                pass
+        if not cover_url:
+            telemetry.increment("placeholder_covers", reason="not_found" if future in done else "deadline")
+        book["cover_url"] = cover_url or PLACEHOLDER_COVER_URL
+
+    if not_done:
+        print(f"Cover lookup deadline hit, {len(not_done)} books use the placeholder")
+    return books
+
+def generation_config_for(output_format, max_output_tokens=None):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    config = JSON_GENERATION_CONFIG if output_format == "json" else GENERATION_CONFIG
+    if max_output_tokens:
+        config = {**config, "max_output_tokens": max_output_tokens}
+    return config
+
+@functools.lru_cache(maxsize=32)
+def build_system_prompt(num_results, output_format="text"):
+    """System instruction asking for num_results books in the Name/Author/... format (or as JSON)."""
+    if output_format == "json":
+        return f"""You are an AI that recommends books. Suggest exactly {num_results} books that match the user's description very closely, refining them as the conversation goes on.
+    Answer with a JSON array only, one object per book with these keys:
+    name, author, genre (comma-separated genres), price (approximate price in Indian Rupees, e.g. ₹499),
+    ai_reasoning (why the user will like it, at least 25 words), description (at least 75 words).
+    Do not add any text outside the JSON and do not ask follow-up questions."""
+
+    return f"""You are an AI that recommends books. Your task is to suggest exactly {num_results} books that match the user's description **very closely**. 
     You will engage in a **conversation** with the user, refining recommendations based on their preferences. BUT In the end of ur answer do not ask any follow up questions that ai cahtbots generally ask for for better user experience i dont need that here okay so do not.
     
     For each book, provide the following information in this EXACT format (follow this format precisely):
@@ -79,70 +411,558 @@ def get_book_recommendations(user_prompt, api_key, num_results=5, context=None):
     List prices in Indian Rupees (₹) as these books will be purchased from Amazon India.
 
     IMPORTANT: Always maintain the exact format shown above for each book with the specified fields in that exact order."""
+
+@functools.lru_cache(maxsize=32)
+def build_rerank_prompt(num_results):
+    """System instruction for picking num_results books out of retrieved candidates."""
+    return f"""You are an AI that recommends books. The user message is a request followed by numbered candidate books from our catalog.
+    Pick the {num_results} candidates that match the request best, best match first. Only pick books from the list.
+    For each book, answer in this EXACT format:
+
+    Name: <Book name exactly as listed>
+    Author: <Author exactly as listed>
+    Price: <Approximate price in INR (Indian Rupees), e.g. ₹499>
+    ai_reasoning: <Why the user will like it, at least 25 words.>
+
+    Do not include any other text and do not ask follow-up questions."""
+
+def _cached_model(key, api_key, model_name, generation_config, system_instruction):
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            get_telemetry().increment("model_builds")
+            with get_telemetry().span("model_build"):
+                configure_genai(api_key)
+                model = (_model_factory or load_genai().GenerativeModel)(
+                    model_name=model_name,
+                    generation_config=generation_config,
+                    system_instruction=system_instruction,
+                )
+            _models[key] = model
+    return model
+
+def get_model(api_key, num_results=5, output_format="text", model_name=MODEL_NAME, max_output_tokens=None):
+    """
+    Return the GenerativeModel for these settings, building it only the first
+    time. Models are reused across requests and Streamlit sessions.
+    """
+    return _cached_model(
+        (api_key, model_name, num_results, output_format, max_output_tokens), api_key, model_name,
+        generation_config_for(output_format, max_output_tokens), build_system_prompt(num_results, output_format)
+    )
+
+def get_rerank_model(api_key, num_results=5, model_name=MODEL_NAME):
+    """The (cached) model that re-ranks retrieved candidates."""
+    return _cached_model(
+        (api_key, model_name, num_results, "rerank", None), api_key, model_name,
+        RERANK_GENERATION_CONFIG, build_rerank_prompt(num_results)
+    )
+
+def _start_generation(user_prompt, api_key, num_results, context, stream, output_format="text", session=None,
+                      model_name=MODEL_NAME, max_output_tokens=None, timeout=None):
+    """
+    Send the request to Gemini and return the (possibly streaming) response.
+    timeout (seconds) is handed to the SDK, which gives up on the call then.
+    """
+    model = get_model(api_key, num_results, output_format, model_name, max_output_tokens)
+    request_options = {"timeout": timeout} if timeout else None
     
-    try:
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config,
-            system_instruction=system_prompt,
+    if session is not None and len(session):
+        contents = session.contents_for(user_prompt)
+        stats = session.last_context_stats
+        print(f"Sending {stats['verbatim']} verbatim + {stats['compacted']} compacted turns "
+              f"({stats['dropped']} dropped), ~{stats['tokens']} context tokens")
+        return model.generate_content(contents, stream=stream, request_options=request_options)
+    
+    # If there's context, use it to create a conversation
+    if context:
+        chat = model.start_chat(history=[])
+        return chat.send_message(f"Previous conversation: {context}\n\nNew request: {user_prompt}", stream=stream,
+                                 request_options=request_options)
+    return model.generate_content(user_prompt, stream=stream, request_options=request_options)
+
+def get_book_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text",
+                             session=None, max_output_tokens=None):
+    """
+    Get book recommendations from Gemini API based on user prompt.
+    Pass a conversation.ConversationSession to send its history along as chat turns.
+    The model router (routing.py) applies the deadline and hedges slow calls.
+    """
+    def generate(model_name, timeout):
+        response = _start_generation(
+            user_prompt, api_key, num_results, context, stream=False, output_format=output_format, session=session,
+            model_name=model_name, max_output_tokens=max_output_tokens, timeout=timeout
         )
-        
-        # If there's context, use it to create a conversation
-        if context:
-            chat = model.start_chat(history=[])
-            response = chat.send_message(f"Previous conversation: {context}\n\nNew request: {user_prompt}")
-        else:
-            response = model.generate_content(user_prompt)
-        
         return response.text
+
+    try:
+        with get_telemetry().span("generate", output_format=output_format, streamed=False):
+            return get_router().generate(generate)
     except Exception as e:
-        raise Exception(f"Error getting recommendations: {str(e)}")
+        raise Exception(f"Error getting recommendations: {str(e)}") from e
 
-def extract_books_from_response(response_text):
-    """Extract structured book information from the AI response and generate valid Amazon links."""
-    books = []
-    
-    # regex expression with only giving in the necessary details
-    # It now looks for the start of the next book OR the end of the string,
-    # ensuring it doesn't capture trailing conversational questions.
-    book_pattern = r"(?:Book\s*\d*:?\s*)?Name:\s*(.*?)[\r\n]+\s*Author:\s*(.*?)[\r\n]+\s*Genre:\s*(.*?)[\r\n]+\s*Price:\s*(.*?)[\r\n]+\s*ai_reasoning:\s*(.*?)[\r\n]+\s*(?:Amazon Link:)?.*?[\r\n]+\s*description:\s*(.*?)(?=\s*(?:Book\s*\d*:?\s*)?Name:|\Z)"
-    
-    matches = re.findall(book_pattern, response_text, re.DOTALL)
+def stream_book_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text",
+                                session=None, max_output_tokens=None):
+    """
+    Like get_book_recommendations, but yields the response text chunk by chunk.
+    The time to the first chunk is recorded as the first_token span; that
+    is what the router hedges on.
+    """
+    def chunks(model_name, timeout):
+        response = _start_generation(
+            user_prompt, api_key, num_results, context, stream=True, output_format=output_format, session=session,
+            model_name=model_name, max_output_tokens=max_output_tokens, timeout=timeout
+        )
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+    telemetry = get_telemetry()
+    start = time.perf_counter()
+    first_chunk = True
+    try:
+        for text in get_router().stream(chunks):
+            if first_chunk:
+                telemetry.record_span("first_token", start, time.perf_counter() - start)
+                first_chunk = False
+            yield text
+    except Exception as e:
+        raise Exception(f"Error getting recommendations: {str(e)}") from e
+    finally:
+        telemetry.record_span("generate", start, time.perf_counter() - start, output_format=output_format,
+                              streamed=True)
+
+def format_candidates(user_prompt, candidates):
+    """The re-rank request: the user's words plus a short line per candidate."""
+    lines = [f"Request: {user_prompt}", "", "Candidates:"]
+    for i, book in enumerate(candidates, 1):
+        description = truncate_to_tokens(book["description"], RERANK_DESCRIPTION_TOKENS)
+        lines.append(f"{i}. {book['name']} by {book['author'] or 'unknown author'} ({book['genre']}): {description}")
+    return "\n".join(lines)
+
+def get_reranked_recommendations(user_prompt, candidates, api_key, num_results=5):
+    """Ask the model to pick and explain num_results of the retrieved candidates."""
+    request = format_candidates(user_prompt, candidates)
+
+    def rerank(model_name, timeout):
+        model = get_rerank_model(api_key, num_results, model_name)
+        return model.generate_content(request, request_options={"timeout": timeout}).text
+
+    try:
+        with get_telemetry().span("rerank", candidates=len(candidates)):
+            return get_router().generate(rerank, kind="rerank")
+    except Exception as e:
+        raise Exception(f"Error re-ranking recommendations: {str(e)}") from e
+
+def build_book(fields):
+    """Turn the parsed fields of one book into a book dict (cover_url is the placeholder)."""
+    return {
+        "name": fields["name"],
+        "author": fields["author"],
+        "genre": fields["genre"],
+        "price": fields["price"],
+        "ai_reasoning": fields["ai_reasoning"],
+        "amazon_link": generate_amazon_in_link(fields["name"], fields["author"]),
+        "cover_url": PLACEHOLDER_COVER_URL,
+        "description": fields["description"]
+    }
+
+def parse_books_with_diagnostics(response_text, output_format="text"):
+    """
+    Parse the AI response into book dicts without looking up covers.
+    Also returns one diagnostics entry per book block (see book_parser).
+    JSON that isn't an array of books raises ValueError.
+    """
+    with get_telemetry().span("parse", output_format=output_format, streamed=False):
+        try:
+            if output_format == "json":
+                parsed, diagnostics = parse_book_json(response_text)
+            else:
+                parsed, diagnostics = parse_book_fields(response_text)
+        except ValueError:
+            get_telemetry().increment("parse_failures", output_format=output_format)
+            raise
+        books = [build_book(fields) for fields in parsed]
     
+    loose = record_parse_diagnostics(diagnostics, len(books), output_format)
     print(f"Attempting to extract books from text with length {len(response_text)}")
-    print(f"Found {len(matches)} book matches with primary pattern")
-    
-    # try fallback.
-    if not matches:
-        fallback_pattern = r"(?:.*?)(?:name|title|book):\s*(.*?)[\r\n]+.*?(?:author|by|writer):\s*(.*?)[\r\n]+.*?(?:genre|category|type):\s*(.*?)[\r\n]+.*?(?:price|cost):\s*(.*?)[\r\n]+.*?(?:reason|why|recommendation):\s*(.*?)[\r\n]+.*?(?:description|about|summary):\s*(.*?)(?=(?:.*?(?:name|title|book):)|$)"
-        matches = re.findall(fallback_pattern, response_text, re.DOTALL | re.IGNORECASE)
-        print(f"Using fallback pattern, found {len(matches)} matches")
+    print(f"Found {len(books)} books ({loose} with non-standard labels, {len(diagnostics) - len(books)} dropped)")
+    return books, diagnostics
+
+def record_parse_diagnostics(diagnostics, found, output_format):
+    """Count dropped books, fallback labels and empty parses. Returns the fallback label count."""
+    telemetry = get_telemetry()
+    loose = sum(1 for d in diagnostics if d["loose_labels"])
+    if loose:
+        telemetry.increment("parser_fallback_labels", loose)
+    if len(diagnostics) > found:
+        telemetry.increment("parser_dropped_books", len(diagnostics) - found, output_format=output_format)
+    if not found:
+        telemetry.increment("parse_failures", output_format=output_format)
+    return loose
+
+def parse_books(response_text, output_format="text"):
+    """Parse the AI response into book dicts without looking up covers."""
+    return parse_books_with_diagnostics(response_text, output_format)[0]
+
+def extract_books_from_response(response_text, output_format="text"):
+    """Extract structured book information from the AI response and generate valid Amazon links."""
+    books = parse_books(response_text, output_format)
     
-    # Define a regex to catch common  questions at the end of a string
-    # This will be applied after extraction to fields that might contain them.
-    conversational_question_pattern = r"\s*(?:What do you think of these\?|Are these the kind of books you're looking for\?|Would you like me to refine the suggestions based on any specific preferences\?).*$"
-
-    for match in matches:
-        if len(match) == 6:
-            name, author, genre, price, ai_reasoning, description = [item.strip() for item in match]
-            
-            description = re.sub(conversational_question_pattern, '', description, flags=re.DOTALL).strip()
-            ai_reasoning = re.sub(conversational_question_pattern, '', ai_reasoning, flags=re.DOTALL).strip()
-            
-            amazon_link = generate_amazon_in_link(name, author)
-            cover_url = fetch_cover_via_openlibrary(name, author) or "https://i.imgur.com/YsaUJOQ.png"
-            
-            book = {
-                "name": name,
-                "author": author,
-                "genre": genre,
-                "price": price,
-                "ai_reasoning": ai_reasoning,
-                "amazon_link": amazon_link,
-                "cover_url": cover_url,
-                "description": description
-            }
-            
-            books.append(book)
+    # the local catalog answers first, the remaining cover lookups go out
+    # together so they cost about one round-trip
+    fetch_covers_concurrently(books)
     
-    return books
\ No newline at end of file
+    return dedupe_books(books)
+
+def iter_books_from_chunks(chunks, output_format="text"):
+    """
+    Incremental version of parse_books. A book is yielded as soon as the
+    next one starts (or its JSON object closes), so callers don't wait for
+    the whole response.
+    """
+    parser = JsonBookParser() if output_format == "json" else BookParser()
+    # parsing is spread over the stream, so only the time inside the parser counts
+    start, parse_time, found = None, 0.0, 0
+    for chunk in chunks:
+        fed = time.perf_counter()
+        start = start or fed
+        parsed = parser.feed(chunk)
+        parse_time += time.perf_counter() - fed
+        for fields in parsed:
+            found += 1
+            yield build_book(fields)
+    closed = time.perf_counter()
+    tail = parser.close()
+    parse_time += time.perf_counter() - closed
+    get_telemetry().record_span("parse", start or closed, parse_time, output_format=output_format, streamed=True)
+    for fields in tail:
+        found += 1
+        yield build_book(fields)
+    record_parse_diagnostics(parser.diagnostics, found, output_format)
+
+def enhance_prompt(user_prompt, book_filter=None, genres=None):
+    """The user's request plus the filters spelled out for the model."""
+    filter_prompt = book_filter.describe() if book_filter is not None else ""
+    if genres:
+        filter_prompt += f" The book should be in one or more of these genres: {', '.join(genres)}."
+    return user_prompt + filter_prompt
+
+def recommend_from_corpus(user_prompt, api_key, num_results=5, genres=None, user_id="anonymous", key=None):
+    """
+    Retrieval fast path: candidates from the local corpus index, re-ranked by
+    the model. Returns (response_text, books), or None when there is no index
+    or nothing in it is close enough, so the caller generates as usual.
+    """
+    index = get_retrieval_index()
+    if index is None:
+        return None
+    with get_telemetry().span("retrieval"):
+        candidates = index.search(user_prompt, k=num_results * RERANK_CANDIDATES_PER_BOOK, genres=genres)
+    if len(candidates) < num_results or candidates[0]["similarity"] < MIN_RETRIEVAL_SIMILARITY:
+        return None
+    print(f"Retrieved {len(candidates)} candidates (best similarity {candidates[0]['similarity']:.3f}), re-ranking")
+
+    response_text = get_scheduler().run(
+        user_id, key, get_reranked_recommendations, user_prompt, candidates, api_key, num_results=num_results
+    )
+    by_key = {make_cover_key(c["name"], c["author"]): c for c in candidates}
+    by_title = {make_cover_key(c["name"], ""): c for c in candidates}
+    picks = []
+    for fields in parse_book_fields(response_text)[0]:
+        candidate = by_key.get(make_cover_key(fields["name"], fields["author"])) \
+            or by_title.get(make_cover_key(fields["name"], ""))
+        # books the model made up have nothing to ground them, so they're skipped
+        if candidate is not None and candidate not in [c for c, _ in picks]:
+            picks.append((candidate, fields))
+    if not picks:
+        return None
+    # too few valid picks: the best remaining candidates make up the rest
+    for candidate in candidates:
+        if len(picks) >= num_results:
+            break
+        if candidate not in [c for c, _ in picks]:
+            picks.append((candidate, {"price": "", "ai_reasoning": CATALOG_PICK_REASONING}))
+
+    books = []
+    for candidate, fields in picks[:num_results]:
+        book = build_book({**candidate, "price": fields["price"], "ai_reasoning": fields["ai_reasoning"]})
+        for field in ("work_key", "pages", "year"):
+            if candidate.get(field) is not None:
+                book[field] = candidate[field]
+        books.append(book)
+    fetch_covers_concurrently(books)
+    return response_text, dedupe_books(books)
+
+def _cache_filters(book_filter, genres):
+    """The part of the response cache key that describes filters."""
+    filters = {}
+    if book_filter is not None and book_filter.active:
+        filters["book_filter"] = book_filter.key()
+    if genres:
+        filters["genres"] = sorted(genres)
+    return filters or None
+
+def recommend_books(user_prompt, api_key, num_results=5, context=None, use_cache=True,
+                    output_format=DEFAULT_OUTPUT_FORMAT, session=None, user_id="anonymous", book_filter=None,
+                    genres=None, step_down=True, may_refill=None):
+    """
+    Get recommendations and parse them, reusing a cached result for the same
+    prompt and settings. Pass use_cache=False to force a fresh generation
+    (the fresh result still replaces the cached one).
+    In JSON mode a response that fails validation is retried in text mode.
+    With a book_filter, books outside its page/year range are dropped and
+    only the shortfall is asked for again, while may_refill() allows (see
+    refill_books).
+    A new conversation is answered from the local retrieval index when it
+    has close enough books (restricted to genres, if given).
+    The caller records the turn in its session afterwards.
+    Gemini calls go through the request scheduler, queued fairly per
+    user_id, and identical requests in flight share one call.
+    When the scheduler is backed up, fewer books are asked for (see
+    routing.step_down) unless step_down is False, e.g. for batch runs.
+    Returns (response_text, books).
+    """
+    with get_telemetry().trace("recommend", user_id=user_id) as trace:
+        cache = get_response_cache()
+        key = make_response_key(
+            user_prompt, num_results, MODEL_NAME, generation_config_for(output_format),
+            session.context_key() if session is not None else context,
+            _cache_filters(book_filter, genres)
+        )
+        if use_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                trace.attributes["source"] = "cache"
+                return cached
+        else:
+            cache.record_bypass()
+
+        max_output_tokens = None
+        if step_down:
+            requested = num_results
+            num_results, max_output_tokens = get_router().step_down(num_results)
+            if num_results != requested:
+                # the smaller answer is cached as what it is, not as the full one
+                trace.attributes["stepped_down_from"] = requested
+                key = make_response_key(
+                    user_prompt, num_results, MODEL_NAME, generation_config_for(output_format, max_output_tokens),
+                    session.context_key() if session is not None else context,
+                    _cache_filters(book_filter, genres)
+                )
+
+        scheduler = get_scheduler()
+        books = []
+        if context is None and not session:
+            retrieved = recommend_from_corpus(
+                user_prompt, api_key, num_results, genres, user_id, key=f"{key}:rerank"
+            )
+            if retrieved:
+                response_text, books = retrieved
+                trace.attributes["source"] = "corpus"
+        if not books and output_format == "json":
+            response_text = scheduler.run(
+                user_id, f"{key}:json", get_book_recommendations,
+                user_prompt, api_key, num_results=num_results, context=context, output_format="json", session=session,
+                max_output_tokens=max_output_tokens
+            )
+            try:
+                books = extract_books_from_response(response_text, output_format="json")
+                trace.attributes["source"] = "json"
+            except ValueError as e:
+                print(f"JSON response failed validation ({e}), falling back to text mode")
+            if not books:
+                get_telemetry().increment("format_fallbacks")
+        if not books:
+            response_text = scheduler.run(
+                user_id, f"{key}:text", get_book_recommendations,
+                user_prompt, api_key, num_results=num_results, context=context, session=session,
+                max_output_tokens=max_output_tokens
+            )
+            books = extract_books_from_response(response_text)
+            trace.attributes["source"] = "text"
+        if book_filter is not None and book_filter.active:
+            seen = list(books)
+            books, _ = filter_books(books, book_filter)
+            refill_books(user_prompt, api_key, book_filter, books, seen, num_results,
+                         context=context, session=session, user_id=user_id, may_refill=may_refill)
+        # empty parses aren't cached so a retry gets another chance
+        if books:
+            cache.put(key, response_text, books)
+        return response_text, books
+
+class RecommendationStream:
+    """
+    Streaming counterpart of recommend_books. Iterating yields each book
+    (cover resolved) while later books are still being generated; cover
+    lookups start the moment a book is parsed. After iteration,
+    response_text and books hold the full result, which is also cached.
+    Books failing book_filter are skipped, and the shortfall is requested
+    (unstreamed) once the main stream ends. New conversations try the
+    retrieval fast path first, like recommend_books. When the request was
+    stepped down under load, stepped_down_from is the number asked for.
+    """
+
+    def __init__(self, user_prompt, api_key, num_results=5, context=None, use_cache=True,
+                 output_format=DEFAULT_OUTPUT_FORMAT, session=None, user_id="anonymous", book_filter=None,
+                 genres=None, step_down=True):
+        self.user_prompt = user_prompt
+        self.api_key = api_key
+        self.num_results = num_results
+        self.context = context
+        self.session = session
+        self.user_id = user_id
+        self.use_cache = use_cache
+        self.output_format = output_format
+        self.book_filter = book_filter
+        self.genres = genres
+        self.step_down = step_down
+        self.max_output_tokens = None
+        self.stepped_down_from = None
+        self.response_text = ""
+        self.books = []
+        self.from_cache = False
+
+    def __iter__(self):
+        with get_telemetry().trace("stream", user_id=self.user_id) as trace:
+            cache = get_response_cache()
+            key = make_response_key(
+                self.user_prompt, self.num_results, MODEL_NAME, generation_config_for(self.output_format),
+                self.session.context_key() if self.session is not None else self.context,
+                _cache_filters(self.book_filter, self.genres)
+            )
+            if self.use_cache:
+                cached = cache.get(key)
+                if cached is not None:
+                    self.response_text, self.books = cached
+                    self.from_cache = True
+                    trace.attributes["source"] = "cache"
+                    yield from self.books
+                    return
+            else:
+                cache.record_bypass()
+
+            if self.step_down:
+                requested = self.num_results
+                self.num_results, self.max_output_tokens = get_router().step_down(requested)
+                if self.num_results != requested:
+                    self.stepped_down_from = trace.attributes["stepped_down_from"] = requested
+                    key = make_response_key(
+                        self.user_prompt, self.num_results, MODEL_NAME,
+                        generation_config_for(self.output_format, self.max_output_tokens),
+                        self.session.context_key() if self.session is not None else self.context,
+                        _cache_filters(self.book_filter, self.genres)
+                    )
+
+            if self.context is None and not self.session:
+                # re-ranking is short, so the fast path isn't streamed
+                retrieved = recommend_from_corpus(
+                    self.user_prompt, self.api_key, self.num_results, self.genres, self.user_id, key=f"{key}:rerank"
+                )
+                if retrieved:
+                    trace.attributes["source"] = "corpus"
+                    self.response_text, books = retrieved
+                    seen = list(books)
+                    self.books, _ = filter_books(books, self.book_filter)
+                    yield from list(self.books)
+                    if self.book_filter is not None and self.book_filter.active:
+                        yield from refill_books(
+                            self.user_prompt, self.api_key, self.book_filter, self.books, seen, self.num_results,
+                            user_id=self.user_id
+                        )
+                    if self.books:
+                        cache.put(key, self.response_text, self.books)
+                    return
+
+            # generation and parsing run in the background so they keep going
+            # while the caller renders the books handed out so far
+            parsed = queue.Queue()
+            parts = []
+            seen = []
+            worker = threading.Thread(
+                target=get_telemetry().bind(self._generate), args=(parsed, parts, key), daemon=True
+            )
+            worker.start()
+
+            while True:
+                kind, book, cover_future = parsed.get()
+                if kind == "error":
+                    raise book
+                if kind == "done":
+                    break
+                try:
+                    cover_url = cover_future.result(timeout=COVER_BATCH_DEADLINE)
+                    if not cover_url:
+                        get_telemetry().increment("placeholder_covers", reason="not_found")
+                    book["cover_url"] = cover_url or PLACEHOLDER_COVER_URL
+                except Exception:
+                    get_telemetry().increment("placeholder_covers", reason="deadline")
+                    cover_future.cancel()
+                seen.append(book)
+                kept, _ = filter_books([book], self.book_filter)
+                if not kept:
+                    continue
+                self.books.append(book)
+                yield book
+
+            self.response_text = "".join(parts)
+            trace.attributes["source"] = "generated"
+            if self.book_filter is not None and self.book_filter.active:
+                yield from refill_books(
+                    self.user_prompt, self.api_key, self.book_filter, self.books, seen, self.num_results,
+                    context=self.context, session=self.session, user_id=self.user_id
+                )
+            if self.books:
+                cache.put(key, self.response_text, self.books)
+
+    def _generate(self, parsed, parts, key):
+        def chunks(output_format):
+            # identical streams in flight share one upstream call
+            for chunk in get_scheduler().stream(
+                self.user_id, f"{key}:stream:{output_format}", stream_book_recommendations,
+                self.user_prompt, self.api_key, num_results=self.num_results, context=self.context,
+                output_format=output_format, session=self.session, max_output_tokens=self.max_output_tokens
+            ):
+                parts.append(chunk)
+                yield chunk
+
+        seen = set()
+
+        def publish(book):
+            cover_future = start_cover_lookup(book)
+            identity = book_identity(book)
+            if identity in seen:
+                cover_future.cancel()
+                return
+            seen.add(identity)
+            parsed.put(("book", book, cover_future))
+
+        try:
+            found = 0
+            if self.output_format == "json":
+                for book in iter_books_from_chunks(chunks("json"), output_format="json"):
+                    found += 1
+                    publish(book)
+                if not found:
+                    print("JSON stream had no valid books, falling back to text mode")
+                    get_telemetry().increment("format_fallbacks")
+                    parts.clear()
+            if not found:
+                for book in iter_books_from_chunks(chunks("text")):
+                    publish(book)
+        except Exception as e:
+            parsed.put(("error", e, None))
+            return
+        parsed.put(("done", None, None))
+
+def register_metrics(telemetry=None):
+    """Export the scheduler, cache and filter stats as gauges next to the spans and counters."""
+    telemetry = telemetry or get_telemetry()
+    telemetry.register_collector("scheduler", lambda: get_scheduler().metrics())
+    telemetry.register_collector("response_cache", lambda: get_response_cache().stats())
+    telemetry.register_collector("cover_cache", lambda: get_cover_cache().stats())
+    telemetry.register_collector("metadata_cache", lambda: get_metadata_cache().stats())
+    telemetry.register_collector("filters", lambda: get_filter_stats().stats())
+    telemetry.register_collector("thumbnails", thumbnail_stats)
+
+register_metrics()
@@ -0,0 +1,375 @@
+"""
+Local book catalog built from OpenLibrary dump files.
+
+Ingest the authors, works and editions dumps (in that order; .txt or .gz,
+either the official tab-separated format or one JSON record per line), then
+finalize() to resolve author names and build the trigram index:
+
+    python catalog.py ingest ol_dump_authors.txt.gz ol_dump_works.txt.gz ol_dump_editions.txt.gz
+
+Files are read line by line and written in batches, so a multi-GB dump never
+has to fit in memory. lookup() answers from an indexed exact key first and
+falls back to an FTS5 trigram index for misspelled or reworded titles.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cover_cache import normalize_author, normalize_title
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "catalog.sqlite3")
+BATCH_SIZE = 10000
+MIN_TITLE_SCORE = 0.75
+MIN_AUTHOR_SCORE = 0.5
+# fuzzy lookups search for books sharing pairs of the query's rarest trigrams
+CANDIDATE_GRAMS = 4
+POSTINGS_LIMIT = 100
+CANDIDATES = 10
+
+_YEAR = re.compile(r"\b(1[0-9]{3}|20[0-9]{2})\b")
+_NUMBER = re.compile(r"\d+")
+
+_catalog = None
+_catalog_loaded = False
+_catalog_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    work_key TEXT UNIQUE,
+    title TEXT,
+    norm_title TEXT,
+    author_key TEXT,
+    author TEXT,
+    norm_author TEXT,
+    cover_id INTEGER,
+    isbn TEXT,
+    pages INTEGER,
+    year INTEGER
+);
+CREATE TABLE IF NOT EXISTS authors (key TEXT PRIMARY KEY, name TEXT) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS title_grams USING fts5 (norm_title, tokenize = 'trigram', detail = 'none');
+CREATE VIRTUAL TABLE IF NOT EXISTS title_gram_vocab USING fts5vocab (title_grams, 'row');
+CREATE TABLE IF NOT EXISTS gram_df (gram TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS books_norm ON books (norm_title, norm_author);
+"""
+
+def trigrams(text):
+    """Character trigrams of a normalized string, padded so short words count."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(a, b):
+    """Jaccard similarity of two trigram sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def _author_tokens(norm_author):
+    """Word order doesn't matter for names ("Christie, Agatha")."""
+    return " ".join(sorted(norm_author.split()))
+
+def cover_url_for(cover_id=None, isbn=None):
+    if cover_id:
+        return f"https://covers.openlibrary.org/b/id/{cover_id}-M.jpg"
+    if isbn:
+        return f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg"
+    return None
+
+def read_json_lines(path):
+    """
+    Yield the JSON objects in a dump file: one per line, either bare or as the
+    last tab-separated column. Lines that don't parse are skipped.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            payload = line.rsplit("\t", 1)[-1]
+            try:
+                record = json.loads(payload)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield record
+
+def _read_records(path):
+    """Yield (key, record) from an OpenLibrary dump."""
+    for record in read_json_lines(path):
+        if record.get("key"):
+            yield record["key"], record
+
+def _first_year(*values):
+    years = [int(m.group()) for value in values if value for m in [_YEAR.search(str(value))] if m]
+    return min(years) if years else None
+
+def _first_cover(record):
+    for cover_id in record.get("covers") or []:
+        if isinstance(cover_id, int) and cover_id > 0:
+            return cover_id
+    return None
+
+def _work_author_key(record):
+    for entry in record.get("authors") or []:
+        if isinstance(entry, dict):
+            author = entry.get("author", entry)
+            if isinstance(author, dict) and author.get("key"):
+                return author["key"]
+    return None
+
+def _row_to_match(row, score):
+    _, work_key, title, _, _, author, _, cover_id, isbn, pages, year = row
+    return {
+        "title": title,
+        "author": author,
+        "work_key": work_key,
+        "cover_id": cover_id,
+        "cover_url": cover_url_for(cover_id, isbn),
+        "isbn": isbn,
+        "pages": pages,
+        "year": year,
+        "score": round(score, 3),
+    }
+
+class BookCatalog:
+    """On-disk catalog of OpenLibrary works with exact and fuzzy lookup."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def ingest(self, path, progress=None):
+        """Stream one dump file into the catalog. Returns counts per record type."""
+        counts = {"authors": 0, "works": 0, "editions": 0, "skipped": 0}
+        batches = {"authors": [], "works": [], "editions": []}
+
+        for key, record in _read_records(path):
+            kind, row = None, None
+            if key.startswith("/authors/") and record.get("name"):
+                kind, row = "authors", (key, record["name"])
+            elif key.startswith("/works/") and record.get("title"):
+                title = record["title"]
+                kind, row = "works", (
+                    key, title, normalize_title(title), _work_author_key(record),
+                    _first_cover(record), _first_year(record.get("first_publish_date")),
+                )
+            elif key.startswith("/books/"):
+                works = record.get("works") or []
+                if works and isinstance(works[0], dict) and works[0].get("key"):
+                    isbn = (record.get("isbn_13") or record.get("isbn_10") or [None])[0]
+                    pages = record.get("number_of_pages")
+                    pages = pages if isinstance(pages, int) and pages > 0 else None
+                    year = _first_year(record.get("publish_date"))
+                    kind, row = "editions", (isbn, pages, _first_cover(record), year, year, works[0]["key"])
+            if kind is None:
+                # redirects, deleted records, editions without a work
+                counts["skipped"] += 1
+                continue
+            batches[kind].append(row)
+
+            for kind, rows in batches.items():
+                if len(rows) >= BATCH_SIZE:
+                    counts[kind] += self._write(kind, rows)
+                    batches[kind] = []
+                    if progress:
+                        progress(counts)
+
+        for kind, rows in batches.items():
+            if rows:
+                counts[kind] += self._write(kind, rows)
+        return counts
+
+    def _write(self, kind, rows):
+        with self._lock:
+            if kind == "authors":
+                self._db.executemany("INSERT OR REPLACE INTO authors (key, name) VALUES (?, ?)", rows)
+            elif kind == "works":
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO books (work_key, title, norm_title, author_key, cover_id, year) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            else:
+                # editions fill in what the work record lacks; the earliest year wins
+                self._db.executemany(
+                    "UPDATE books SET isbn = COALESCE(isbn, ?), pages = COALESCE(pages, ?), "
+                    "cover_id = COALESCE(cover_id, ?), "
+                    "year = CASE WHEN year IS NULL OR year > ? THEN COALESCE(?, year) ELSE year END "
+                    "WHERE work_key = ?",
+                    rows,
+                )
+            self._db.commit()
+        return len(rows)
+
+    def finalize(self):
+        """Resolve author names and (re)build the trigram index. Run after ingesting."""
+        with self._lock:
+            db = self._db
+            db.execute(
+                "UPDATE books SET author = (SELECT name FROM authors WHERE authors.key = books.author_key) "
+                "WHERE author IS NULL AND author_key IS NOT NULL"
+            )
+            # FTS5's trigram tokenizer builds the postings; rowid is the book id
+            db.execute("DELETE FROM title_grams")
+            last_id = 0
+            while True:
+                rows = db.execute(
+                    "SELECT id, norm_title, author FROM books WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, BATCH_SIZE),
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                db.executemany(
+                    "UPDATE books SET norm_author = ? WHERE id = ?",
+                    [(normalize_author(author or ""), book_id) for book_id, _, author in rows],
+                )
+                db.executemany(
+                    "INSERT INTO title_grams (rowid, norm_title) VALUES (?, ?)",
+                    [(book_id, norm_title) for book_id, norm_title, _ in rows],
+                )
+            # fts5vocab scans the whole index per query, so document counts are copied out once
+            db.execute("DELETE FROM gram_df")
+            db.execute("INSERT INTO gram_df (gram, df) SELECT term, doc FROM title_gram_vocab")
+            db.commit()
+
+    def lookup(self, title, author=""):
+        """
+        Best catalog match for title/author as a dict (title, author, work_key,
+        cover_id, cover_url, isbn, pages, year, score), or None.
+        """
+        norm_title, norm_author = normalize_title(title), normalize_author(author or "")
+        if not norm_title:
+            return None
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM books WHERE norm_title = ? ORDER BY cover_id IS NULL LIMIT 20", (norm_title,)
+            ).fetchall()
+            best = self._best_match(rows, norm_title, norm_author)
+            if best is None:
+                best = self._best_match(self._fuzzy_candidates(norm_title), norm_title, norm_author)
+        return best
+
+    def _fuzzy_candidates(self, norm_title):
+        # the FTS5 tokenizer doesn't pad, so these are the plain 3-character windows
+        grams = list({norm_title[i:i + 3] for i in range(len(norm_title) - 2)})
+        if not grams:
+            return []
+        placeholders = ",".join("?" * len(grams))
+        rare = [row[0] for row in self._db.execute(
+            f"SELECT gram FROM gram_df WHERE gram IN ({placeholders}) ORDER BY df LIMIT ?",
+            (*grams, CANDIDATE_GRAMS),
+        )]
+        if not rare:
+            return []
+        # pairs of rare trigrams have short intersections; OR-ing a few pairs
+        # means one typo can't lose the right book
+        phrases = ['"' + gram.replace('"', '""') + '"' for gram in rare]
+        query = " OR ".join(f"({a} AND {b})" for a, b in zip(phrases[::2], phrases[1::2])) or phrases[0]
+        matches = self._db.execute(
+            "SELECT books.id, books.norm_title FROM title_grams JOIN books ON books.id = title_grams.rowid "
+            "WHERE title_grams MATCH ? LIMIT ?",
+            (query, POSTINGS_LIMIT),
+        ).fetchall()
+        title_grams = trigrams(norm_title)
+        matches.sort(key=lambda row: similarity(title_grams, trigrams(row[1])), reverse=True)
+        ids = [book_id for book_id, _ in matches[:CANDIDATES]]
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        return self._db.execute(f"SELECT * FROM books WHERE id IN ({placeholders})", ids).fetchall()
+
+    def _best_match(self, rows, norm_title, norm_author):
+        title_grams = trigrams(norm_title)
+        author_grams = trigrams(_author_tokens(norm_author)) if norm_author else None
+        best, best_score = None, 0.0
+        for row in rows:
+            row_norm_title, row_norm_author = row[3], row[6]
+            # "Book 2" is not "Book 3", however similar the rest looks
+            if _NUMBER.findall(norm_title) != _NUMBER.findall(row_norm_title):
+                continue
+            score = similarity(title_grams, trigrams(row_norm_title))
+            if score < MIN_TITLE_SCORE:
+                continue
+            if author_grams is not None and row_norm_author:
+                # a known but different author rules a candidate out
+                author_score = similarity(author_grams, trigrams(_author_tokens(row_norm_author)))
+                if author_score < MIN_AUTHOR_SCORE:
+                    continue
+                score = 0.75 * score + 0.25 * author_score
+            if score > best_score:
+                best_score = score
+                best = _row_to_match(row, score)
+        return best
+
+    def by_work_key(self, work_key):
+        """The catalog entry for an OpenLibrary work key, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM books WHERE work_key = ?", (work_key,)).fetchone()
+        return _row_to_match(row, 1.0) if row else None
+
+    def stats(self):
+        with self._lock:
+            books = self._db.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+            with_covers = self._db.execute("SELECT COUNT(*) FROM books WHERE cover_id IS NOT NULL").fetchone()[0]
+        return {"books": books, "with_covers": with_covers}
+
+    def close(self):
+        self._db.close()
+
+def get_catalog():
+    """
+    Return the process-wide catalog, or None when no catalog has been built.
+    The location comes from NOVELQUEST_CATALOG, defaulting to .cache/catalog.sqlite3.
+    """
+    global _catalog, _catalog_loaded
+    with _catalog_lock:
+        if not _catalog_loaded:
+            path = os.getenv("NOVELQUEST_CATALOG", DEFAULT_DB_PATH)
+            _catalog = BookCatalog(path) if os.path.exists(path) else None
+            _catalog_loaded = True
+        return _catalog
+
+def set_catalog(catalog):
+    """Swap the process-wide catalog (None disables it)."""
+    global _catalog, _catalog_loaded
+    with _catalog_lock:
+        _catalog = catalog
+        _catalog_loaded = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local NovelQuest book catalog from OpenLibrary dumps.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    ingest = sub.add_parser("ingest", help="ingest dump files (authors, then works, then editions) and finalize")
+    ingest.add_argument("paths", nargs="+")
+    ingest.add_argument("--db", default=os.getenv("NOVELQUEST_CATALOG", DEFAULT_DB_PATH))
+    lookup = sub.add_parser("lookup", help="look up a title/author")
+    lookup.add_argument("title")
+    lookup.add_argument("author", nargs="?", default="")
+    lookup.add_argument("--db", default=os.getenv("NOVELQUEST_CATALOG", DEFAULT_DB_PATH))
+    args = parser.parse_args()
+
+    catalog = BookCatalog(args.db)
+    if args.command == "ingest":
+        for path in args.paths:
+            start = time.perf_counter()
+            counts = catalog.ingest(path, progress=lambda c: print(f"  {c}", end="\r"))
+            print(f"{path}: {counts} in {time.perf_counter() - start:.1f}s")
+        catalog.finalize()
+        print(f"Catalog ready: {catalog.stats()}")
+    else:
+        start = time.perf_counter()
+        match = catalog.lookup(args.title, args.author)
+        print(json.dumps(match, indent=2, ensure_ascii=False))
+        print(f"lookup took {(time.perf_counter() - start) * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
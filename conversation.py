@@ -0,0 +1,171 @@
+"""
+Conversation history for follow-up requests, bounded by a token budget.
+
+The latest exchanges go to the model verbatim. Older ones are compacted to
+what the user asked for plus the titles/authors that were recommended, and
+the oldest are dropped once even that no longer fits. Prompt size, and so
+per-turn latency, stays flat however long the conversation runs.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from book_parser import parse_book_fields, parse_book_json
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("NOVELQUEST_CONTEXT_TOKENS", 1500))
+# how long an idle session is kept in the shared backend
+SESSION_TTL = int(os.getenv("NOVELQUEST_SESSION_TTL", 7 * 24 * 3600))
+RECENT_TURNS = 1
+PREFERENCE_TOKEN_LIMIT = 80
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    """Word pieces and punctuation, a stand-in for the model tokenizer offline."""
+    return len(_TOKEN.findall(text))
+
+def truncate_to_tokens(text, limit):
+    """Cut text after roughly limit tokens, on a word boundary."""
+    pieces = list(_TOKEN.finditer(text))
+    if len(pieces) <= limit:
+        return text
+    return text[:pieces[limit - 1].end()].rstrip() + " …"
+
+def recommended_titles(response_text):
+    """(name, author) pairs from a model response, text or JSON."""
+    try:
+        if response_text.lstrip().startswith(("[", "{")):
+            books, _ = parse_book_json(response_text)
+        else:
+            books, _ = parse_book_fields(response_text)
+    except ValueError:
+        books = []
+    return [(book["name"], book["author"]) for book in books]
+
+class ConversationSession:
+    """
+    Role-based chat history for one user, kept in st.session_state. Follow-ups
+    send it as real user/model turns instead of one pasted transcript.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=RECENT_TURNS):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.turns = []
+        self.last_context_stats = None
+
+    @property
+    def history(self):
+        """The full, unbounded history as user/model turns."""
+        contents = []
+        for turn in self.turns:
+            contents.append({"role": "user", "parts": [turn["user"]]})
+            contents.append({"role": "model", "parts": [turn["model"]]})
+        return contents
+
+    def record_turn(self, user_prompt, response_text, books=None):
+        if books is not None:
+            titles = [(book["name"], book["author"]) for book in books]
+        else:
+            titles = recommended_titles(response_text)
+        self.turns.append({"user": user_prompt, "model": response_text, "titles": titles})
+
+    def contents_for(self, user_prompt):
+        """
+        The turns to send for a new user message, within the token budget.
+        last_context_stats records what went into it.
+        """
+        contents, self.last_context_stats = self.build_context(reserve=estimate_tokens(user_prompt))
+        return contents + [{"role": "user", "parts": [user_prompt]}]
+
+    def build_context(self, reserve=0):
+        """
+        History as user/model turns that fits in token_budget - reserve.
+        Returns (contents, stats) where stats counts verbatim, compacted and
+        dropped turns and the estimated context tokens.
+        """
+        budget = max(self.token_budget - reserve, 0)
+        kept = []
+        used = 0
+        stats = {"turns": len(self.turns), "verbatim": 0, "compacted": 0, "dropped": 0, "tokens": 0}
+
+        # newest first; once a turn doesn't fit, everything older is dropped too
+        for age, turn in enumerate(reversed(self.turns)):
+            options = [] if stats["dropped"] else [("compacted", *self._compact(turn))]
+            if age < self.recent_turns and not stats["dropped"]:
+                options.insert(0, ("verbatim", turn["user"], turn["model"]))
+            for kind, user_text, model_text in options:
+                cost = estimate_tokens(user_text) + estimate_tokens(model_text)
+                if used + cost <= budget:
+                    kept.append((user_text, model_text))
+                    used += cost
+                    stats[kind] += 1
+                    break
+            else:
+                stats["dropped"] += 1
+
+        stats["tokens"] = used
+        contents = []
+        for user_text, model_text in reversed(kept):
+            contents.append({"role": "user", "parts": [user_text]})
+            contents.append({"role": "model", "parts": [model_text]})
+        return contents, stats
+
+    def context_key(self):
+        """Text form of the bounded history, used in response cache keys."""
+        return json.dumps(self.build_context()[0], ensure_ascii=False)
+
+    def snapshot(self):
+        """A copy with the same turns, for background requests that mustn't touch last_context_stats."""
+        copy = ConversationSession(self.token_budget, self.recent_turns)
+        copy.turns = list(self.turns)
+        return copy
+
+    def to_dict(self):
+        return {"turns": self.turns, "last_context_stats": self.last_context_stats}
+
+    @classmethod
+    def from_dict(cls, data, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=RECENT_TURNS):
+        session = cls(token_budget, recent_turns)
+        session.turns = [dict(turn, titles=[tuple(title) for title in turn["titles"]]) for turn in data["turns"]]
+        session.last_context_stats = data.get("last_context_stats")
+        return session
+
+    def clear(self):
+        self.turns = []
+        self.last_context_stats = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def _compact(self, turn):
+        user_text = truncate_to_tokens(turn["user"], PREFERENCE_TOKEN_LIMIT)
+        if turn["titles"]:
+            model_text = "Recommended: " + "; ".join(f"{name} by {author}" for name, author in turn["titles"])
+        else:
+            model_text = truncate_to_tokens(turn["model"], PREFERENCE_TOKEN_LIMIT)
+        return user_text, model_text
+
+def hash_session_id(session_id):
+    """
+    Stand-in for a session id wherever it shows (scheduler queues, traces,
+    logs): whoever holds the id itself can open the conversation.
+    """
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:16]
+
+def save_session(backend, session_id, conversation, books, shared=False):
+    """
+    Store a user's conversation and current results, so any app worker can
+    pick them up. shared marks one the user chose to open by link.
+    """
+    backend.set_json(f"session:{session_id}",
+                     {"conversation": conversation.to_dict(), "books": books, "shared": shared}, ttl=SESSION_TTL)
+
+def load_session(backend, session_id, shared_only=False):
+    """(ConversationSession, books) saved for session_id, or None. shared_only skips unshared ones."""
+    data = backend.get_json(f"session:{session_id}")
+    if data is None or (shared_only and not data.get("shared")):
+        return None
+    return ConversationSession.from_dict(data["conversation"]), data["books"]
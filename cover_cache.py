@@ -0,0 +1,216 @@
+"""
+Cover URL cache that sits in front of the OpenLibrary search.
+
+Lookups go to an in-process LRU first, then to the shared backend when app
+workers share state (see shared_state.py), then to a SQLite file, so covers
+survive Streamlit restarts. "No cover found" is cached too, with a shorter TTL.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from shared_state import get_state_backend
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "covers.sqlite3")
+
+COVER_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+MAX_MEMORY_ENTRIES = 1000
+MAX_DISK_ENTRIES = 50000
+
+# returned by CoverCache.get when nothing (not even a "no cover") is cached
+MISSING = object()
+_cover_cache = None
+
+def _normalize_text(text):
+    text = text.lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def normalize_title(title):
+    """Lowercase a title and drop punctuation, series info and subtitles."""
+    title = re.sub(r"\(.*?\)|\[.*?\]", " ", title)
+    title = re.split(r":| - | — ", title)[0]
+    title = _normalize_text(title)
+    return re.sub(r"^(the|a|an) ", "", title)
+
+def normalize_author(author):
+    """Keep only the first listed author, lowercased and without punctuation."""
+    author = re.split(r",|&|;| and ", author)[0]
+    return _normalize_text(author)
+
+def make_cover_key(title, author):
+    """Cache key for a title/author pair, so small formatting changes still hit."""
+    return f"{normalize_title(title)}|{normalize_author(author)}"
+
+class CoverCache:
+    """LRU + TTL cache of cover URLs, optionally backed by a SQLite file."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, ttl=COVER_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_entries=MAX_MEMORY_ENTRIES, max_disk_entries=MAX_DISK_ENTRIES, backend=None,
+                 namespace="cover"):
+        self.ttl = ttl
+        self.backend = backend
+        # key prefix in the shared backend, so caches sharing one don't collide
+        self.namespace = namespace
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "negative_hits": 0,
+            "disk_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+        }
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            # cover lookups run in a thread pool, access is serialised by _lock
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS covers ("
+                "key TEXT PRIMARY KEY, url TEXT, expires_at REAL, last_used REAL)"
+            )
+            self._db.commit()
+
+    def get(self, title, author):
+        """
+        Return the cached cover URL, None for a cached "no cover", or
+        MISSING when the caller has to look it up.
+        """
+        key = make_cover_key(title, author)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                url, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._count_hit(url)
+                    return url
+                del self._entries[key]
+                self._counters["expired"] += 1
+
+        shared = self._get_shared(key, now)
+        with self._lock:
+            if shared is not None:
+                self._remember(key, *shared)
+                self._counters["shared_hits"] += 1
+                self._count_hit(shared[0])
+                return shared[0]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT url, expires_at FROM covers WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    self._db.execute("UPDATE covers SET last_used = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self._counters["disk_hits"] += 1
+                    self._count_hit(row[0])
+                    return row[0]
+                if row:
+                    self._counters["expired"] += 1
+
+            self._counters["misses"] += 1
+            return MISSING
+
+    def put(self, title, author, url):
+        """Store a lookup result. url=None records that the book has no cover."""
+        key = make_cover_key(title, author)
+        now = time.time()
+        expires_at = now + (self.ttl if url else self.negative_ttl)
+        if self.backend is not None:
+            try:
+                self.backend.set_json(f"{self.namespace}:{key}", {"url": url, "expires_at": expires_at},
+                                      ttl=expires_at - now)
+            except Exception as e:
+                print(f"Shared cover cache write failed: {e}")
+        with self._lock:
+            self._remember(key, url, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO covers (key, url, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                    (key, url, expires_at, now),
+                )
+                self._trim_disk(now)
+                self._db.commit()
+
+    def stats(self):
+        """Counters plus current sizes, for sizing the cache."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._entries)
+            if self._db is not None:
+                stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM covers").fetchone()[0]
+            lookups = stats["hits"] + stats["negative_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["hits"] + stats["negative_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM covers")
+                self._db.commit()
+
+    def _get_shared(self, key, now):
+        """(url, expires_at) from the shared backend, or None."""
+        if self.backend is None:
+            return None
+        try:
+            shared = self.backend.get_json(f"{self.namespace}:{key}")
+        except Exception as e:
+            print(f"Shared cover cache read failed: {e}")
+            return None
+        if shared is None or shared["expires_at"] <= now:
+            return None
+        return shared["url"], shared["expires_at"]
+
+    def _count_hit(self, url):
+        if url:
+            self._counters["hits"] += 1
+        else:
+            self._counters["negative_hits"] += 1
+
+    def _remember(self, key, url, expires_at):
+        self._entries[key] = (url, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _trim_disk(self, now):
+        self._db.execute("DELETE FROM covers WHERE expires_at <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM covers").fetchone()[0]
+        extra = count - self.max_disk_entries
+        if extra > 0:
+            self._db.execute(
+                "DELETE FROM covers WHERE key IN (SELECT key FROM covers ORDER BY last_used LIMIT ?)",
+                (extra,),
+            )
+            self._counters["disk_evictions"] += extra
+
+def get_cover_cache():
+    """Return the process-wide cover cache, creating it on first use."""
+    global _cover_cache
+    if _cover_cache is None:
+        _cover_cache = CoverCache(db_path=os.getenv("NOVELQUEST_COVER_CACHE", DEFAULT_DB_PATH),
+                                  backend=get_state_backend())
+    return _cover_cache
+
+def set_cover_cache(cache):
+    """Swap the process-wide cover cache, e.g. for an isolated one in tests."""
+    global _cover_cache
+    _cover_cache = cache
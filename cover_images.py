@@ -0,0 +1,341 @@
+"""
+Cover thumbnails, downloaded once and served from our own instance.
+
+Cards used to point browsers straight at covers.openlibrary.org, so every
+re-render made every browser fetch a medium JPEG from OpenLibrary. Now each
+resolved cover is downloaded once, cropped to the 150x225 card size and
+stored as WebP (or JPEG) under its content hash, with the least recently
+used files evicted past a size budget. Cards get the thumbnail as a data URI,
+or as a URL on a small server with year-long cache headers: the server runs
+on NOVELQUEST_COVER_PORT (localhost only, put a proxy in front of it) and
+cards link to it when NOVELQUEST_COVER_BASE_URL says where browsers reach
+it. Missing covers use the bundled placeholder.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.getenv("NOVELQUEST_THUMBNAIL_CACHE", os.path.join(HERE, ".cache", "thumbnails"))
+MAX_CACHE_BYTES = int(float(os.getenv("NOVELQUEST_THUMBNAIL_CACHE_MB", 200)) * 2 ** 20)
+THUMBNAIL_SIZE = (150, 225)
+THUMBNAIL_FORMAT = os.getenv("NOVELQUEST_THUMBNAIL_FORMAT", "webp").lower()
+THUMBNAIL_QUALITY = 80
+DOWNLOAD_TIMEOUT = 5
+DOWNLOAD_WORKERS = 4
+MAX_SOURCE_BYTES = 5 * 2 ** 20
+DOWNLOAD_CHUNK_BYTES = 64 * 2 ** 10
+# OpenLibrary answers unknown cover ids with a 1x1 image
+MIN_SOURCE_SIDE = 10
+# how long a card waits for a download still in flight before using the remote URL
+RENDER_WAIT = 2.0
+
+COVER_PORT = os.getenv("NOVELQUEST_COVER_PORT")
+COVER_BASE_URL = os.getenv("NOVELQUEST_COVER_BASE_URL")
+# a year: file names are content hashes, so a file never changes
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+PLACEHOLDER_PATH = os.path.join(HERE, "placeholder_cover.svg")
+MIME_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "svg": "image/svg+xml"}
+
+def _data_uri(data, ext):
+    return f"data:{MIME_TYPES[ext]};base64,{base64.b64encode(data).decode('ascii')}"
+
+with open(PLACEHOLDER_PATH, "rb") as _f:
+    PLACEHOLDER_COVER_URL = _data_uri(_f.read(), "svg")
+
+_thumbnail_cache = None
+_thumbnail_lock = threading.Lock()
+_cover_server = None
+
+def make_thumbnail(data, image_format=THUMBNAIL_FORMAT):
+    """
+    Crop and resize image bytes to THUMBNAIL_SIZE like the card's
+    object-fit: cover. Returns the encoded bytes, or None for images too
+    small to be a real cover.
+    """
+    # Pillow loads with the first thumbnail, not with the app
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        if min(image.size) < MIN_SOURCE_SIDE:
+            return None
+        image = ImageOps.fit(image.convert("RGB"), THUMBNAIL_SIZE, Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, format=image_format.upper(), quality=THUMBNAIL_QUALITY)
+    return out.getvalue()
+
+class ThumbnailCache:
+    """
+    Content-addressed thumbnail files plus a SQLite index of which source URL
+    produced which file. Total file size stays under max_bytes by evicting
+    the least recently used files.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=MAX_CACHE_BYTES, image_format=THUMBNAIL_FORMAT,
+                 base_url=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.image_format = image_format
+        # thumbnails are linked from here instead of inlined when set
+        self.base_url = base_url
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS sources (url TEXT PRIMARY KEY, digest TEXT);"
+            "CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, ext TEXT, size INTEGER, last_used REAL);"
+            "CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);"
+        )
+        self._db.commit()
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="thumbnail")
+        self._counters = {"hits": 0, "downloads": 0, "failures": 0, "missing": 0, "evictions": 0, "shared": 0}
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{ext}")
+
+    def lookup(self, url):
+        """(digest, ext) of the thumbnail made from url, or None. "" as digest means no usable image."""
+        with self._lock:
+            found = self._find(url)
+            if found is None:
+                return None
+            digest, ext = found
+            if digest:
+                self._db.execute("UPDATE files SET last_used = ? WHERE digest = ?", (time.time(), digest))
+                self._db.commit()
+            self._counters["hits"] += 1
+            return digest, ext
+
+    def _find(self, url):
+        row = self._db.execute(
+            "SELECT s.digest, f.ext FROM sources s LEFT JOIN files f ON f.digest = s.digest WHERE s.url = ?",
+            (url,),
+        ).fetchone()
+        if row is None or (row[0] and row[1] is None):
+            # never fetched, or the file was evicted and has to be fetched again
+            return None
+        return row
+
+    def read(self, digest):
+        """Thumbnail bytes and extension for a digest, or None if it isn't cached."""
+        with self._lock:
+            row = self._db.execute("SELECT ext FROM files WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self.path_for(digest, row[0]), "rb") as f:
+                return f.read(), row[0]
+        except FileNotFoundError:
+            return None
+
+    def store(self, url, thumbnail):
+        """Save a thumbnail made from url (None: url has no usable image). Returns (digest, ext)."""
+        if thumbnail is None:
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO sources (url, digest) VALUES (?, '')", (url,))
+                self._db.commit()
+                self._counters["missing"] += 1
+            return "", None
+        digest = hashlib.sha256(thumbnail).hexdigest()
+        ext = self.image_format
+        path = self.path_for(digest, ext)
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM files WHERE digest = ?", (digest,)).fetchone():
+                # another URL already gave us the same image
+                self._counters["shared"] += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(thumbnail)
+                os.replace(tmp_path, path)
+                self._db.execute(
+                    "INSERT INTO files (digest, ext, size, last_used) VALUES (?, ?, ?, ?)",
+                    (digest, ext, len(thumbnail), time.time()),
+                )
+            self._db.execute("INSERT OR REPLACE INTO sources (url, digest) VALUES (?, ?)", (url, digest))
+            self._evict()
+            self._db.commit()
+        return digest, ext
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        while total > self.max_bytes:
+            digest, ext, size = self._db.execute(
+                "SELECT digest, ext, size FROM files ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            self._db.execute("DELETE FROM files WHERE digest = ?", (digest,))
+            self._db.execute("DELETE FROM sources WHERE digest = ?", (digest,))
+            try:
+                os.remove(self.path_for(digest, ext))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._counters["evictions"] += 1
+
+    def prefetch(self, url, session=None):
+        """Start downloading url's thumbnail unless it's cached or already on its way. Returns a Future or None."""
+        if not url or url.startswith("data:"):
+            return None
+        with self._lock:
+            # not a lookup: only rendering a card counts as a hit
+            if self._find(url) is not None:
+                return None
+            future = self._pending.get(url)
+            if future is None:
+                future = self._pending[url] = self._executor.submit(self._download, url, session)
+        return future
+
+    def _download(self, url, session):
+        if session is None:
+            import requests as session
+        try:
+            with session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as resp:
+                if resp.status_code == 404:
+                    return self.store(url, None)
+                resp.raise_for_status()
+                data = _read_limited(resp, MAX_SOURCE_BYTES)
+            if data is None:
+                print(f"Cover at {url} is over {MAX_SOURCE_BYTES} bytes")
+                return self.store(url, None)
+            try:
+                thumbnail = make_thumbnail(data, self.image_format)
+            except (OSError, ValueError) as e:
+                print(f"Cover at {url} is not a usable image: {e}")
+                thumbnail = None
+            with self._lock:
+                self._counters["downloads"] += 1
+            return self.store(url, thumbnail)
+        except Exception as e:
+            # network trouble isn't remembered, the next render tries again
+            with self._lock:
+                self._counters["failures"] += 1
+            print(f"Could not download cover {url}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+
+    def src(self, url, session=None, wait=RENDER_WAIT):
+        """
+        What a card's <img src> should be for a cover URL: our thumbnail, the
+        placeholder when there is no usable image, or the original URL when
+        the download didn't finish within wait seconds.
+        """
+        if not url or url == PLACEHOLDER_COVER_URL:
+            return PLACEHOLDER_COVER_URL
+        if url.startswith("data:"):
+            return url
+        found = self.lookup(url)
+        if found is None:
+            future = self.prefetch(url, session)
+            try:
+                found = future.result(timeout=wait) if future is not None else self.lookup(url)
+            except Exception:
+                found = None
+            if found is None:
+                return url
+        digest, ext = found
+        if not digest:
+            return PLACEHOLDER_COVER_URL
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/covers/{digest}.{ext}"
+        data = self.read(digest)
+        if data is None:
+            return url
+        return _data_uri(*data)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["files"], stats["bytes"] = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()
+            stats["pending"] = len(self._pending)
+        return stats
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+def _read_limited(resp, limit):
+    """The whole body of a streamed response, or None once it goes past limit bytes."""
+    chunks = []
+    total = 0
+    for chunk in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+        total += len(chunk)
+        if total > limit:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def get_thumbnail_cache():
+    """Return the process-wide thumbnail cache, creating it on first use."""
+    global _thumbnail_cache
+    with _thumbnail_lock:
+        if _thumbnail_cache is None:
+            # localhost is the server's address, not the browser's: without a
+            # public base URL the cards inline the thumbnails
+            _thumbnail_cache = ThumbnailCache(base_url=COVER_BASE_URL)
+        return _thumbnail_cache
+
+def thumbnail_stats():
+    """Stats of the process-wide cache, {} until something used it."""
+    with _thumbnail_lock:
+        cache = _thumbnail_cache
+    return cache.stats() if cache is not None else {}
+
+def set_thumbnail_cache(cache):
+    """Swap the process-wide thumbnail cache, e.g. for one in a temporary directory in tests."""
+    global _thumbnail_cache
+    with _thumbnail_lock:
+        _thumbnail_cache = cache
+
+class _CoverHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        name = self.path.split("?")[0].rsplit("/", 1)[-1]
+        digest = name.split(".")[0]
+        found = get_thumbnail_cache().read(digest) if self.path.startswith("/covers/") and digest else None
+        if found is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data, ext = found
+        if self.headers.get("If-None-Match") == f'"{digest}"':
+            self.send_response(304)
+            self.send_header("Cache-Control", CACHE_CONTROL)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", MIME_TYPES[ext])
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", CACHE_CONTROL)
+        self.send_header("ETag", f'"{digest}"')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_cover_server(port=COVER_PORT, host="127.0.0.1"):
+    """
+    Serve /covers/<digest>.<ext> from the thumbnail cache on port, once per
+    process. Only local by default; pass host="0.0.0.0" to serve it directly.
+    """
+    global _cover_server
+    with _thumbnail_lock:
+        if _cover_server is not None or not port:
+            return _cover_server
+        _cover_server = ThreadingHTTPServer((host, int(port)), _CoverHandler)
+    threading.Thread(target=_cover_server.serve_forever, daemon=True, name="covers").start()
+    print(f"Serving cover thumbnails on port {_cover_server.server_port}")
+    return _cover_server
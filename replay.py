@@ -0,0 +1,516 @@
+"""
+Record/replay for Gemini and OpenLibrary, and offline fakes of both.
+
+Recording wraps the real Gemini model and OpenLibrary session and appends
+every exchange to JSON lines in a fixtures directory (gemini.jsonl,
+openlibrary.jsonl). Replaying serves those exchanges back with no network.
+FakeGemini and FakeOpenLibrary make up answers in the right format for
+anything else. Replayers and fakes take an UpstreamProfile with latency,
+throughput and error injection, so tests and benchmarks see realistic
+timing and failures.
+
+Record a fixture set (needs GEMINI_API_KEY and network):
+
+    python replay.py record prompts.jsonl fixtures/replay/mine
+
+prompts.jsonl uses the batch runner's input format (see batch.py).
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import book_filters
+import book_recommender
+import cover_cache
+
+GEMINI_FILE = "gemini.jsonl"
+OPENLIBRARY_FILE = "openlibrary.jsonl"
+# roughly how Gemini splits a streamed response
+STREAM_CHUNK_CHARS = 80
+CHARS_PER_TOKEN = 4
+
+class ReplayMiss(Exception):
+    """A request that isn't in the fixtures and has no fallback."""
+
+class UpstreamTimeout(Exception):
+    """The request's timeout passed before the first byte, like the SDK's DeadlineExceeded."""
+
+    def __init__(self, timeout):
+        super().__init__(f"Deadline of {timeout:g}s exceeded")
+        self.code = 504
+
+class UpstreamError(Exception):
+    """Injected failure. code makes the scheduler treat 429/5xx as retryable."""
+
+    def __init__(self, code):
+        super().__init__(f"{code} injected upstream error")
+        self.code = code
+
+class UpstreamProfile:
+    """
+    How a fake upstream behaves: latency before the first byte (plus up to
+    jitter more), output speed in tokens per second (None for instant), and
+    the share of requests that fail with error_status.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, tokens_per_second=None, error_rate=0.0, error_status=503, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def first_byte_delay(self):
+        with self._lock:
+            return self.latency + self.jitter * self._random.random()
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def output_delay(self, text):
+        if not self.tokens_per_second:
+            return 0.0
+        return len(text) / CHARS_PER_TOKEN / self.tokens_per_second
+
+NO_DELAY = UpstreamProfile()
+
+class FixtureStore:
+    """Recorded exchanges by request key, kept in one JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = entry["response"]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, request, response):
+        with self._lock:
+            self._entries[key] = response
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "request": request, "response": response}, ensure_ascii=False) + "\n")
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# --- Gemini ---
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+class _Chat:
+    """start_chat() stand-in: the history plus the new message, as one request."""
+
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, request_options=None):
+        return self.model.generate_content(self.history + [{"role": "user", "parts": [content]}], stream=stream,
+                                           request_options=request_options)
+
+class _Model:
+    """The parts of genai.GenerativeModel book_recommender uses; subclasses answer in _respond."""
+
+    def __init__(self, model_name, generation_config=None, system_instruction=None, profile=NO_DELAY):
+        self.model_name = model_name
+        self.generation_config = dict(generation_config or {})
+        self.system_instruction = system_instruction or ""
+        self.profile = profile
+
+    def request(self, contents):
+        return {
+            "model": self.model_name,
+            "generation_config": self.generation_config,
+            "system_instruction": self.system_instruction,
+            "contents": contents,
+        }
+
+    def start_chat(self, history=None):
+        return _Chat(self, history)
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        request = self.request(contents)
+        delay = self.profile.first_byte_delay()
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise UpstreamTimeout(timeout)
+        time.sleep(delay)
+        if self.profile.fails():
+            raise UpstreamError(self.profile.error_status)
+        chunks = self._respond(request, _digest(request))
+        if stream:
+            return self._stream(chunks)
+        text = "".join(chunks)
+        time.sleep(self.profile.output_delay(text))
+        return _Response(text)
+
+    def _stream(self, chunks):
+        for chunk in chunks:
+            time.sleep(self.profile.output_delay(chunk))
+            yield _Response(chunk)
+
+    def _respond(self, request, key):
+        raise NotImplementedError
+
+def _chunked(text):
+    return [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)] or [""]
+
+class _FakeModel(_Model):
+    def _respond(self, request, key):
+        return _chunked(fake_gemini_text(self.system_instruction, request["contents"]))
+
+class FakeGemini:
+    """Model factory whose models make up answers in the format their system instruction asks for."""
+
+    def __init__(self, profile=NO_DELAY):
+        self.profile = profile
+
+    def __call__(self, model_name, generation_config=None, system_instruction=None):
+        return _FakeModel(model_name, generation_config, system_instruction, self.profile)
+
+class _RecordingModel(_Model):
+    def __init__(self, real, recorder, *args):
+        super().__init__(*args)
+        self.real = real
+        self.recorder = recorder
+
+    def _respond(self, request, key):
+        contents = request["contents"]
+        chunks = [chunk.text for chunk in self.real.generate_content(contents, stream=True) if chunk.text]
+        self.recorder.store.put(key, request, {"chunks": chunks})
+        return chunks
+
+class GeminiRecorder:
+    """Model factory wrapping upstream (default: real Gemini) and recording every response."""
+
+    def __init__(self, fixtures_dir, upstream=None):
+        self.store = FixtureStore(os.path.join(fixtures_dir, GEMINI_FILE))
+        self.upstream = upstream
+
+    def __call__(self, model_name, generation_config=None, system_instruction=None):
+        upstream = self.upstream or book_recommender.load_genai().GenerativeModel
+        real = upstream(model_name=model_name, generation_config=generation_config,
+                        system_instruction=system_instruction)
+        return _RecordingModel(real, self, model_name, generation_config, system_instruction)
+
+class _ReplayModel(_Model):
+    def __init__(self, replayer, *args):
+        super().__init__(*args)
+        self.replayer = replayer
+
+    def _respond(self, request, key):
+        recorded = self.replayer.store.get(key)
+        if recorded is not None:
+            self.replayer.hits += 1
+            return recorded["chunks"]
+        self.replayer.misses += 1
+        if self.replayer.fallback is None:
+            raise ReplayMiss(f"No recorded Gemini response for {request['contents']!r:.200}")
+        return _chunked(fake_gemini_text(self.system_instruction, request["contents"]))
+
+class GeminiReplayer:
+    """
+    Model factory serving recorded responses. Unrecorded requests are made up
+    by FakeGemini when fallback is True, else raise ReplayMiss.
+    """
+
+    def __init__(self, fixtures_dir, profile=NO_DELAY, fallback=False):
+        self.store = FixtureStore(os.path.join(fixtures_dir, GEMINI_FILE))
+        self.profile = profile
+        self.fallback = FakeGemini(profile) if fallback else None
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, model_name, generation_config=None, system_instruction=None):
+        return _ReplayModel(self, model_name, generation_config, system_instruction, self.profile)
+
+_TITLE_NOUNS = ("Garden", "River", "Letters", "Winter", "Harbor", "Archive", "Lantern", "Orchard",
+                "Signal", "Crossing", "Island", "Library")
+_FIRST_NAMES = ("Maya", "Jonah", "Iris", "Tomas", "Leena", "Arjun", "Clara", "Felix", "Noor", "Owen")
+_LAST_NAMES = ("Hale", "Okafor", "Lindqvist", "Rao", "Moreau", "Sato", "Brennan", "Varga", "Quinn", "Adler")
+_CANDIDATE_LINE = re.compile(r"^\d+\.\s+(.+?) by (.+?) \(", re.MULTILINE)
+
+def _last_user_text(contents):
+    if isinstance(contents, str):
+        return contents
+    for turn in reversed(contents):
+        if isinstance(turn, dict) and turn.get("role") == "user":
+            return " ".join(str(part) for part in turn.get("parts", []))
+    return ""
+
+def fake_books(prompt, count):
+    """count made-up books for prompt, the same ones every time."""
+    seed = zlib.crc32(prompt.encode("utf-8"))
+    words = re.findall(r"[A-Za-z]{4,}", prompt) or ["Quiet"]
+    books = []
+    for i in range(count):
+        word = words[(seed + i) % len(words)].title()
+        name = f"The {word} {_TITLE_NOUNS[(seed + i) % len(_TITLE_NOUNS)]}"
+        if i >= len(_TITLE_NOUNS):
+            name += f" {i}"
+        first = _FIRST_NAMES[(seed // 7 + i) % len(_FIRST_NAMES)]
+        last = _LAST_NAMES[(seed // 11 + i) % len(_LAST_NAMES)]
+        # about as long as real answers: ~30 words of reasoning, ~80 of description
+        books.append({
+            "name": name,
+            "author": f"{first} {last}",
+            "genre": "Fiction, Mystery",
+            "price": f"₹{299 + (seed + i) % 7 * 50}",
+            "ai_reasoning": f"It matches what you asked for: {prompt[:60]}. "
+                            + "The pacing and characters suit that mood well. " * 3,
+            "description": f"{name} follows a {word.lower()} that changes a small town. "
+                           + "Secrets surface as the seasons turn and old friends return. " * 8,
+        })
+    return books
+
+def fake_gemini_text(system_instruction, contents):
+    """What a model with this system instruction would plausibly answer, in its format."""
+    prompt = _last_user_text(contents)
+    rerank = re.search(r"Pick the (\d+) candidates", system_instruction)
+    if rerank:
+        picks = _CANDIDATE_LINE.findall(prompt)[:int(rerank.group(1))]
+        return "\n\n".join(
+            f"Name: {name}\nAuthor: {author}\nPrice: ₹399\n"
+            f"ai_reasoning: {'It is one of the closest matches to the request in tone and subject. ' * 2}"
+            for name, author in picks
+        )
+    count = re.search(r"exactly (\d+) books", system_instruction)
+    books = fake_books(prompt, int(count.group(1)) if count else 5)
+    if "JSON array" in system_instruction:
+        return json.dumps(books, ensure_ascii=False)
+    return "\n\n".join(
+        f"Book {i}:\nName: {book['name']}\nAuthor: {book['author']}\nGenre: {book['genre']}\n"
+        f"Price: {book['price']}\nai_reasoning: {book['ai_reasoning']}\nAmazon Link:\n"
+        f"description: {book['description']}"
+        for i, book in enumerate(books, 1)
+    )
+
+# --- OpenLibrary ---
+
+def openlibrary_key(request):
+    """Method, path and sorted query: the same search on any host gets the same key."""
+    url = urllib.parse.urlsplit(request.url)
+    query = sorted(urllib.parse.parse_qsl(url.query))
+    return _digest([request.method, url.path, query])
+
+def fake_cover_image(request):
+    """A plain 180x270 JPEG whose colour depends on the cover URL."""
+    # Pillow loads with the first fake cover, not with replay
+    from PIL import Image
+    seed = zlib.crc32(request.url.encode("utf-8"))
+    image = Image.new("RGB", (180, 270), (seed & 0xFF, seed >> 8 & 0xFF, seed >> 16 & 0xFF))
+    out = io.BytesIO()
+    image.save(out, format="JPEG")
+    return out.getvalue()
+
+def fake_openlibrary_answer(request):
+    """(content type, body): a cover image for covers URLs, else a search.json answer."""
+    if urllib.parse.urlsplit(request.url).path.startswith("/b/"):
+        return "image/jpeg", fake_cover_image(request)
+    return "application/json", fake_openlibrary_body(request)
+
+def fake_openlibrary_body(request):
+    """A search.json answer with one made-up doc (cover, pages, year) for the title asked for."""
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.url).query))
+    title = query.get("title", "")
+    seed = zlib.crc32(f"{title}|{query.get('author', '')}".encode("utf-8"))
+    doc = {
+        "title": title,
+        "author_name": [query.get("author", "")],
+        "cover_i": 1000000 + seed % 9000000,
+        "number_of_pages_median": 150 + seed % 600,
+        "first_publish_year": 1950 + seed % 75,
+    }
+    return json.dumps({"numFound": 1, "docs": [doc]})
+
+def _make_response(request, status, body, content_type="application/json"):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body.encode("utf-8") if isinstance(body, str) else body
+    response._content_consumed = True
+    response.raw = io.BytesIO(response._content)
+    response.encoding = "utf-8"
+    response.headers["Content-Type"] = content_type
+    response.url = request.url
+    response.request = request
+    return response
+
+def _timeout_seconds(timeout):
+    if isinstance(timeout, tuple):
+        timeout = timeout[-1]
+    return timeout
+
+class _Adapter(HTTPAdapter):
+    """Sends every request through owner._send instead of the network (unless the owner records)."""
+
+    def __init__(self, owner):
+        super().__init__()
+        self.owner = owner
+
+    def send(self, request, **kwargs):
+        return self.owner._send(self, request, **kwargs)
+
+class _OpenLibraryUpstream:
+    def __init__(self, profile=NO_DELAY):
+        self.profile = profile
+
+    def session(self):
+        """A requests session whose http(s) calls go to this upstream."""
+        session = requests.Session()
+        adapter = _Adapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _send(self, adapter, request, timeout=None, **kwargs):
+        delay = self.profile.first_byte_delay()
+        timeout = _timeout_seconds(timeout)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise requests.exceptions.ReadTimeout(f"injected timeout after {timeout}s", request=request)
+        time.sleep(delay)
+        if self.profile.fails():
+            return _make_response(request, self.profile.error_status, json.dumps({"error": "injected"}))
+        return self._answer(adapter, request, timeout=timeout, **kwargs)
+
+    def _answer(self, adapter, request, **kwargs):
+        raise NotImplementedError
+
+class FakeOpenLibrary(_OpenLibraryUpstream):
+    """Answers every search with one made-up doc, and cover URLs with an image."""
+
+    def _answer(self, adapter, request, **kwargs):
+        content_type, body = fake_openlibrary_answer(request)
+        return _make_response(request, 200, body, content_type)
+
+def _recorded_body(response):
+    """JSON and other text as is, images as base64."""
+    content_type = response.headers.get("Content-Type", "")
+    recorded = {"status": response.status_code, "content_type": content_type}
+    if content_type.startswith("image/"):
+        recorded["body_base64"] = base64.b64encode(response.content).decode("ascii")
+    else:
+        recorded["body"] = response.text
+    return recorded
+
+class OpenLibraryRecorder:
+    """Session factory: real OpenLibrary calls, each response recorded."""
+
+    def __init__(self, fixtures_dir):
+        self.store = FixtureStore(os.path.join(fixtures_dir, OPENLIBRARY_FILE))
+
+    def session(self):
+        session = requests.Session()
+        adapter = _Adapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _send(self, adapter, request, **kwargs):
+        response = HTTPAdapter.send(adapter, request, **kwargs)
+        self.store.put(
+            openlibrary_key(request),
+            {"method": request.method, "url": request.url},
+            _recorded_body(response),
+        )
+        return response
+
+class OpenLibraryReplayer(_OpenLibraryUpstream):
+    """
+    Serves recorded OpenLibrary responses. Unrecorded requests get a
+    FakeOpenLibrary answer when fallback is True, else raise ReplayMiss.
+    """
+
+    def __init__(self, fixtures_dir, profile=NO_DELAY, fallback=False):
+        super().__init__(profile)
+        self.store = FixtureStore(os.path.join(fixtures_dir, OPENLIBRARY_FILE))
+        self.fallback = fallback
+        self.hits = 0
+        self.misses = 0
+
+    def _answer(self, adapter, request, **kwargs):
+        recorded = self.store.get(openlibrary_key(request))
+        if recorded is not None:
+            self.hits += 1
+            if "body_base64" in recorded:
+                body = base64.b64decode(recorded["body_base64"])
+            else:
+                body = recorded["body"]
+            return _make_response(request, recorded["status"], body,
+                                  recorded.get("content_type", "application/json"))
+        self.misses += 1
+        if not self.fallback:
+            raise ReplayMiss(f"No recorded OpenLibrary response for {request.url}")
+        content_type, body = fake_openlibrary_answer(request)
+        return _make_response(request, 200, body, content_type)
+
+def use_upstreams(gemini_factory, openlibrary):
+    """Point book_recommender at these (None, None restores the real services)."""
+    book_recommender.set_model_factory(gemini_factory)
+    book_recommender.set_http_session(openlibrary.session() if openlibrary is not None else None)
+
+def use_offline_upstreams(fixtures_dir=None, gemini_profile=NO_DELAY, openlibrary_profile=NO_DELAY):
+    """
+    No-network upstreams: recorded fixtures from fixtures_dir where there are
+    any, made-up answers for the rest. Returns (gemini, openlibrary).
+    """
+    if fixtures_dir:
+        gemini = GeminiReplayer(fixtures_dir, gemini_profile, fallback=True)
+        openlibrary = OpenLibraryReplayer(fixtures_dir, openlibrary_profile, fallback=True)
+    else:
+        gemini, openlibrary = FakeGemini(gemini_profile), FakeOpenLibrary(openlibrary_profile)
+    use_upstreams(gemini, openlibrary)
+    return gemini, openlibrary
+
+def main():
+    parser = argparse.ArgumentParser(description="Record Gemini and OpenLibrary fixtures for offline replay.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record = subparsers.add_parser("record", help="run prompts against the real services and record them")
+    record.add_argument("prompts", help="JSONL prompts in the batch runner's format")
+    record.add_argument("fixtures_dir")
+    record.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"))
+    args = parser.parse_args()
+    if not args.api_key:
+        parser.error("set GEMINI_API_KEY or pass --api-key")
+
+    import batch
+    # nothing may be answered from local caches, or replay would miss it later
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    book_filters.set_metadata_cache(book_filters.MetadataCache(db_path=None))
+    use_upstreams(GeminiRecorder(args.fixtures_dir), OpenLibraryRecorder(args.fixtures_dir))
+    batch.run_batch(args.prompts, os.path.join(args.fixtures_dir, "results.jsonl"), args.api_key, use_cache=False)
+
+if __name__ == "__main__":
+    main()
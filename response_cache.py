@@ -0,0 +1,144 @@
+"""
+Cache of finished recommendation results.
+
+An entry holds the raw model text together with the parsed book list (covers
+already resolved), so a hit skips the Gemini call, the regex extraction and
+the cover lookups. With a shared backend (see shared_state.py) entries are
+also written there, so a result generated by one app worker is a hit in
+all of them.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from shared_state import get_state_backend
+
+RESPONSE_TTL = int(os.getenv("NOVELQUEST_RESPONSE_CACHE_TTL", 6 * 3600))
+MAX_RESPONSES = int(os.getenv("NOVELQUEST_RESPONSE_CACHE_SIZE", 256))
+
+_response_cache = None
+
+def canonical_prompt(prompt):
+    """Collapse case, whitespace and trailing punctuation so near-identical prompts match."""
+    prompt = " ".join(prompt.lower().split())
+    prompt = re.sub(r"\s+([.,!?;:])", r"\1", prompt)
+    return prompt.rstrip(" .!?")
+
+def make_response_key(prompt, num_results, model_name, generation_config, context=None, filters=None):
+    """Hash everything that can change what the model returns (or which books are kept)."""
+    payload = {
+        "prompt": canonical_prompt(prompt),
+        "num_results": num_results,
+        "model": model_name,
+        "config": generation_config,
+        "context": canonical_prompt(context) if context else None,
+        "filters": filters,
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    In-process LRU + TTL cache of (response_text, books) pairs, in front of
+    an optional shared backend.
+    """
+
+    def __init__(self, ttl=RESPONSE_TTL, max_entries=MAX_RESPONSES, backend=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "shared_hits": 0, "misses": 0, "expired": 0, "evictions": 0, "bypassed": 0}
+
+    def get(self, key):
+        """Return (response_text, books) for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= now:
+                del self._entries[key]
+                self._counters["expired"] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+        if entry is None:
+            entry = self._get_shared(key, now)
+            with self._lock:
+                if entry is None:
+                    self._counters["misses"] += 1
+                    return None
+                self._remember(key, entry)
+                self._counters["hits"] += 1
+                self._counters["shared_hits"] += 1
+        response_text, books, _ = entry
+        # callers are free to edit the dicts they get back
+        return response_text, copy.deepcopy(books)
+
+    def put(self, key, response_text, books):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, (response_text, copy.deepcopy(books), expires_at))
+        if self.backend is not None:
+            try:
+                self.backend.set_json(f"response:{key}", {"response_text": response_text, "books": books,
+                                                          "expires_at": expires_at}, ttl=self.ttl)
+            except Exception as e:
+                print(f"Shared response cache write failed: {e}")
+
+    def _get_shared(self, key, now):
+        if self.backend is None:
+            return None
+        try:
+            shared = self.backend.get_json(f"response:{key}")
+        except Exception as e:
+            print(f"Shared response cache read failed: {e}")
+            return None
+        if shared is None or shared["expires_at"] <= now:
+            return None
+        return shared["response_text"], shared["books"], shared["expires_at"]
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self._counters["bypassed"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Empty this worker's entries (shared ones expire on their own)."""
+        with self._lock:
+            self._entries.clear()
+
+def get_response_cache():
+    """Return the process-wide response cache, creating it on first use."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(backend=get_state_backend())
+    return _response_cache
+
+def set_response_cache(cache):
+    """Swap the process-wide response cache, e.g. for an isolated one in tests."""
+    global _response_cache
+    _response_cache = cache
@@ -0,0 +1,359 @@
+"""
+Semantic retrieval over a local book corpus.
+
+Every book's title, genres and description become a hashed TF-IDF vector
+(no model to download, works on any CPU). The vectors live in a memory-mapped
+float32 matrix next to a uint32 genre bitmask per book, so a query is one
+vectorized cosine pass over the rows whose genres match. The LLM then only
+re-ranks the retrieved candidates and writes ai_reasoning for them.
+
+Build an index from JSON lines ({"name", "author", "genre", "description"})
+or OpenLibrary works dump files:
+
+    python retrieval.py build corpus.jsonl --out .cache/retrieval
+    python retrieval.py search "books like The Silent Patient" --genre Thriller
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+
+from catalog import get_catalog, read_json_lines
+from cover_cache import normalize_title
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "retrieval")
+DIMENSIONS = 512
+# float32 so scoring is a straight BLAS mat-vec on the mapped pages; converting
+# float16 rows on the fly was ~10x slower than the product itself
+VECTOR_DTYPE = "float32"
+# rows scored per step, which bounds the temporary arrays
+CHUNK_ROWS = 65536
+BUILD_BATCH = 10000
+INDEX_VERSION = 1
+
+# numpy, imported by the first index build or load rather than with the
+# module: the app imports this module for GENRES on every cold start
+np = None
+
+GENRES = (
+    "Fiction", "Non-Fiction", "Fantasy", "Science Fiction", "Mystery",
+    "Romance", "Thriller", "Historical Fiction", "Biography",
+    "Young Adult", "Horror", "Adventure", "Classics", "Literary Fiction",
+    "Poetry", "Self-Help", "Psychological Thriller", "Suspense", "Comedy",
+    "Drama", "Satire", "Memoir", "Crime", "Action", "Philosophy",
+)
+GENRE_ALIASES = {
+    "Non-Fiction": ("nonfiction",),
+    "Science Fiction": ("sci-fi", "scifi"),
+    "Mystery": ("detective",),
+    "Young Adult": ("ya", "juvenile fiction", "teen"),
+    "Comedy": ("humor", "humour"),
+    "Classics": ("classic literature",),
+    "Biography": ("autobiography",),
+}
+# a genre name matches as a whole word, and "fiction" doesn't match "non-fiction"
+_GENRE_PATTERNS = [
+    re.compile("|".join(
+        r"(?<![\w-])" + re.escape(name) + r"s?\b" for name in (genre.lower(),) + GENRE_ALIASES.get(genre, ())
+    ))
+    for genre in GENRES
+]
+
+STOPWORDS = frozenset(
+    "a an and are as at be book books but by for from has have he her his i in is it its like me "
+    "novel of on or she so that the their them they this to was were with who you your".split()
+)
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+def genre_mask(genres):
+    """Bitmask of the GENRES named (case-insensitive); unknown names are ignored."""
+    mask = 0
+    wanted = {genre.lower() for genre in genres or ()}
+    for bit, genre in enumerate(GENRES):
+        if genre.lower() in wanted:
+            mask |= 1 << bit
+    return mask
+
+def genre_mask_for_text(text):
+    """Bitmask of the GENRES mentioned in free text such as OpenLibrary subjects."""
+    text = text.lower()
+    mask = 0
+    for bit, pattern in enumerate(_GENRE_PATTERNS):
+        if pattern.search(text):
+            mask |= 1 << bit
+    return mask
+
+def tokenize(text):
+    """Words without stopwords, plus adjacent-word bigrams."""
+    words = [word for word in _WORD.findall(text.lower()) if word not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def hashed_counts(text):
+    """{bucket: signed sublinear term frequency} for the hashing trick."""
+    counts = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    buckets = {}
+    for token, count in counts.items():
+        h = zlib.crc32(token.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        bucket = h % DIMENSIONS
+        buckets[bucket] = buckets.get(bucket, 0.0) + sign * (1.0 + math.log(count))
+    return buckets
+
+def book_text(book):
+    # the title counts twice so "books like <title>" lands on the book's neighbourhood
+    return f"{book['name']} {book['name']} {book.get('genre', '')} {book.get('description', '')}"
+
+def normalize_record(record, catalog=None):
+    """
+    A corpus book dict (name, author, genre, description, plus work_key/pages/
+    year when known) from a JSON line, or None when there's nothing to index.
+    """
+    name = record.get("name") or record.get("title")
+    if not isinstance(name, str) or not name.strip():
+        return None
+    description = record.get("description") or ""
+    if isinstance(description, dict):
+        description = description.get("value", "")
+    genre = record.get("genre") or record.get("genres") or record.get("subjects") or ""
+    if isinstance(genre, list):
+        genre = ", ".join(str(g) for g in genre[:10])
+    if not isinstance(description, str) or not isinstance(genre, str) or not (description.strip() or genre.strip()):
+        return None
+
+    book = {"name": name.strip(), "author": record.get("author") or "", "genre": genre.strip(),
+            "description": description.strip()}
+    key = record.get("key") or record.get("work_key")
+    if isinstance(key, str) and key.startswith("/works/"):
+        book["work_key"] = key
+        match = catalog.by_work_key(key) if catalog is not None else None
+        if match:
+            book["author"] = book["author"] or match["author"] or ""
+            book["pages"], book["year"] = match["pages"], match["year"]
+    if not isinstance(book["author"], str):
+        book["author"] = ""
+    return book
+
+def build_index(paths, out_dir=DEFAULT_INDEX_DIR, catalog=None, progress=None):
+    """
+    Build an index from corpus files in two streaming passes: the first
+    writes the normalized books and counts document frequencies, the second
+    writes the vectors. Returns the number of books indexed.
+    """
+    _load_numpy()
+    os.makedirs(out_dir, exist_ok=True)
+    books_path = os.path.join(out_dir, "books.jsonl")
+    doc_freq = np.zeros(DIMENSIONS, dtype=np.int64)
+    count = 0
+    with open(books_path, "wb") as books_file, \
+            open(os.path.join(out_dir, "offsets.u64"), "wb") as offsets_file, \
+            open(os.path.join(out_dir, "genres.u32"), "wb") as genres_file:
+        offsets, masks = [], []
+        for path in paths:
+            for record in read_json_lines(path):
+                book = normalize_record(record, catalog)
+                if book is None:
+                    continue
+                offsets.append(books_file.tell())
+                books_file.write((json.dumps(book, ensure_ascii=False) + "\n").encode("utf-8"))
+                masks.append(genre_mask_for_text(book["genre"]))
+                doc_freq[list(hashed_counts(book_text(book)))] += 1
+                count += 1
+                if len(offsets) >= BUILD_BATCH:
+                    offsets_file.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+                    genres_file.write(np.asarray(masks, dtype=np.uint32).tobytes())
+                    offsets, masks = [], []
+                    if progress:
+                        progress(count)
+        offsets_file.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+        genres_file.write(np.asarray(masks, dtype=np.uint32).tobytes())
+
+    idf = (np.log((1 + count) / (1 + doc_freq)) + 1).astype(np.float32)
+    np.save(os.path.join(out_dir, "idf.npy"), idf)
+    if not count:
+        raise ValueError("No indexable books (name plus description or genres) in the corpus")
+    vectors = np.lib.format.open_memmap(
+        os.path.join(out_dir, "vectors.npy"), mode="w+", dtype=VECTOR_DTYPE, shape=(count, DIMENSIONS)
+    )
+    with open(books_path, encoding="utf-8") as books_file:
+        row = 0
+        batch = np.zeros((BUILD_BATCH, DIMENSIONS), dtype=np.float32)
+        for line in books_file:
+            for bucket, weight in hashed_counts(book_text(json.loads(line))).items():
+                batch[row % BUILD_BATCH, bucket] = weight
+            row += 1
+            if row % BUILD_BATCH == 0 or row == count:
+                size = (row - 1) % BUILD_BATCH + 1
+                vectors[row - size:row] = _normalize_rows(batch[:size] * idf)
+                batch[:] = 0
+    vectors.flush()
+    del vectors
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "count": count, "dimensions": DIMENSIONS,
+                   "genres": list(GENRES)}, f)
+    return count
+
+def _load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+class RetrievalIndex:
+    """Read-only view of a built index; the big arrays stay memory-mapped."""
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        _load_numpy()
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != INDEX_VERSION or meta["dimensions"] != DIMENSIONS or meta["genres"] != list(GENRES):
+            raise ValueError(f"Retrieval index in {index_dir} was built with other settings, rebuild it")
+        self.count = meta["count"]
+        self.idf = np.load(os.path.join(index_dir, "idf.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+        self.genres = np.memmap(os.path.join(index_dir, "genres.u32"), dtype=np.uint32, mode="r", shape=(self.count,))
+        self.offsets = np.memmap(os.path.join(index_dir, "offsets.u64"), dtype=np.uint64, mode="r",
+                                 shape=(self.count,))
+        self._books_file = open(os.path.join(index_dir, "books.jsonl"), "rb")
+        self._lock = threading.Lock()
+
+    def vectorize(self, text):
+        vector = np.zeros(DIMENSIONS, dtype=np.float32)
+        for bucket, weight in hashed_counts(text).items():
+            vector[bucket] = weight
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def book(self, row):
+        with self._lock:
+            self._books_file.seek(int(self.offsets[row]))
+            return json.loads(self._books_file.readline())
+
+    def top_k(self, query_vector, k=10, genres=None, exclude=()):
+        """[(row, score)] of the k rows closest to query_vector, best first."""
+        mask = genre_mask(genres)
+        best_rows, best_scores = [], []
+        for start in range(0, self.count, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, self.count)
+            if mask:
+                # genre pre-filter: only rows sharing a bit with the mask are scored
+                rows = np.flatnonzero(self.genres[start:stop] & mask)
+                if not len(rows):
+                    continue
+                scores = self.vectors[start + rows] @ query_vector
+                rows = rows + start
+            else:
+                scores = self.vectors[start:stop] @ query_vector
+                rows = np.arange(start, stop)
+            if len(scores) > k + len(exclude):
+                keep = np.argpartition(-scores, k + len(exclude))[:k + len(exclude)]
+                rows, scores = rows[keep], scores[keep]
+            best_rows.append(rows)
+            best_scores.append(scores)
+        if not best_rows:
+            return []
+        rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        order = np.argsort(-scores)
+        results = [(int(rows[i]), float(scores[i])) for i in order if int(rows[i]) not in exclude]
+        return results[:k]
+
+    def search(self, query, k=10, genres=None):
+        """
+        Top k corpus books for a free-text query, as book dicts with a
+        "similarity" field. A corpus book named in the query ("books like
+        <title>") is used as the example instead of being returned.
+        """
+        query_vector = self.vectorize(query)
+        if not query_vector.any():
+            return []
+        results = self.top_k(query_vector, k + 3, genres)
+        norm_query = f" {normalize_title(query)} "
+        named = []
+        for row, _ in results[:3]:
+            title = normalize_title(self.book(row)["name"])
+            if len(title) > 3 and f" {title} " in norm_query:
+                named.append(row)
+        if named:
+            # the example's own vector finds its neighbours better than the title words do
+            example = self.vectors[named].sum(axis=0)
+            results = self.top_k(example / np.linalg.norm(example), k, genres, exclude=set(named))
+        books = []
+        for row, score in results[:k]:
+            book = self.book(row)
+            book["similarity"] = round(score, 4)
+            books.append(book)
+        return books
+
+    def close(self):
+        self._books_file.close()
+
+def get_retrieval_index():
+    """
+    Return the process-wide index, or None when none has been built. The
+    location comes from NOVELQUEST_RETRIEVAL_INDEX, default .cache/retrieval.
+    """
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            index_dir = os.getenv("NOVELQUEST_RETRIEVAL_INDEX", DEFAULT_INDEX_DIR)
+            try:
+                _index = RetrievalIndex(index_dir) if os.path.exists(os.path.join(index_dir, "meta.json")) else None
+            except Exception as e:
+                print(f"Retrieval index not loaded: {e}")
+                _index = None
+            _index_loaded = True
+        return _index
+
+def set_retrieval_index(index):
+    """Swap the process-wide index (None disables retrieval)."""
+    global _index, _index_loaded
+    with _index_lock:
+        _index = index
+        _index_loaded = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the NovelQuest retrieval index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="index JSON lines or OpenLibrary works dumps")
+    build.add_argument("paths", nargs="+")
+    build.add_argument("--out", default=os.getenv("NOVELQUEST_RETRIEVAL_INDEX", DEFAULT_INDEX_DIR))
+    search = sub.add_parser("search", help="run a query against the index")
+    search.add_argument("query")
+    search.add_argument("--genre", action="append")
+    search.add_argument("-k", type=int, default=10)
+    search.add_argument("--out", default=os.getenv("NOVELQUEST_RETRIEVAL_INDEX", DEFAULT_INDEX_DIR))
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        count = build_index(args.paths, args.out, catalog=get_catalog(), progress=lambda n: print(f"  {n}", end="\r"))
+        print(f"Indexed {count} books in {time.perf_counter() - start:.1f}s")
+    else:
+        index = RetrievalIndex(args.out)
+        start = time.perf_counter()
+        books = index.search(args.query, k=args.k, genres=args.genre)
+        elapsed = time.perf_counter() - start
+        for book in books:
+            print(f"{book['similarity']:.3f}  {book['name']} by {book['author']}  [{book['genre'][:60]}]")
+        print(f"{elapsed * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Model routing for Gemini generations: deadlines, hedged requests and
+step-down under load.
+
+Every generation goes to the primary model, the first one in
+NOVELQUEST_MODELS. If it hasn't produced output after the hedge delay (the
+HEDGE_PERCENTILE latency seen for that model, or a fixed default until
+there are enough samples), a second request goes to the hedge model: the
+second one listed, usually a cheaper/faster one such as
+gemini-2.0-flash-lite, else the primary again. Whichever produces output
+first is used and the other is cancelled. Hedges are capped at
+MAX_HEDGE_RATE of requests and only sent when the rate limiter has a token
+to spare, so they never queue in front of real requests.
+
+A request with no output after REQUEST_DEADLINE seconds fails with
+DeadlineExceeded instead of leaving the user waiting. Each attempt is
+also given the time left as its own timeout, so the upstream call itself
+stops then and a hung call can't hold on to a worker. When the scheduler
+queue backs up, searches ask for fewer books and shorter answers
+(step_down) so the queue drains faster.
+
+Latencies per model and kind (a full response, the first chunk of a stream,
+a re-rank) are kept in a rolling window, for the hedge delays and stats().
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scheduler import get_scheduler
+from telemetry import get_telemetry
+
+MODELS = [name.strip() for name in os.getenv("NOVELQUEST_MODELS", "gemini-2.0-flash").split(",") if name.strip()]
+REQUEST_DEADLINE = float(os.getenv("NOVELQUEST_REQUEST_DEADLINE", 60))
+HEDGING = os.getenv("NOVELQUEST_HEDGING", "1") == "1"
+HEDGE_PERCENTILE = 0.9
+# samples per model and kind before the percentile replaces the default delay
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAYS = {"response": 15.0, "first_token": 5.0, "rerank": 8.0}
+# hedging on noise just doubles the traffic
+MIN_HEDGE_DELAY = 1.0
+MAX_HEDGE_RATE = 0.1
+LATENCY_WINDOW = 500
+# queued generations at which searches step down (0 never steps down)
+STEP_DOWN_QUEUE_DEPTH = int(os.getenv("NOVELQUEST_STEP_DOWN_QUEUE_DEPTH", 4))
+STEP_DOWN_RESULTS = 3
+STEP_DOWN_MAX_OUTPUT_TOKENS = 1024
+WORKERS = 8
+
+_router = None
+_router_lock = threading.Lock()
+_DONE = object()
+
+class DeadlineExceeded(Exception):
+    """No model produced output before the request deadline."""
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+class LatencyTracker:
+    """The last window latencies (seconds) per (model, kind)."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, model, kind, seconds):
+        with self._lock:
+            self._samples.setdefault((model, kind), deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model, kind, fraction, min_samples=1):
+        """The fraction percentile, or None with fewer than min_samples samples."""
+        with self._lock:
+            samples = list(self._samples.get((model, kind), ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return percentile(samples, fraction)
+
+    def report(self):
+        """{model: {kind: {count, p50_ms, p90_ms, p99_ms, max_ms}}}"""
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+        report = {}
+        for (model, kind), values in sorted(samples.items()):
+            report.setdefault(model, {})[kind] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p90_ms": percentile(values, 0.9) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+        return report
+
+class _Attempt:
+    def __init__(self, model, hedge, cleanup):
+        self.model = model
+        self.hedge = hedge
+        self.cleanup = cleanup
+        self.future = None
+
+    def discard(self, future):
+        """Done callback of a cancelled attempt: let go of what it produced."""
+        if self.cleanup is not None and not future.cancelled() and future.exception() is None:
+            self.cleanup(future.result())
+
+class ModelRouter:
+    """
+    Runs generation attempts on the configured models with a deadline and
+    hedging. load() returns the scheduler's queue depth and spare_token()
+    takes a rate limit token without waiting; both default to the
+    process-wide scheduler.
+    """
+
+    def __init__(self, models=None, deadline=REQUEST_DEADLINE, hedging=HEDGING, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, default_hedge_delays=None, min_hedge_delay=MIN_HEDGE_DELAY,
+                 max_hedge_rate=MAX_HEDGE_RATE, step_down_queue_depth=STEP_DOWN_QUEUE_DEPTH, load=None,
+                 spare_token=None):
+        self.models = list(models or MODELS)
+        self.primary = self.models[0]
+        self.hedge_model = self.models[1] if len(self.models) > 1 else self.primary
+        self.deadline = deadline
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.default_hedge_delays = dict(default_hedge_delays or DEFAULT_HEDGE_DELAYS)
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_rate = max_hedge_rate
+        self.step_down_queue_depth = step_down_queue_depth
+        self.load = load or (lambda: get_scheduler().metrics()["queue_depth"])
+        self.spare_token = spare_token or (lambda: get_scheduler().try_acquire())
+        self.latency = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="model")
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "hedged": 0,
+            # hedges that answered first
+            "hedge_wins": 0,
+            # hedges due but not sent: over MAX_HEDGE_RATE or no spare token
+            "hedges_skipped": 0,
+            "cancelled": 0,
+            "deadline_exceeded": 0,
+            "step_downs": 0,
+        }
+
+    def hedge_delay(self, model, kind):
+        """Seconds without output after which a request is hedged."""
+        delay = self.latency.percentile(model, kind, self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            delay = self.default_hedge_delays.get(kind, max(self.default_hedge_delays.values()))
+        return max(delay, self.min_hedge_delay)
+
+    def step_down(self, num_results):
+        """(num_results, max_output_tokens) to ask for now; max_output_tokens is None for the default."""
+        if not self.step_down_queue_depth or self.load() < self.step_down_queue_depth:
+            return num_results, None
+        if num_results <= STEP_DOWN_RESULTS:
+            return num_results, None
+        self._record("step_downs")
+        get_telemetry().increment("step_downs")
+        print(f"Busy, asking for {STEP_DOWN_RESULTS} books instead of {num_results}")
+        return STEP_DOWN_RESULTS, STEP_DOWN_MAX_OUTPUT_TOKENS
+
+    def generate(self, attempt, kind="response"):
+        """
+        attempt(model_name, timeout) -> result, on the primary model and
+        hedged if it is slow. timeout is the seconds left before the
+        deadline, for the upstream call. Returns the first result. When every attempt failed the
+        first error is raised, when none finished in time DeadlineExceeded.
+        """
+        return self._race(attempt, kind)
+
+    def stream(self, attempt, kind="first_token"):
+        """
+        Streaming version of generate: attempt(model_name, timeout) returns
+        an iterator, and the race is to its first item. Yields the winner's
+        items; the loser's iterator is closed. The router's deadline covers
+        the wait for the first item, the timeout the whole upstream stream.
+        """
+        def first_item(model, timeout):
+            items = iter(attempt(model, timeout))
+            return items, next(items, _DONE)
+
+        items, first = self._race(first_item, kind, cleanup=_close_items)
+        try:
+            if first is not _DONE:
+                yield first
+            yield from items
+        finally:
+            _close_items((items, first))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+        stats["hedge_win_rate"] = stats["hedge_wins"] / stats["hedged"] if stats["hedged"] else 0.0
+        return stats
+
+    def _race(self, run, kind, cleanup=None):
+        telemetry = get_telemetry()
+        start = time.perf_counter()
+        self._record("requests")
+        deadline = start + self.deadline
+        live = [self._submit(run, self.primary, kind, False, cleanup, deadline)]
+        hedge_at = start + self.hedge_delay(self.primary, kind)
+        hedge_due = self.hedging and hedge_at < deadline
+        errors = []
+        while True:
+            for attempt in [a for a in live if a.future.done()]:
+                live.remove(attempt)
+                try:
+                    result = attempt.future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                self._cancel(live)
+                if attempt.hedge:
+                    self._record("hedge_wins")
+                telemetry.increment("model_answers", model=attempt.model, hedge=attempt.hedge)
+                return result
+            now = time.perf_counter()
+            # failures are left to the scheduler's retries, only slowness is hedged
+            if not live and now < deadline:
+                raise errors[0]
+            if now >= deadline:
+                self._cancel(live)
+                self._record("deadline_exceeded")
+                telemetry.increment("deadline_exceeded", kind=kind)
+                # not chained to an upstream timeout, which the scheduler would retry
+                raise DeadlineExceeded(f"No model answered before the request deadline ({kind})") from None
+            if hedge_due and now >= hedge_at:
+                hedge_due = False
+                if self._may_hedge():
+                    print(f"No output from {self.primary} after {now - start:.1f}s, hedging on {self.hedge_model}")
+                    live.append(self._submit(run, self.hedge_model, kind, True, cleanup, deadline))
+            wait([a.future for a in live], timeout=max((hedge_at if hedge_due else deadline) - now, 0),
+                 return_when=FIRST_COMPLETED)
+
+    def _may_hedge(self):
+        with self._lock:
+            # the first hedge is always allowed, then at most max_hedge_rate of requests
+            over_budget = self._stats["hedged"] >= max(1, self.max_hedge_rate * self._stats["requests"])
+        if over_budget or not self.spare_token():
+            self._record("hedges_skipped")
+            return False
+        self._record("hedged")
+        get_telemetry().increment("hedged_requests")
+        return True
+
+    def _submit(self, run, model, kind, hedge, cleanup, deadline):
+        attempt = _Attempt(model, hedge, cleanup)
+        telemetry = get_telemetry()
+
+        def timed():
+            start = time.perf_counter()
+            try:
+                # the time left counts from when a worker picks the attempt up
+                result = run(model, max(deadline - start, 0.001))
+            except Exception:
+                telemetry.increment("model_errors", model=model)
+                raise
+            # losers count too, or the percentiles would only see the fast answers
+            seconds = time.perf_counter() - start
+            self.latency.record(model, kind, seconds)
+            telemetry.record_span(f"model:{kind}", start, seconds, model=model, hedge=hedge)
+            return result
+
+        attempt.future = self._executor.submit(telemetry.bind(timed))
+        return attempt
+
+    def _cancel(self, attempts):
+        for attempt in attempts:
+            self._record("cancelled")
+            # a call already running can't be interrupted, it stops at its
+            # timeout; whatever it returns is dropped, and a stream is closed
+            if not attempt.future.cancel():
+                attempt.future.add_done_callback(attempt.discard)
+
+    def _record(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+def _close_items(started):
+    items, _ = started
+    close = getattr(items, "close", None)
+    if close is not None:
+        close()
+
+def get_router():
+    """Return the process-wide router, creating it on first use."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter()
+        return _router
+
+def set_router(router):
+    """Swap the process-wide router, e.g. one with short delays in tests. None goes back to the default."""
+    global _router
+    with _router_lock:
+        _router = router
+
+get_telemetry().register_collector("routing", lambda: get_router().stats())
@@ -0,0 +1,385 @@
+"""
+Process-wide scheduler for Gemini calls.
+
+Every generation request goes through one queue per user, served round-robin
+by a fixed set of workers. Workers take a token from a bucket sized to our
+quota before each upstream call, retry 429/5xx errors with jittered
+exponential backoff, and identical requests already in flight share one
+upstream call instead of starting another; for a stream, every consumer
+gets all of its chunks, however late it joined. When app workers share state
+(see shared_state.py), the bucket lives in the shared backend, so all of
+them together stay within the quota. Background calls (speculation) made
+under spare_tokens_only() never wait for a token: they fail with
+NoSpareToken instead, so they can't use up the quota a user's next real
+request needs.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from shared_state import get_state_backend
+from telemetry import get_telemetry
+
+REQUESTS_PER_MINUTE = float(os.getenv("NOVELQUEST_REQUESTS_PER_MINUTE", 15))
+BURST = int(os.getenv("NOVELQUEST_REQUEST_BURST", 3))
+MAX_CONCURRENT = int(os.getenv("NOVELQUEST_MAX_CONCURRENT", 4))
+MAX_RETRIES = 4
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# the same errors as gRPC status names, for SDK errors that only carry those
+RETRYABLE_GRPC_STATUS = ("RESOURCE_EXHAUSTED", "INTERNAL", "UNAVAILABLE", "DEADLINE_EXCEEDED")
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_local = threading.local()
+
+class NoSpareToken(Exception):
+    """A call made under spare_tokens_only() found no rate limit token free."""
+
+@contextmanager
+def spare_tokens_only():
+    """Calls scheduled from this thread inside the block only run on a token that is free right now."""
+    previous = getattr(_local, "spare_only", False)
+    _local.spare_only = True
+    try:
+        yield
+    finally:
+        _local.spare_only = previous
+
+def status_code(error):
+    """HTTP status of an SDK (google.api_core) or requests error, else None."""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+def is_retryable(error):
+    """
+    True for rate limits and server errors, also when wrapped in another
+    exception. Goes by the error's status only: a 500 in the message text
+    (say "500 pages") isn't a server error.
+    """
+    while error is not None:
+        if status_code(error) in RETRYABLE_STATUS:
+            return True
+        if getattr(getattr(error, "grpc_status_code", None), "name", None) in RETRYABLE_GRPC_STATUS:
+            return True
+        error = error.__cause__
+    return False
+
+class TokenBucket:
+    """Allows rate_per_minute requests on average, with bursts of up to capacity."""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            delay = self._take()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self):
+        """Take a token if one is available right now, without waiting."""
+        return not self._take()
+
+    def _take(self):
+        """Take a token and return 0.0, or return the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+class SharedTokenBucket:
+    """
+    TokenBucket kept in a shared backend under key, so every worker process
+    draws from the same quota. Falls back to a local bucket if the backend
+    can't be reached.
+    """
+
+    def __init__(self, backend, rate_per_minute, capacity, key="ratelimit:gemini"):
+        self.backend = backend
+        self.key = key
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._local = TokenBucket(rate_per_minute, capacity)
+
+    def acquire(self):
+        """Block until a token is available. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            try:
+                delay = self.backend.take_token(self.key, self.rate, self.capacity)
+            except Exception as e:
+                print(f"Shared rate limiter unavailable ({e}), limiting this worker only")
+                return waited + self._local.acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self):
+        """Take a token if one is available right now, without waiting."""
+        try:
+            return not self.backend.take_token(self.key, self.rate, self.capacity)
+        except Exception as e:
+            print(f"Shared rate limiter unavailable ({e}), limiting this worker only")
+            return self._local.try_acquire()
+
+class _ChunkBuffer:
+    """
+    The items of one streamed call, kept until it ends, so every consumer of
+    it (also one joining late) reads all of them from the start.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._end = None
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self._end = ("error", error) if error else ("done", None)
+            self._cond.notify_all()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._items) and self._end is None:
+                    self._cond.wait()
+                if index < len(self._items):
+                    item = self._items[index]
+                else:
+                    kind, error = self._end
+                    if kind == "error":
+                        raise error
+                    return
+            index += 1
+            yield item
+
+class _Job:
+    def __init__(self, user_id, key, func, args, kwargs, stream):
+        self.user_id = user_id
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.stream = stream
+        self.spare_only = getattr(_local, "spare_only", False)
+        self.future = Future()
+        self.chunks = _ChunkBuffer() if stream else None
+        self.enqueued_at = time.monotonic()
+        # the request this call belongs to, so the worker's spans join its trace
+        self.trace = get_telemetry().current_trace()
+        self.enqueued_perf = time.perf_counter()
+
+class RequestScheduler:
+    """Fair, rate-limited, retrying executor for upstream model calls."""
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, burst=BURST, max_concurrent=MAX_CONCURRENT,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY, backend=None):
+        if backend is not None:
+            self.bucket = SharedTokenBucket(backend, requests_per_minute, burst)
+        else:
+            self.bucket = TokenBucket(requests_per_minute, burst)
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # user id -> deque of jobs; OrderedDict order is the round-robin order
+        self._queues = OrderedDict()
+        self._in_flight = {}
+        self._cond = threading.Condition()
+        self._workers = []
+        self._metrics = {
+            "submitted": 0,
+            "coalesced": 0,
+            "completed": 0,
+            "failed": 0,
+            "retries": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "rate_limit_wait_seconds": 0.0,
+        }
+
+    def run(self, user_id, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) through the scheduler and return its result.
+        A call with the same key as one still in flight waits for that one's
+        result instead (key=None never coalesces).
+        """
+        with self._cond:
+            self._metrics["submitted"] += 1
+            job = _Job(user_id, key, func, args, kwargs, stream=False)
+            if self._joinable(job):
+                self._metrics["coalesced"] += 1
+                future = self._in_flight[key].future
+            else:
+                if key is not None:
+                    self._in_flight[key] = job
+                self._enqueue(job)
+                future = job.future
+        return future.result()
+
+    def stream(self, user_id, key, func, *args, **kwargs):
+        """
+        Scheduled version of a generator function: yields its items as the
+        worker produces them. Retries only happen before the first item.
+        A stream with the same key as one still in flight reads that one's
+        items instead, from the first (key=None never coalesces).
+        """
+        with self._cond:
+            self._metrics["submitted"] += 1
+            job = _Job(user_id, key, func, args, kwargs, stream=True)
+            if self._joinable(job):
+                self._metrics["coalesced"] += 1
+                job = self._in_flight[job.key]
+            else:
+                if key is not None:
+                    self._in_flight[key] = job
+                self._enqueue(job)
+        yield from job.chunks
+
+    def try_acquire(self):
+        """A rate limit token for a call outside the queue (a hedged request), if one is free right now."""
+        return self.bucket.try_acquire()
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._metrics)
+        started = metrics["completed"] + metrics["failed"]
+        metrics["avg_wait_seconds"] = metrics["total_wait_seconds"] / started if started else 0.0
+        return metrics
+
+    def _joinable(self, job):
+        """Whether job can wait for the identical one in flight instead of running."""
+        running = self._in_flight.get(job.key) if job.key is not None else None
+        # a real request can't hang on to a background call that may find no token
+        return (running is not None and running.stream == job.stream
+                and (job.spare_only or not running.spare_only))
+
+    def _enqueue(self, job):
+        self._queues.setdefault(job.user_id, deque()).append(job)
+        depth = self._metrics["queue_depth"] = self._metrics["queue_depth"] + 1
+        self._metrics["max_queue_depth"] = max(self._metrics["max_queue_depth"], depth)
+        if len(self._workers) < self.max_concurrent:
+            worker = threading.Thread(target=self._work, daemon=True, name=f"scheduler-{len(self._workers)}")
+            self._workers.append(worker)
+            worker.start()
+        self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            # take one job from the user at the front, then send them to the back
+            user_id, jobs = next(iter(self._queues.items()))
+            job = jobs.popleft()
+            self._queues.pop(user_id)
+            if jobs:
+                self._queues[user_id] = jobs
+            self._metrics["queue_depth"] -= 1
+            waited = time.monotonic() - job.enqueued_at
+            self._metrics["total_wait_seconds"] += waited
+            self._metrics["max_wait_seconds"] = max(self._metrics["max_wait_seconds"], waited)
+            return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            telemetry = get_telemetry()
+            with telemetry.use_trace(job.trace):
+                telemetry.record_span("queue_wait", job.enqueued_perf, time.perf_counter() - job.enqueued_perf)
+                try:
+                    result = self._call_with_retries(job)
+                except Exception as e:
+                    self._finish(job, error=e)
+                else:
+                    self._finish(job, result=result)
+
+    def _call_with_retries(self, job):
+        attempt = 0
+        while True:
+            if job.spare_only:
+                if not self.bucket.try_acquire():
+                    raise NoSpareToken("No rate limit token to spare for a background call")
+                waited = 0.0
+            else:
+                acquire_start = time.perf_counter()
+                waited = self.bucket.acquire()
+            with self._cond:
+                self._metrics["rate_limit_wait_seconds"] += waited
+            if waited:
+                get_telemetry().record_span("rate_limit_wait", acquire_start, waited)
+            started = False
+            try:
+                if not job.stream:
+                    return job.func(*job.args, **job.kwargs)
+                for item in job.func(*job.args, **job.kwargs):
+                    started = True
+                    job.chunks.put(item)
+                return None
+            except Exception as e:
+                if started or attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                with self._cond:
+                    self._metrics["retries"] += 1
+                get_telemetry().increment("upstream_retries")
+                print(f"Upstream error ({e}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _finish(self, job, result=None, error=None):
+        with self._cond:
+            # a real request may have taken the key over from a background one
+            if job.key is not None and self._in_flight.get(job.key) is job:
+                self._in_flight.pop(job.key)
+            self._metrics["failed" if error else "completed"] += 1
+        if job.stream:
+            job.chunks.finish(error)
+        if error:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+def get_scheduler():
+    """Return the process-wide scheduler, creating it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(backend=get_state_backend())
+        return _scheduler
+
+def set_scheduler(scheduler):
+    """Swap the process-wide scheduler, e.g. for a fast one in tests."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
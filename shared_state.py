@@ -0,0 +1,286 @@
+"""
+State shared between app workers.
+
+With several Streamlit replicas behind a load balancer, each process used to
+keep its own response and cover caches, conversation history and rate
+limiter. A shared backend lets every replica see the others' cache entries
+and the conversations users shared by link, and spend from one request
+quota. It doesn't carry a session over when a reconnect lands on another
+replica: the browser would have to present the session's secret id, and
+the only place Streamlit lets the app keep it client-side is the URL,
+where it would hand the conversation to whoever the URL gets passed to.
+
+A backend is a small key/value store with expiry plus two atomic
+operations, the subset of Redis the app needs:
+
+    get(key)                   -> str or None
+    set(key, value, ttl=None)  value is a str, ttl in seconds
+    delete(key)
+    incr(key, amount=1)        -> the new value
+    take_token(key, rate_per_second, capacity)
+        -> 0.0 when a token was taken, else seconds until one is available
+
+SQLiteBackend keeps it in one SQLite file, using SQLite's file locking, so
+workers on one host (or a shared volume) need no other service.
+RedisBackend does the same on a Redis-compatible server (needs the redis
+package). MemoryBackend is per process, for tests.
+
+NOVELQUEST_SHARED_STATE picks the backend: a SQLite file path (or
+sqlite:///path) or a redis:// URL. Unset, every worker keeps to itself as
+before.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+SHARED_STATE_URL = os.getenv("NOVELQUEST_SHARED_STATE")
+# how long SQLite waits for another worker's write lock, in seconds
+LOCK_TIMEOUT = 10.0
+# expired rows are removed every this many writes
+PURGE_EVERY = 500
+
+_backend = None
+_backend_lock = threading.Lock()
+
+class StateBackend(ABC):
+    """Base class: subclasses implement the Redis-like primitives."""
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def incr(self, key, amount=1):
+        pass
+
+    @abstractmethod
+    def take_token(self, key, rate_per_second, capacity):
+        pass
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key, value, ttl=None):
+        self.set(key, json.dumps(value, ensure_ascii=False), ttl)
+
+    def close(self):
+        pass
+
+def _refill(tokens, updated, now, rate_per_second, capacity):
+    """Token bucket step shared by the backends: (tokens, wait seconds)."""
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate_per_second)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate_per_second
+
+class MemoryBackend(StateBackend):
+    """Per-process backend: the interface without the sharing."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._buckets = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value, expires_at = self._values.get(key, ("0", None))
+            value = str(int(value) + amount)
+            self._values[key] = (value, expires_at)
+            return int(value)
+
+    def take_token(self, key, rate_per_second, capacity):
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = _refill(tokens, updated, now, rate_per_second, capacity)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+class SQLiteBackend(StateBackend):
+    """
+    Backend in one SQLite file. WAL mode lets readers run while a worker
+    writes; read-modify-write operations run in BEGIN IMMEDIATE
+    transactions, so they are atomic across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # autocommit mode, transactions are opened explicitly
+        self._db = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                             (key, value, expires_at))
+            self._count_write()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1):
+        with self._lock, self._transaction():
+            row = self._db.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            expired = row is not None and row[1] is not None and row[1] <= time.time()
+            value = (0 if row is None or expired else int(row[0])) + amount
+            self._db.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                             (key, str(value), None if row is None or expired else row[1]))
+        return value
+
+    def take_token(self, key, rate_per_second, capacity):
+        with self._lock, self._transaction():
+            now = time.time()
+            row = self._db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens, wait = _refill(tokens, updated, now, rate_per_second, capacity)
+            self._db.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                             (key, tokens, now))
+        return wait
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _transaction(self):
+        return _Transaction(self._db)
+
+    def _count_write(self):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self._db.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on errors."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+# Token bucket as one atomic script: KEYS[1], ARGV = rate, capacity, now
+_TAKE_TOKEN_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+class RedisBackend(StateBackend):
+    """Backend on a Redis-compatible server (Redis, Valkey, KeyDB...)."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise Exception(f"Error connecting to {url}: the redis package is not installed") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._take_token = self._redis.register_script(_TAKE_TOKEN_SCRIPT)
+
+    def get(self, key):
+        return self._redis.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, value, ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def incr(self, key, amount=1):
+        return self._redis.incrby(key, amount)
+
+    def take_token(self, key, rate_per_second, capacity):
+        # the server's clock, so workers with skewed clocks agree
+        seconds, micros = self._redis.time()
+        return float(self._take_token(keys=[key], args=[rate_per_second, capacity, seconds + micros / 1e6]))
+
+    def close(self):
+        self._redis.close()
+
+def backend_from_url(url):
+    """A backend for a NOVELQUEST_SHARED_STATE value, or None for an empty one."""
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    if url == "memory://":
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///"):]
+    return SQLiteBackend(url)
+
+def get_state_backend():
+    """Return the process-wide shared backend, or None when workers don't share state."""
+    global _backend
+    with _backend_lock:
+        if _backend is None and SHARED_STATE_URL:
+            _backend = backend_from_url(SHARED_STATE_URL)
+        return _backend
+
+def set_state_backend(backend):
+    """Swap the shared backend, e.g. for a temporary SQLite file in tests. None turns sharing off."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,292 @@
+"""
+Speculative prefetch of likely follow-ups.
+
+Most follow-ups are a short refinement of the search just shown: "more like
+the first one", "shorter ones", "something newer". With speculation on, the
+app asks for a few of those in the background as soon as the results are
+on screen, and a follow-up that closely matches one is answered from it
+instead of waiting for a generation.
+
+Speculation costs quota, so it is capped per result set (number of
+requests and estimated tokens). With filters on, the refills asked for
+when books get filtered out count against the same token budget. It also
+only runs on rate limit tokens that are free right now (like hedged
+requests): a speculation that would have to wait for one is skipped, so
+the user's next real request never waits behind speculation. Every speculative answer ends up either
+used or wasted, and the stats count both, with the hit rate of follow-ups,
+so the caps can be tuned. Off by default; NOVELQUEST_SPECULATIVE=1 turns
+it on for new sessions.
+"""
+
+import difflib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from book_recommender import recommend_books
+from conversation import estimate_tokens
+from scheduler import NoSpareToken, spare_tokens_only
+from telemetry import get_telemetry
+
+SPECULATIVE_DEFAULT = os.getenv("NOVELQUEST_SPECULATIVE") == "1"
+MAX_REQUESTS = int(os.getenv("NOVELQUEST_SPECULATIVE_REQUESTS", 3))
+TOKEN_BUDGET = int(os.getenv("NOVELQUEST_SPECULATIVE_TOKENS", 6000))
+WORKERS = 2
+# how close (difflib ratio) a follow-up must be to one of the phrasings
+MATCH_THRESHOLD = 0.8
+
+_WORD = re.compile(r"[a-z0-9#]+")
+
+_executor = None
+_stats = None
+_lock = threading.Lock()
+
+def normalize(text):
+    return " ".join(_WORD.findall(text.lower()))
+
+def likely_followups(books):
+    """
+    (prompt, phrasings) for the refinements users send most often after a
+    search, most likely first. The prompt is what gets sent; a follow-up
+    matching any of the phrasings is answered with its result.
+    """
+    candidates = []
+    if books:
+        first = books[0]["name"]
+        candidates.append((f"More books like {first}, please.", [
+            "more like #1", "more like the first one", "more like the first book",
+            f"more like {first}", f"similar to {first}", f"books like {first}",
+        ]))
+    candidates.append(("Shorter books, please.", [
+        "shorter books", "shorter ones", "something shorter", "shorter please", "shorter",
+    ]))
+    candidates.append(("More recent books, please.", [
+        "more recent books", "more recent ones", "something more recent", "newer books", "newer ones", "newer",
+    ]))
+    candidates.append(("Older, classic books, please.", [
+        "older books", "older ones", "something older", "classics", "more classic books",
+    ]))
+    return candidates
+
+def match_score(text, phrasings):
+    """Best similarity between text and the phrasings; numbers must agree ("#1" isn't "#2")."""
+    text = normalize(text)
+    numbers = re.findall(r"\d+", text)
+    best = 0.0
+    for phrasing in phrasings:
+        phrasing = normalize(phrasing)
+        if re.findall(r"\d+", phrasing) != numbers:
+            continue
+        best = max(best, difflib.SequenceMatcher(None, text, phrasing).ratio())
+    return best
+
+class SpeculationStats:
+    """Hit rate of follow-ups and the tokens speculation spent, used or wasted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "requests": 0,
+            "hits": 0,
+            "misses": 0,
+            "tokens_used": 0,
+            "tokens_wasted": 0,
+            # candidates skipped because the token budget ran out
+            "skipped_budget": 0,
+            # candidates skipped because no rate limit token was free
+            "skipped_no_token": 0,
+            # filter refills sent, and not sent because the budget ran out
+            "refills": 0,
+            "skipped_refills": 0,
+        }
+
+    def record(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        followups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / followups if followups else 0.0
+        spent = stats["tokens_used"] + stats["tokens_wasted"]
+        stats["wasted_fraction"] = stats["tokens_wasted"] / spent if spent else 0.0
+        return stats
+
+def get_speculation_stats():
+    global _stats
+    with _lock:
+        if _stats is None:
+            _stats = SpeculationStats()
+        return _stats
+
+def set_speculation_stats(stats):
+    global _stats
+    with _lock:
+        _stats = stats
+
+def get_speculation_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="speculate")
+        return _executor
+
+class _Speculation:
+    def __init__(self, prompt, phrasings):
+        self.prompt = prompt
+        self.phrasings = phrasings
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.response_text = None
+        self.books = []
+        self.context_stats = None
+        self.tokens = 0
+        # "used" or "wasted" once accounted for
+        self.outcome = None
+
+class FollowupPrefetcher:
+    """
+    Speculative follow-ups for one result set. Runs its candidates one after
+    another in the background, within max_requests and token_budget, on a
+    snapshot of the conversation so the live session isn't touched. Filter
+    refills run inside their speculation, so they share its worker and
+    scheduler queue, and they are only sent while token_budget lasts.
+    """
+
+    def __init__(self, session, books, api_key, num_results=5, book_filter=None, use_cache=True,
+                 user_id="anonymous", max_requests=MAX_REQUESTS, token_budget=TOKEN_BUDGET):
+        self.session = session.snapshot()
+        self.books = books
+        self.api_key = api_key
+        self.num_results = num_results
+        self.book_filter = book_filter
+        self.use_cache = use_cache
+        # its own fair queue in the scheduler, so a real request from the
+        # same user isn't queued behind speculation (and spare_tokens_only
+        # keeps it off the tokens that request needs)
+        self.user_id = f"{user_id}:speculative"
+        self.token_budget = token_budget
+        self.tokens_spent = 0
+        self.speculations = [_Speculation(prompt, phrasings)
+                             for prompt, phrasings in likely_followups(books)[:max_requests]]
+        self._lock = threading.Lock()
+        self._discarded = False
+        self._future = None
+
+    def serves(self, books, num_results, book_filter, use_cache):
+        """True when these speculations answer follow-ups on books with those settings."""
+        filter_key = lambda f: f.key() if f is not None else None
+        return (books is self.books and num_results == self.num_results and use_cache == self.use_cache
+                and filter_key(book_filter) == filter_key(self.book_filter))
+
+    def start(self):
+        self._future = get_speculation_executor().submit(self._run)
+        return self
+
+    def _run(self):
+        stats = get_speculation_stats()
+        for speculation in self.speculations:
+            with self._lock:
+                if self._discarded:
+                    break
+                if speculation.cancelled:
+                    speculation.done.set()
+                    continue
+                if self.tokens_spent >= self.token_budget:
+                    stats.record("skipped_budget")
+                    speculation.done.set()
+                    continue
+                speculation.started = True
+            try:
+                with get_telemetry().trace("speculate", user_id=self.user_id) as trace, spare_tokens_only():
+                    speculation.response_text, speculation.books = recommend_books(
+                        speculation.prompt, self.api_key, num_results=self.num_results, use_cache=self.use_cache,
+                        session=self.session, user_id=self.user_id, book_filter=self.book_filter,
+                        may_refill=lambda: self._may_refill(trace)
+                    )
+                speculation.context_stats = self.session.last_context_stats
+                # a response cache hit cost nothing upstream
+                if trace.attributes.get("source") != "cache":
+                    speculation.tokens = (
+                        estimate_tokens(speculation.prompt) + (speculation.context_stats or {}).get("tokens", 0)
+                        + estimate_tokens(speculation.response_text) + trace.attributes.get("refill_tokens", 0)
+                    )
+                self.tokens_spent += speculation.tokens
+                stats.record("requests")
+                get_telemetry().increment("speculative_requests")
+            except NoSpareToken:
+                stats.record("skipped_no_token")
+                get_telemetry().increment("speculative_skipped", reason="no_token")
+            except Exception as e:
+                print(f"Speculative follow-up failed: {e}")
+            finally:
+                speculation.done.set()
+            # discarded while this one was generating
+            if self._discarded:
+                self._account(speculation, "wasted")
+
+    def _may_refill(self, trace):
+        """Whether a filter refill may go out: spent so far, this speculation's refills included, is under budget."""
+        stats = get_speculation_stats()
+        if self.tokens_spent + trace.attributes.get("refill_tokens", 0) >= self.token_budget:
+            stats.record("skipped_refills")
+            return False
+        stats.record("refills")
+        return True
+
+    def take(self, followup):
+        """
+        The (response_text, books, context_stats) of a speculation matching
+        followup, waiting for it if it is still generating, or None. Counts
+        the follow-up as a hit or a miss.
+        """
+        stats = get_speculation_stats()
+        best, best_score = None, MATCH_THRESHOLD
+        for speculation in self.speculations:
+            score = match_score(followup, speculation.phrasings)
+            if score >= best_score:
+                best, best_score = speculation, score
+        if best is not None:
+            with self._lock:
+                # not started yet: asking directly is quicker than queueing behind the others
+                if not best.started:
+                    best.cancelled = True
+                    best = None
+        if best is not None:
+            # already underway, so waiting beats starting over
+            best.done.wait()
+        if best is None or not best.books:
+            stats.record("misses")
+            get_telemetry().increment("speculative_followups", outcome="miss")
+            return None
+        stats.record("hits")
+        get_telemetry().increment("speculative_followups", outcome="hit")
+        self._account(best, "used")
+        return best.response_text, best.books, best.context_stats
+
+    def discard(self):
+        """The results moved on: whatever wasn't used is wasted, and nothing more starts."""
+        with self._lock:
+            self._discarded = True
+        for speculation in self.speculations:
+            if speculation.done.is_set():
+                self._account(speculation, "wasted")
+
+    def wait(self, timeout=None):
+        """Block until every candidate has run or been skipped (tests, benchmarks)."""
+        if self._future is not None:
+            self._future.result(timeout=timeout)
+
+    def _account(self, speculation, outcome):
+        with self._lock:
+            if speculation.outcome is not None or not speculation.tokens:
+                speculation.outcome = speculation.outcome or outcome
+                return
+            speculation.outcome = outcome
+        get_speculation_stats().record(f"tokens_{outcome}", speculation.tokens)
+        get_telemetry().increment("speculative_tokens", speculation.tokens, outcome=outcome)
+
+get_telemetry().register_collector("speculation", lambda: get_speculation_stats().stats())
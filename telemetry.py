@@ -0,0 +1,329 @@
+"""
+Timing spans, counters and their exports.
+
+A trace is one user request (a search, a follow-up, a batch prompt). Spans
+time the stages inside it: model construction, queue wait, generation (and
+time to first token when streaming), parsing, each cover lookup and the
+Streamlit render. The current trace is kept per thread and handed to the
+scheduler and cover lookup threads, so their spans land in the right
+waterfall.
+
+Every span also feeds a per-stage latency histogram, and counters track
+events like parse failures and placeholder covers. Both export as
+Prometheus text (NOVELQUEST_METRICS_FILE, or an HTTP endpoint on
+NOVELQUEST_METRICS_PORT), and finished traces are appended as JSON lines to
+NOVELQUEST_TRACE_LOG. User ids are hashed on the way out, so neither
+export can be used to pick out a user.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# latency histogram bucket bounds, in seconds
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_TRACES = 20
+METRIC_PREFIX = "novelquest"
+
+TRACE_LOG_PATH = os.getenv("NOVELQUEST_TRACE_LOG")
+METRICS_FILE = os.getenv("NOVELQUEST_METRICS_FILE")
+METRICS_PORT = os.getenv("NOVELQUEST_METRICS_PORT")
+# trace attributes that identify a user, hashed in every export
+PRIVATE_ATTRIBUTES = ("user_id",)
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+_metrics_server = None
+
+def anonymize(value):
+    """A stable stand-in for an identifying attribute: same user, same hash."""
+    return hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:16]
+
+class Trace:
+    """The spans of one request, with offsets relative to its start."""
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration, attributes):
+        span = {"name": name, "offset": round(start - self.start, 6), "duration": round(duration, 6)}
+        span.update(attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["offset"])
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "attributes": {key: anonymize(value) if key in PRIVATE_ATTRIBUTES else value
+                           for key, value in self.attributes.items()},
+            "spans": spans,
+        }
+
+class Telemetry:
+    """Collects spans, latency histograms and counters for the process."""
+
+    def __init__(self, trace_log_path=TRACE_LOG_PATH, metrics_file=METRICS_FILE):
+        self.trace_log_path = trace_log_path
+        self.metrics_file = metrics_file
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        # stage -> [bucket counts..., +Inf count], sum
+        self._histograms = {}
+        self._recent = deque(maxlen=RECENT_TRACES)
+        self._collectors = {}
+
+    def current_trace(self):
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def use_trace(self, trace):
+        """Make trace current on this thread, e.g. in a worker running part of a request."""
+        previous = self.current_trace()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    def bind(self, func):
+        """Wrap func so it runs under the caller's current trace, whatever thread calls it."""
+        trace = self.current_trace()
+        if trace is None:
+            return func
+        def bound(*args, **kwargs):
+            with self.use_trace(trace):
+                return func(*args, **kwargs)
+        return bound
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        """
+        Start a trace for one request. Inside a trace already running on this
+        thread, this joins it instead, so nested entry points share one waterfall.
+        """
+        current = self.current_trace()
+        if current is not None:
+            yield current
+            return
+        trace = Trace(name, attributes)
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            # a trace opened in a generator can end (closed, abandoned) while
+            # another one is current on this thread; that one stays
+            if self.current_trace() is trace:
+                self._local.trace = current
+            trace.duration = time.perf_counter() - trace.start
+            self._finish_trace(trace)
+
+    @contextmanager
+    def span(self, name, trace=None, **attributes):
+        """Time the block as stage name, in trace (default: the current one)."""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.record_span(name, start, time.perf_counter() - start, trace, **attributes)
+
+    def record_span(self, name, start, duration, trace=None, **attributes):
+        """Record a span measured by the caller (perf_counter start, seconds)."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [[0] * (len(SPAN_BUCKETS) + 1), 0.0]
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if duration <= bound:
+                    histogram[0][i] += 1
+                    break
+            else:
+                histogram[0][-1] += 1
+            histogram[1] += duration
+        trace = trace or self.current_trace()
+        if trace is not None:
+            trace.add_span(name, start, duration, attributes)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name, **labels):
+        """A counter's value; without labels, the sum over all of them."""
+        with self._lock:
+            if labels:
+                return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+            return sum(value for (counter, _), value in self._counters.items() if counter == name)
+
+    def register_collector(self, name, collect):
+        """collect() returns a dict of numbers exported as gauges (e.g. cache stats)."""
+        with self._lock:
+            self._collectors[name] = collect
+
+    def recent_traces(self):
+        """The last finished traces, newest first, as dicts."""
+        with self._lock:
+            traces = list(self._recent)
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    def snapshot(self):
+        """Counters, per-stage latency and collector values as plain dicts."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: (list(buckets), total) for name, (buckets, total) in self._histograms.items()}
+            collectors = dict(self._collectors)
+        stages = {}
+        for name, (buckets, total) in histograms.items():
+            count = sum(buckets)
+            stages[name] = {"count": count, "total_seconds": total, "avg_seconds": total / count if count else 0.0}
+        return {
+            "counters": {_label_string(name, labels): value for (name, labels), value in counters.items()},
+            "stages": stages,
+            "gauges": {name: _numbers(collect) for name, collect in collectors.items()},
+        }
+
+    def prometheus_text(self):
+        """Everything in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((name, list(buckets), total) for name, (buckets, total) in self._histograms.items())
+            collectors = sorted(self._collectors.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_prometheus_labels(labels)} {value}")
+
+        if histograms:
+            metric = f"{METRIC_PREFIX}_stage_seconds"
+            lines.append(f"# HELP {metric} Time spent per request stage.")
+            lines.append(f"# TYPE {metric} histogram")
+        for name, buckets, total in histograms:
+            cumulative = 0
+            for bound, count in zip(SPAN_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_prometheus_labels((('stage', name), ('le', bound)))} {cumulative}")
+            lines.append(f"{metric}_sum{_prometheus_labels((('stage', name),))} {total}")
+            lines.append(f"{metric}_count{_prometheus_labels((('stage', name),))} {cumulative}")
+
+        for collector, collect in collectors:
+            for key, value in sorted(_numbers(collect).items()):
+                metric = f"{METRIC_PREFIX}_{collector}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        """Write prometheus_text() to path (atomically, for node_exporter's textfile collector)."""
+        path = path or self.metrics_file
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def _finish_trace(self, trace):
+        with self._lock:
+            self._recent.append(trace)
+        if self.trace_log_path:
+            line = json.dumps(trace.to_dict(), ensure_ascii=False)
+            with self._lock, open(self.trace_log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        if self.metrics_file:
+            try:
+                self.write_prometheus()
+            except OSError as e:
+                print(f"Could not write metrics file: {e}")
+
+def _numbers(collect):
+    try:
+        values = collect()
+    except Exception as e:
+        print(f"Metrics collector failed: {e}")
+        return {}
+    return {key: value for key, value in values.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+def _label_string(name, labels):
+    if not labels:
+        return name
+    return f"{name}{{{','.join(f'{key}={value}' for key, value in labels)}}}"
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def get_telemetry():
+    """Return the process-wide telemetry, creating it on first use."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry()
+        return _telemetry
+
+def set_telemetry(telemetry):
+    """Swap the process-wide telemetry, e.g. for an isolated one in tests."""
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry = telemetry
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body, content_type = get_telemetry().prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path.startswith("/traces"):
+            body, content_type = json.dumps(get_telemetry().recent_traces()), "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    """
+    Serve /metrics (Prometheus text) and /traces (recent traces as JSON) on
+    port, once per process. Does nothing when no port is configured. Only
+    local by default; pass host="0.0.0.0" for a scraper on another machine.
+    """
+    global _metrics_server
+    with _telemetry_lock:
+        if _metrics_server is not None or not port:
+            return _metrics_server
+        _metrics_server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True, name="metrics").start()
+    print(f"Serving metrics on http://{host}:{_metrics_server.server_port}/metrics")
+    return _metrics_server
@@ -4,58 +4,1599 @@ and generating an Amazon India search link.
 Run with: python test.py
 """
 
+import base64
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import requests
 import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from google.api_core import exceptions as api_exceptions
 
-def fetch_cover_via_openlibrary(title, author):
+import batch
+import book_filters
+import book_parser
+import book_recommender
+import catalog
+import conversation
+import cover_cache
+import cover_images
+import response_cache
+import replay
+import retrieval
+import routing
+import scheduler
+import shared_state
+import speculation
+import telemetry
+
+def generate_amazon_in_link(book_title, author):
+    query = f"{book_title} {author} book"
+    encoded_query = urllib.parse.quote(query)
+    return f"https://www.amazon.in/s?k={encoded_query}"
+
+class FakeOpenLibraryHandler(BaseHTTPRequestHandler):
+    """Answers /search.json like OpenLibrary, after sleeping server.latency seconds."""
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        title = query.get("title", [""])[0]
+        self.server.requests_seen += 1
+        if title.startswith("No Cover"):
+            docs = []
+        else:
+            docs = [{"cover_i": sum(map(ord, title)), **self.server.metadata.get(title, {})}]
+        body = json.dumps({"docs": docs}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_openlibrary(latency):
+    """Start a fake OpenLibrary on a free local port and point book_recommender at it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenLibraryHandler)
+    server.latency = latency
+    server.requests_seen = 0
+    server.metadata = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    book_filters.set_metadata_cache(book_filters.MetadataCache(db_path=None))
+    server.real_url = book_recommender.OPENLIBRARY_SEARCH_URL
+    book_recommender.OPENLIBRARY_SEARCH_URL = f"http://127.0.0.1:{server.server_port}/search.json"
+    return server
+
+def stop_fake_openlibrary(server):
+    server.shutdown()
+    book_recommender.OPENLIBRARY_SEARCH_URL = server.real_url
+
+def use_fast_scheduler():
+    """A scheduler whose rate limit and backoff don't slow the tests down."""
+    fast = scheduler.RequestScheduler(requests_per_minute=60000, burst=100, base_delay=0.01, max_delay=0.05)
+    scheduler.set_scheduler(fast)
+    return fast
+
+def make_response(num_books, prefix="Book Title"):
+    """Build a model response in the strict Name/Author/... format."""
+    blocks = []
+    for i in range(1, num_books + 1):
+        blocks.append(
+            f"Book {i}:\nName: {prefix} {i}\nAuthor: Author {i}\nGenre: Mystery, Thriller\n"
+            f"Price: ₹{300 + i}\nai_reasoning: Reason {i}.\nAmazon Link:\n"
+            f"description: Description of book {i}.\n"
+        )
+    return "\n".join(blocks)
+
+def test_concurrent_cover_lookups():
+    """Ten books behind a slow server should take about one round-trip, not ten."""
+    server = start_fake_openlibrary(latency=0.5)
+    try:
+        start = time.perf_counter()
+        books = book_recommender.extract_books_from_response(make_response(10))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_fake_openlibrary(server)
+    assert len(books) == 10, f"Expected 10 books, got {len(books)}"
+    assert server.requests_seen == 10
+    assert all(b["cover_url"].startswith("https://covers.openlibrary.org/") for b in books)
+    assert elapsed < 1.5, f"Cover lookups took {elapsed:.2f}s, expected about one round-trip"
+
+def test_cover_lookup_deadline():
+    """Lookups slower than the batch deadline fall back to the placeholder cover."""
+    server = start_fake_openlibrary(latency=2)
+    try:
+        books = [{"name": f"Slow {i}", "author": "Someone"} for i in range(4)]
+        start = time.perf_counter()
+        book_recommender.fetch_covers_concurrently(books, deadline=0.3)
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_fake_openlibrary(server)
+    assert elapsed < 1, f"Batch ignored its deadline, took {elapsed:.2f}s"
+    assert all(b["cover_url"] == book_recommender.PLACEHOLDER_COVER_URL for b in books)
+
+def test_missing_cover_placeholder():
+    """A book OpenLibrary has no cover for gets the placeholder, the rest keep theirs."""
+    server = start_fake_openlibrary(latency=0)
+    try:
+        books = [{"name": "No Cover Here", "author": "A"}, {"name": "Has Cover", "author": "B"}]
+        book_recommender.fetch_covers_concurrently(books)
+    finally:
+        stop_fake_openlibrary(server)
+    assert books[0]["cover_url"] == book_recommender.PLACEHOLDER_COVER_URL
+    assert books[1]["cover_url"].startswith("https://covers.openlibrary.org/b/id/")
+
+def test_cover_cache_keys():
+    """Case, punctuation, subtitles and co-authors shouldn't change the cache key."""
+    key = cover_cache.make_cover_key("The Silent Patient", "Alex Michaelides")
+    assert cover_cache.make_cover_key("the silent patient: A Novel", "ALEX MICHAELIDES") == key
+    assert cover_cache.make_cover_key("Silent Patient (Paperback)", "Alex Michaelides, Someone Else") == key
+    assert cover_cache.make_cover_key("The Silent Patient!", "Alex Michaelides") == key
+    assert cover_cache.make_cover_key("The Silent Witness", "Alex Michaelides") != key
+
+def test_cover_cache_persistence():
+    """Entries survive a new cache instance on the same file; misses are cached negatively."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "covers.sqlite3")
+        cache = cover_cache.CoverCache(db_path=db_path)
+        cache.put("Dune", "Frank Herbert", "https://covers.openlibrary.org/b/id/1-M.jpg")
+        cache.put("Unknown Book", "Nobody", None)
+
+        reopened = cover_cache.CoverCache(db_path=db_path)
+        assert reopened.get("Dune", "Frank Herbert") == "https://covers.openlibrary.org/b/id/1-M.jpg"
+        assert reopened.get("Unknown Book", "Nobody") is None
+        assert reopened.get("Other Book", "Nobody") is cover_cache.MISSING
+        stats = reopened.stats()
+        assert (stats["hits"], stats["negative_hits"], stats["misses"], stats["disk_hits"]) == (1, 1, 1, 2)
+
+        short = cover_cache.CoverCache(db_path=None, negative_ttl=0)
+        short.put("Unknown Book", "Nobody", None)
+        assert short.get("Unknown Book", "Nobody") is cover_cache.MISSING
+
+def test_cover_cache_eviction():
+    cache = cover_cache.CoverCache(db_path=None, max_entries=2)
+    for i in range(3):
+        cache.put(f"Book {i}", "Author", f"https://covers.openlibrary.org/b/id/{i}-M.jpg")
+    assert cache.get("Book 0", "Author") is cover_cache.MISSING
+    assert cache.get("Book 2", "Author") is not cover_cache.MISSING
+    assert cache.stats()["evictions"] == 1
+
+def test_cover_cache_skips_network():
+    """Repeated titles (including ones without a cover) only hit OpenLibrary once."""
+    server = start_fake_openlibrary(latency=0)
+    try:
+        for _ in range(3):
+            book_recommender.fetch_cover_via_openlibrary("Has Cover", "B")
+            book_recommender.fetch_cover_via_openlibrary("No Cover Here", "A")
+    finally:
+        stop_fake_openlibrary(server)
+    assert server.requests_seen == 2, f"Expected 2 upstream requests, got {server.requests_seen}"
+
+def test_response_cache():
+    """Same prompt and settings reuse the parsed books; bypass and new settings don't."""
+    calls = []
+    def fake_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                             max_output_tokens=None):
+        calls.append(user_prompt)
+        return make_response(num_results)
+
+    real_recommendations = book_recommender.get_book_recommendations
+    book_recommender.get_book_recommendations = fake_recommendations
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    server = start_fake_openlibrary(latency=0)
+    try:
+        _, books = book_recommender.recommend_books("Cozy mysteries  in Cornwall.", "key", num_results=3)
+        books[0]["name"] = "edited by the caller"
+        _, again = book_recommender.recommend_books("cozy mysteries in cornwall", "key", num_results=3)
+        assert len(calls) == 1 and server.requests_seen == 3
+        assert again[0]["name"] == "Book Title 1"
+
+        book_recommender.recommend_books("cozy mysteries in cornwall", "key", num_results=4)
+        book_recommender.recommend_books("cozy mysteries in cornwall", "key", num_results=3, use_cache=False)
+        assert len(calls) == 3
+        stats = response_cache.get_response_cache().stats()
+        assert (stats["hits"], stats["bypassed"]) == (1, 1)
+    finally:
+        book_recommender.get_book_recommendations = real_recommendations
+        stop_fake_openlibrary(server)
+
+    expiring = response_cache.ResponseCache(ttl=0.01, max_entries=1)
+    expiring.put("a", "text", [])
+    expiring.put("b", "text", [])
+    assert expiring.get("a") is None and expiring.stats()["evictions"] == 1
+    time.sleep(0.02)
+    assert expiring.get("b") is None
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_recorded_responses(extension="txt"):
+    responses = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "responses", f"*.{extension}"))):
+        with open(path, encoding="utf-8") as f:
+            responses[os.path.basename(path)] = f.read()
+    return responses
+
+def test_incremental_parser_matches_batch():
+    """Feeding a response in chunks of any size gives the same books as parsing it whole."""
+    for name, text in load_recorded_responses().items():
+        expected = book_recommender.parse_books(text)
+        assert expected, f"{name}: batch parser found no books"
+        for size in (1, 3, 7, 64, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            got = list(book_recommender.iter_books_from_chunks(chunks))
+            assert got == expected, f"{name}: incremental parse differs with {size}-char chunks"
+
+def test_streaming_time_to_first_book():
+    """The first book arrives (with its cover) long before generation finishes."""
+    text = load_recorded_responses()["thriller_5.txt"]
+    blocks = text.split("\n\nBook ")
+
+    def fake_stream(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                    max_output_tokens=None):
+        for i, block in enumerate(blocks):
+            time.sleep(0.3)
+            yield block if i == 0 else "\n\nBook " + block
+
+    real_stream = book_recommender.stream_book_recommendations
+    book_recommender.stream_book_recommendations = fake_stream
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    server = start_fake_openlibrary(latency=0.1)
+    try:
+        start = time.perf_counter()
+        stream = book_recommender.RecommendationStream("twisty thrillers", "key", num_results=5)
+        arrivals = []
+        for book in stream:
+            arrivals.append(time.perf_counter() - start)
+            assert book["cover_url"].startswith("https://covers.openlibrary.org/")
+        total = time.perf_counter() - start
+    finally:
+        book_recommender.stream_book_recommendations = real_stream
+        stop_fake_openlibrary(server)
+    assert len(stream.books) == 5 and stream.response_text == text
+    assert arrivals[0] < total / 2, f"First book at {arrivals[0]:.2f}s of {total:.2f}s"
+
+    # the finished stream was cached like recommend_books results
+    cached = book_recommender.RecommendationStream("twisty thrillers", "key", num_results=5)
+    assert [b["name"] for b in cached] == [b["name"] for b in stream.books] and cached.from_cache
+
+def test_parser_loose_format_and_diagnostics():
+    """Loose labels parse, and broken books are reported instead of swallowing neighbours."""
+    books = book_recommender.parse_books(load_recorded_responses()["loose_format_2.txt"])
+    assert [b["name"] for b in books] == ["Project Hail Mary", "The Martian"]
+    assert books[0]["author"] == "Andy Weir" and books[1]["price"] == "₹399"
+    assert books[0]["description"].startswith("Ryland Grace is the sole survivor")
+
+    text = (
+        "**Name:** Dune\n**Author:** Frank Herbert\nGenre: Science Fiction\nPrice: ₹599\n"
+        "ai_reasoning: Politics and sand.\ndescription: Paul Atreides goes to Arrakis.\n"
+        "Note: this line belongs to the description.\n\n"
+        "Author: Nobody\nGenre: Drama\n\n"
+        "Name: Emma\nAuthor: Jane Austen\ndescription: A matchmaker meddles. What do you think of these? Anything else?\n"
+    )
+    books, diagnostics = book_recommender.parse_books_with_diagnostics(text)
+    assert [b["name"] for b in books] == ["Dune", "Emma"]
+    assert books[0]["description"].endswith("this line belongs to the description.")
+    assert books[1]["description"] == "A matchmaker meddles."
+    assert [d["status"] for d in diagnostics] == ["ok", "dropped", "incomplete"]
+    assert diagnostics[1]["missing_fields"] == ["name", "price", "ai_reasoning", "description"]
+    assert diagnostics[2]["missing_fields"] == ["genre", "price", "ai_reasoning"]
+
+def test_parser_linear_on_adversarial_input():
+    """Malformed books that made the old fallback regex blow up parse in linear time."""
+    def missing_price(n):
+        return "".join(f"Name: T{i}\nAuthor: A\nGenre: G\nai_reasoning: r\ndescription: d\n" for i in range(n))
+
+    def parse_time(text):
+        start = time.perf_counter()
+        book_parser.parse_book_fields(text)
+        return time.perf_counter() - start
+
+    small, large = missing_price(2000), missing_price(16000)
+    parse_time(small)
+    ratio = parse_time(large) / parse_time(small)
+    assert ratio < 24, f"8x the input took {ratio:.1f}x the time"
+    assert parse_time("name: title: by: cost: " * 20000) < 0.5
+
+def test_json_output_mode():
+    """JSON responses skip the text parser; invalid JSON falls back to a text-mode request."""
+    text_responses = load_recorded_responses()
+    json_responses = load_recorded_responses("json")
+    for name, text in json_responses.items():
+        expected = book_recommender.parse_books(text_responses[name.replace(".json", ".txt")])
+        assert book_recommender.parse_books(text, output_format="json") == expected, name
+        for size in (1, 50):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            assert list(book_recommender.iter_books_from_chunks(chunks, output_format="json")) == expected, name
+        # the same array wrapped in an object, next to another array that isn't books
+        wrapped = '{"tags": [{"name": "Not a book"}], "books": ' + text + "}"
+        assert book_recommender.parse_books(wrapped, output_format="json") == expected, name
+        for size in (1, 50):
+            chunks = [wrapped[i:i + size] for i in range(0, len(wrapped), size)]
+            assert list(book_recommender.iter_books_from_chunks(chunks, output_format="json")) == expected, name
+
+    calls = []
+    json_reply = {"value": json_responses["fantasy_3.json"]}
+    def fake_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                             max_output_tokens=None):
+        calls.append(output_format)
+        return json_reply["value"] if output_format == "json" else text_responses["thriller_5.txt"]
+
+    real_recommendations = book_recommender.get_book_recommendations
+    book_recommender.get_book_recommendations = fake_recommendations
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    server = start_fake_openlibrary(latency=0)
+    try:
+        _, books = book_recommender.recommend_books("epic fantasy", "key", num_results=3, output_format="json")
+        assert calls == ["json"] and [b["name"] for b in books][0] == "The Name of the Wind"
+
+        json_reply["value"] = '[{"name": "Cut off mid'
+        _, books = book_recommender.recommend_books("slow thrillers", "key", output_format="json")
+        assert calls == ["json", "json", "text"] and len(books) == 5
+    finally:
+        book_recommender.get_book_recommendations = real_recommendations
+        stop_fake_openlibrary(server)
+
+class FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenerativeModel:
+    """Stands in for genai.GenerativeModel and records what it was sent."""
+    instances = []
+
+    def __init__(self, model_name, generation_config, system_instruction):
+        self.system_instruction = system_instruction
+        self.sent = []
+        FakeGenerativeModel.instances.append(self)
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        self.sent.append(contents)
+        return FakeGeminiResponse(make_response(2, prefix=f"Reply {len(self.sent)}"))
+
+def test_model_and_session_reuse():
+    """Models are built once per settings; follow-ups send role-based history."""
+    configured = []
+    genai = book_recommender.load_genai()
+    real_model, real_configure = genai.GenerativeModel, genai.configure
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.configure = lambda api_key: configured.append(api_key)
+    book_recommender._models.clear()
+    book_recommender._configured_api_key = None
+    FakeGenerativeModel.instances = []
+    try:
+        session = conversation.ConversationSession()
+        first = book_recommender.get_book_recommendations("space opera", "key-1", num_results=2)
+        session.record_turn("space opera", first)
+        followup = book_recommender.get_book_recommendations("shorter ones", "key-1", num_results=2, session=session)
+        session.record_turn("shorter ones", followup)
+        book_recommender.get_book_recommendations("poetry", "key-1", num_results=3)
+    finally:
+        genai.GenerativeModel, genai.configure = real_model, real_configure
+        book_recommender._models.clear()
+        book_recommender._configured_api_key = None
+
+    assert configured == ["key-1"], configured
+    assert len(FakeGenerativeModel.instances) == 2
+    model = FakeGenerativeModel.instances[0]
+    assert model.sent[0] == "space opera"
+    assert [turn["role"] for turn in model.sent[1]] == ["user", "model", "user"]
+    assert model.sent[1][1]["parts"] == [first] and model.sent[1][2]["parts"] == ["shorter ones"]
+    assert len(session) == 2
+
+def test_conversation_token_budget():
+    """Context stays under budget however long the conversation gets."""
+    response = load_recorded_responses()["thriller_5.txt"]
+    session = conversation.ConversationSession(token_budget=1500, recent_turns=1)
+    sizes = []
+    for turn in range(30):
+        contents = session.contents_for(f"Follow-up {turn}: darker, please")
+        sizes.append(session.last_context_stats["tokens"])
+        assert sizes[-1] <= 1500
+        session.record_turn(f"Follow-up {turn}: darker, please", response)
+
+    stats = session.last_context_stats
+    assert stats["verbatim"] == 1 and stats["compacted"] > 0 and stats["dropped"] > 0
+    assert contents[-2]["parts"] == [response]
+    assert contents[1]["parts"][0].startswith("Recommended: The Silent Patient by Alex Michaelides;")
+    assert contents[-1] == {"role": "user", "parts": ["Follow-up 29: darker, please"]}
+    # older turns are the ones that go
+    assert contents[0]["parts"][0] == f"Follow-up {29 - stats['verbatim'] - stats['compacted']}: darker, please"
+    assert max(sizes[15:]) - min(sizes[15:]) < 50, sizes
+
+class FlakyModel:
     """
-    Search OpenLibrary for title+author, grab the first cover_i or ISBN,
-    and return the medium‐size cover URL.
+    Fake upstream that fails the calls listed in fail_on (1-based) with the
+    SDK's error for status, wrapped like get_book_recommendations does.
     """
+
+    def __init__(self, fail_on, status=429, message="Resource has been exhausted", delay=0):
+        self.fail_on = set(fail_on)
+        self.status = status
+        self.message = message
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.delay)
+        if call in self.fail_on:
+            error = api_exceptions.from_http_status(self.status, self.message)
+            raise Exception(f"Error getting recommendations: {error}") from error
+        return f"answer to {prompt}"
+
+def test_scheduler_retries():
+    """429/5xx are retried with backoff, other errors and exhausted retries surface."""
+    fast = use_fast_scheduler()
+    model = FlakyModel(fail_on=[1, 2])
+    assert fast.run("u", None, model, "p") == "answer to p"
+    assert model.calls == 3 and fast.metrics()["retries"] == 2
+
+    model = FlakyModel(fail_on=[1], status=400, message="API key not valid")
+    try:
+        fast.run("u", None, model, "p")
+        raise AssertionError("non-retryable error was swallowed")
+    except Exception as e:
+        assert "400" in str(e) and model.calls == 1
+
+    model = FlakyModel(fail_on=range(1, 20), status=503, message="Service Unavailable")
+    try:
+        fast.run("u", None, model, "p")
+        raise AssertionError("exhausted retries didn't raise")
+    except Exception as e:
+        assert "503" in str(e) and model.calls == fast.max_retries + 1
+    assert fast.metrics()["failed"] == 2
+
+    # background calls fail at once instead of waiting for a token
+    drained = scheduler.RequestScheduler(requests_per_minute=1, burst=1)
+    drained.try_acquire()
+    model = FlakyModel(fail_on=[])
+    try:
+        with scheduler.spare_tokens_only():
+            drained.run("u", None, model, "p")
+        raise AssertionError("ran without a token")
+    except scheduler.NoSpareToken:
+        assert model.calls == 0
+
+    # the status decides, not numbers in the message
+    assert not scheduler.is_retryable(Exception("Error getting recommendations: books under 500 pages"))
+    assert not scheduler.is_retryable(ValueError("429 books requested"))
+    assert scheduler.is_retryable(api_exceptions.ServiceUnavailable("model overloaded"))
+    assert scheduler.is_retryable(api_exceptions.DeadlineExceeded("took too long"))
+    response = requests.Response()
+    response.status_code = 502
+    assert scheduler.is_retryable(requests.HTTPError("Bad Gateway", response=response))
+    response.status_code = 404
+    assert not scheduler.is_retryable(requests.HTTPError("Not Found", response=response))
+
+def test_scheduler_coalescing_and_fairness():
+    """Identical in-flight prompts share one call; a second user isn't stuck behind a busy one."""
+    fast = scheduler.RequestScheduler(requests_per_minute=60000, burst=100, max_concurrent=1)
+    model = FlakyModel(fail_on=[], delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fast.run("u", "same", model, "p"))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["answer to p"] * 5 and model.calls == 1
+    assert fast.metrics()["coalesced"] == 4
+
+    order = []
+    def record(name):
+        time.sleep(0.05)
+        order.append(name)
+    busy = [threading.Thread(target=fast.run, args=("busy", None, record, f"busy-{i}")) for i in range(4)]
+    for t in busy:
+        t.start()
+        time.sleep(0.01)
+    quiet = threading.Thread(target=fast.run, args=("quiet", None, record, "quiet"))
+    quiet.start()
+    for t in busy + [quiet]:
+        t.join()
+    assert order.index("quiet") <= 2, order
+    metrics = fast.metrics()
+    assert metrics["max_queue_depth"] >= 3 and metrics["queue_depth"] == 0 and metrics["max_wait_seconds"] > 0
+
+class CountingProfile(replay.UpstreamProfile):
+    """UpstreamProfile that counts the upstream calls made with it."""
+
+    def __init__(self, **settings):
+        super().__init__(**settings)
+        self.calls = 0
+
+    def first_byte_delay(self):
+        with self._lock:
+            self.calls += 1
+        return super().first_byte_delay()
+
+def test_identical_streams_share_one_call():
+    """Two users streaming the same search at once (the app's path) share one upstream call and both get every book."""
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    fast = use_fast_scheduler()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    profile = CountingProfile(latency=0.3, tokens_per_second=5000)
+    replay.use_upstreams(replay.FakeGemini(profile), replay.FakeOpenLibrary())
+    streams = [book_recommender.RecommendationStream("heist thrillers", "key", num_results=3, user_id=user)
+               for user in ("first", "second")]
+    results = {}
     try:
-        resp = requests.get(
-            "https://openlibrary.org/search.json",
-            params={"title": title, "author": author, "limit": 1},
-            timeout=5
+        threads = [threading.Thread(target=lambda s=s: results.setdefault(s.user_id, [b["name"] for b in s]))
+                   for s in streams]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+    finally:
+        replay.use_upstreams(None, None)
+    assert profile.calls == 1 and fast.metrics()["coalesced"] == 1, (profile.calls, fast.metrics())
+    assert len(results["first"]) == 3 and results["first"] == results["second"]
+    assert streams[0].response_text == streams[1].response_text
+
+def test_token_bucket():
+    bucket = scheduler.TokenBucket(rate_per_minute=600, capacity=2)
+    start = time.perf_counter()
+    for _ in range(4):
+        bucket.acquire()
+    elapsed = time.perf_counter() - start
+    assert 0.15 < elapsed < 0.6, f"4 requests at 10/s with burst 2 took {elapsed:.2f}s"
+
+def build_fixture_catalog(db_path):
+    """Ingest the small OpenLibrary dump in fixtures/openlibrary."""
+    book_catalog = catalog.BookCatalog(db_path)
+    counts = {}
+    for name in ("authors.txt", "works.txt", "editions.jsonl"):
+        for kind, count in book_catalog.ingest(os.path.join(FIXTURES_DIR, "openlibrary", name)).items():
+            counts[kind] = counts.get(kind, 0) + count
+    book_catalog.finalize()
+    return book_catalog, counts
+
+def test_catalog_ingest_and_lookup():
+    """Dump records land in the catalog with editions merged into their work."""
+    with tempfile.TemporaryDirectory() as tmp:
+        book_catalog, counts = build_fixture_catalog(os.path.join(tmp, "catalog.sqlite3"))
+        try:
+            assert counts == {"authors": 3, "works": 3, "editions": 4, "skipped": 2}, counts
+            match = book_catalog.lookup("Book Title 1", "Author 1")
+            assert match["work_key"] == "/works/OL1W"
+            assert match["cover_url"] == "https://covers.openlibrary.org/b/id/101-M.jpg"
+            assert match["isbn"] == "9780000000011" and match["pages"] == 320 and match["year"] == 1999
+            assert book_catalog.lookup("Book Title 2", "Author 2")["year"] == 2004
+            # no cover id, so the edition ISBN gives the cover
+            assert book_catalog.lookup("Book Title 3", "Author 3")["cover_url"].endswith("/isbn/9780000000035-M.jpg")
+
+            # misspelled titles go through the trigram index, a different author doesn't match
+            fuzzy = book_catalog.lookup("The Book Tittle 2", "author 2")
+            assert fuzzy is not None and fuzzy["work_key"] == "/works/OL2W", fuzzy
+            assert book_catalog.lookup("Book Title 2", "Somebody Else") is None
+            assert book_catalog.lookup("Completely Unrelated", "Nobody") is None
+
+            start = time.perf_counter()
+            for _ in range(1000):
+                book_catalog.lookup("Book Title 1", "Author 1")
+            per_lookup = (time.perf_counter() - start) / 1000
+            print(f"Catalog lookup: {per_lookup * 1e6:.0f} µs")
+            assert per_lookup < 0.001, f"Exact lookups took {per_lookup * 1000:.2f} ms"
+        finally:
+            book_catalog.close()
+
+def test_catalog_resolves_before_network():
+    """Books the catalog knows skip OpenLibrary, and duplicates in a response are dropped."""
+    server = start_fake_openlibrary(latency=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        book_catalog, _ = build_fixture_catalog(os.path.join(tmp, "catalog.sqlite3"))
+        catalog.set_catalog(book_catalog)
+        try:
+            response = make_response(4) + "\n" + make_response(1)
+            books = book_recommender.extract_books_from_response(response)
+        finally:
+            catalog.set_catalog(None)
+            book_catalog.close()
+            stop_fake_openlibrary(server)
+    assert [b["name"] for b in books] == [f"Book Title {i}" for i in range(1, 5)]
+    assert server.requests_seen == 1, f"Expected only the unknown book to hit the network, saw {server.requests_seen}"
+    assert books[0]["pages"] == 320 and books[0]["year"] == 1999
+    assert "work_key" not in books[3]
+
+def test_book_filter_checks():
+    book_filter = book_filters.BookFilter(min_pages=200, max_pages=500, max_year=2010)
+    assert book_filter.check({"pages": 320, "year": 1999}) == "ok"
+    assert book_filter.check({"pages": 150, "year": 1999}) == "pages"
+    assert book_filter.check({"pages": 320, "year": 2015}) == "year"
+    assert book_filter.check({"pages": 320}) == "unverified"
+    assert book_filter.describe() == (" The book should have between 200 and 500 pages."
+                                      " The book should be published in or before 2010.")
+    assert not book_filters.BookFilter().active and book_filters.BookFilter().key() is None
+
+    # metadata is cached apart from covers, with stats of its own
+    metadata = book_filters.MetadataCache(db_path=None)
+    assert metadata.get("Dune", "Frank Herbert") is cover_cache.MISSING
+    metadata.put("Dune", "Frank Herbert", {"pages": 412, "year": 1965})
+    metadata.put("Unknown Book", "Nobody", {})
+    assert metadata.get("Dune", "Frank Herbert") == {"pages": 412, "year": 1965}
+    assert metadata.get("Unknown Book", "Nobody") == {}
+    stats = metadata.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (1, 1, 1), stats
+    assert "metadata_cache" in telemetry.get_telemetry().snapshot()["gauges"]
+
+    # NOVELQUEST_METADATA_DB moves the metadata file, like NOVELQUEST_COVER_CACHE does for covers
+    real_cache = book_filters.get_metadata_cache()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "metadata.sqlite3")
+        os.environ["NOVELQUEST_METADATA_DB"] = path
+        book_filters.set_metadata_cache(None)
+        try:
+            book_filters.get_metadata_cache()
+            assert os.path.exists(path)
+        finally:
+            del os.environ["NOVELQUEST_METADATA_DB"]
+            book_filters.set_metadata_cache(real_cache)
+
+def test_filters_refill_shortfall():
+    """Books outside the page range are dropped and only the shortfall is asked for again."""
+    responses = [make_response(4), make_response(2, "Fresh Pick"), make_response(1, "Last Pick")]
+    for streamed in (False, True):
+        calls = []
+        def fake_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text",
+                                 session=None, max_output_tokens=None):
+            calls.append((user_prompt, num_results))
+            return responses[len(calls) - 1]
+        def fake_stream(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                        max_output_tokens=None):
+            yield fake_recommendations(user_prompt, api_key, num_results)
+
+        real_recommendations = book_recommender.get_book_recommendations
+        real_stream = book_recommender.stream_book_recommendations
+        book_recommender.get_book_recommendations = fake_recommendations
+        book_recommender.stream_book_recommendations = fake_stream
+        response_cache.set_response_cache(response_cache.ResponseCache())
+        book_filters.set_filter_stats(book_filters.FilterStats())
+        use_fast_scheduler()
+        server = start_fake_openlibrary(latency=0)
+        server.metadata = {
+            "Book Title 1": {"number_of_pages_median": 150, "first_publish_year": 2001},
+            "Book Title 2": {"number_of_pages_median": 320},
+            "Book Title 3": {"number_of_pages_median": 900},
+            # Book Title 4 has no metadata and can't be checked
+            "Fresh Pick 1": {"number_of_pages_median": 250},
+            "Fresh Pick 2": {"number_of_pages_median": 1000},
+            "Last Pick 1": {"number_of_pages_median": 300},
+        }
+        book_filter = book_filters.BookFilter(min_pages=200, max_pages=500)
+        try:
+            if streamed:
+                stream = book_recommender.RecommendationStream("long reads", "key", num_results=4,
+                                                               book_filter=book_filter)
+                books = list(stream)
+            else:
+                _, books = book_recommender.recommend_books("long reads", "key", num_results=4,
+                                                            book_filter=book_filter)
+        finally:
+            book_recommender.get_book_recommendations = real_recommendations
+            book_recommender.stream_book_recommendations = real_stream
+            stop_fake_openlibrary(server)
+
+        assert [b["name"] for b in books] == ["Book Title 2", "Book Title 4", "Fresh Pick 1", "Last Pick 1"], books
+        assert [n for _, n in calls] == [4, 2, 1]
+        assert "Do not recommend any of these books: Book Title 1 by Author 1; Book Title 2 by Author 2" in calls[1][0]
+        assert "Fresh Pick 2 by Author 2" in calls[2][0]
+        # metadata came with the cover lookups, one search per book
+        assert server.requests_seen == 7
+        stats = book_filters.get_filter_stats().stats()
+        assert (stats["checked"], stats["rejected_pages"], stats["unverified"]) == (7, 3, 1), stats
+        assert (stats["refill_requests"], stats["refill_books"], stats["requery_books_avoided"]) == (2, 3, 5)
+
+def test_retrieval_index():
+    """Top-k by cosine similarity, with the genre bitmask applied before scoring."""
+    with tempfile.TemporaryDirectory() as tmp:
+        count = retrieval.build_index([os.path.join(FIXTURES_DIR, "corpus", "books.jsonl")], tmp)
+        index = retrieval.RetrievalIndex(tmp)
+        try:
+            assert count == index.count == 20
+            dune = index.search("desert planet politics and betrayal", k=3, genres=["Science Fiction"])
+            assert dune[0]["name"] == "Dune", dune
+            assert all("Science Fiction" in book["genre"] for book in dune)
+
+            # the named book is the example, not a result
+            similar = index.search("books like The Silent Patient", k=3, genres=["Thriller"])
+            names = [book["name"] for book in similar]
+            assert "The Silent Patient" not in names, names
+            assert set(names) <= {"Gone Girl", "The Girl on the Train", "Behind Closed Doors", "Sharp Objects",
+                                  "Neuromancer", "It"}, names
+            assert index.search("the and of", k=3) == []
+        finally:
+            index.close()
+    assert retrieval.genre_mask_for_text("Non-Fiction, Memoir") == retrieval.genre_mask(["Non-Fiction", "Memoir"])
+    assert retrieval.genre_mask_for_text("Sci-fi") == retrieval.genre_mask(["science fiction"])
+
+def test_retrieval_fast_path():
+    """Corpus hits are re-ranked by the model; queries the corpus can't answer are generated."""
+    rerank_calls, generate_calls = [], []
+    def fake_rerank(user_prompt, candidates, api_key, num_results=5):
+        rerank_calls.append((user_prompt, candidates))
+        return (
+            "Name: Gone Girl\nAuthor: Gillian Flynn\nPrice: ₹399\nai_reasoning: Another unreliable narrator.\n\n"
+            "Name: Not In The List\nAuthor: Nobody\nPrice: ₹1\nai_reasoning: Made up.\n\n"
+            "Name: The Girl on the Train\nAuthor: Paula Hawkins\nPrice: ₹299\nai_reasoning: Same tension.\n"
         )
-        data = resp.json()
-        docs = data.get("docs", [])
-        if not docs:
+    def fake_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                             max_output_tokens=None):
+        generate_calls.append(user_prompt)
+        return make_response(num_results)
+
+    real_rerank = book_recommender.get_reranked_recommendations
+    real_recommendations = book_recommender.get_book_recommendations
+    book_recommender.get_reranked_recommendations = fake_rerank
+    book_recommender.get_book_recommendations = fake_recommendations
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    server = start_fake_openlibrary(latency=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        retrieval.build_index([os.path.join(FIXTURES_DIR, "corpus", "books.jsonl")], tmp)
+        index = retrieval.RetrievalIndex(tmp)
+        retrieval.set_retrieval_index(index)
+        try:
+            _, books = book_recommender.recommend_books("books like The Silent Patient", "key", num_results=2,
+                                                        genres=["Thriller"])
+            streamed = list(book_recommender.RecommendationStream("books like Gone Girl", "key", num_results=2,
+                                                                  genres=["Thriller"]))
+            _, generated = book_recommender.recommend_books("zzz qqq xxyy", "key", num_results=2)
+        finally:
+            retrieval.set_retrieval_index(None)
+            index.close()
+            book_recommender.get_reranked_recommendations = real_rerank
+            book_recommender.get_book_recommendations = real_recommendations
+            stop_fake_openlibrary(server)
+
+    assert [b["name"] for b in books] == ["Gone Girl", "The Girl on the Train"]
+    # description and genre come from the corpus, reasoning and price from the model
+    assert books[0]["description"].startswith("On their fifth wedding anniversary")
+    assert books[0]["ai_reasoning"] == "Another unreliable narrator." and books[0]["price"] == "₹399"
+    # Gone Girl was the example, so the model's pick of it is ignored and the next candidate fills in
+    assert [b["name"] for b in streamed][0] == "The Girl on the Train" and len(streamed) == 2
+    assert "Gone Girl" not in [b["name"] for b in streamed] and len(rerank_calls) == 2
+    assert "Candidates:" in book_recommender.format_candidates("x", rerank_calls[0][1])
+    assert generate_calls == ["zzz qqq xxyy"] and [b["name"] for b in generated] == ["Book Title 1", "Book Title 2"]
+
+def test_batch_run_and_resume():
+    """Every prompt ends up in the output once; a re-run only retries what failed."""
+    calls = []
+    def fake_recommendations(user_prompt, api_key, num_results=5, context=None, output_format="text", session=None,
+                             max_output_tokens=None):
+        calls.append(user_prompt)
+        if user_prompt.startswith("flaky") and calls.count(user_prompt) == 1:
+            raise Exception("Error getting recommendations: upstream hiccup")
+        return make_response(num_results, user_prompt.split()[0])
+
+    real_recommendations = book_recommender.get_book_recommendations
+    book_recommender.get_book_recommendations = fake_recommendations
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    server = start_fake_openlibrary(latency=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "prompts.jsonl")
+        output_path = os.path.join(tmp, "results.jsonl")
+        with open(input_path, "w") as f:
+            for i in range(6):
+                f.write(json.dumps({"id": f"p{i}", "prompt": f"prompt{i} books", "num_results": 2}) + "\n")
+            f.write(json.dumps({"prompt": "flaky books", "num_results": 1, "min_year": 1990}) + "\n")
+        # a crash mid-write left half a record behind
+        with open(output_path, "w") as f:
+            f.write('{"id": "p0", "bo')
+        try:
+            first = batch.run_batch(input_path, output_path, "key", concurrency=3,
+                                    requests_per_minute=60000, burst=100)
+            second = batch.run_batch(input_path, output_path, "key", concurrency=3,
+                                     requests_per_minute=60000, burst=100)
+        finally:
+            book_recommender.get_book_recommendations = real_recommendations
+            stop_fake_openlibrary(server)
+            use_fast_scheduler()
+        with open(output_path) as f:
+            records = [json.loads(line) for line in f]
+
+    assert (first["completed"], first["failed"], first["skipped"]) == (6, ["7"], 0), first
+    assert (second["completed"], second["failed"], second["skipped"]) == (1, [], 6), second
+    assert first["prompts_per_minute"] > 0 and "rate_limit_wait_seconds" in first
+    assert sorted(r["id"] for r in records) == ["7", "p0", "p1", "p2", "p3", "p4", "p5"]
+    by_id = {r["id"]: r for r in records}
+    assert [b["name"] for b in by_id["p3"]["books"]] == ["prompt3 1", "prompt3 2"]
+    # the filter was spelled out for the model, and only the failed prompt ran twice
+    assert calls.count("flaky books The book should be published in or after 1990.") == 2
+    assert len(calls) == 8
+
+class FakeStreamingModel(FakeGenerativeModel):
+    """FakeGenerativeModel that also answers stream=True, in 40-character chunks."""
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        response = super().generate_content(contents)
+        if not stream:
+            return response
+        return [FakeGeminiResponse(response.text[i:i + 40]) for i in range(0, len(response.text), 40)]
+
+def test_telemetry_spans_and_export():
+    """Each request gets one trace with its stages as spans; counters and latency export as Prometheus text."""
+    genai = book_recommender.load_genai()
+    real_model, real_configure = genai.GenerativeModel, genai.configure
+    genai.GenerativeModel = FakeStreamingModel
+    genai.configure = lambda api_key: None
+    book_recommender._models.clear()
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    server = start_fake_openlibrary(latency=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        trace_log = os.path.join(tmp, "traces.jsonl")
+        metrics_file = os.path.join(tmp, "metrics.prom")
+        collected = telemetry.Telemetry(trace_log_path=trace_log, metrics_file=metrics_file)
+        telemetry.set_telemetry(collected)
+        book_recommender.register_metrics(collected)
+        try:
+            book_recommender.recommend_books("space opera", "key", num_results=2, user_id="reader-42")
+            streamed = list(book_recommender.RecommendationStream("cozy mystery", "key", num_results=2))
+            # outside any request: counted, but not part of a trace
+            book_recommender.fetch_covers_concurrently([book_recommender.build_book(
+                {"name": "No Cover Here", "author": "Nobody", "genre": "", "price": "", "ai_reasoning": "",
+                 "description": ""}
+            )])
+            book_recommender.extract_books_from_response("Sorry, I can't help with that.")
+        finally:
+            genai.GenerativeModel, genai.configure = real_model, real_configure
+            book_recommender._models.clear()
+            stop_fake_openlibrary(server)
+            telemetry.set_telemetry(telemetry.Telemetry())
+            book_recommender.register_metrics()
+        with open(trace_log) as f:
+            logged = [json.loads(line) for line in f]
+        with open(metrics_file) as f:
+            exported = f.read()
+
+    assert len(streamed) == 2
+    stream_trace, batch_trace = collected.recent_traces()
+    assert [t["trace_id"] for t in logged] == [batch_trace["trace_id"], stream_trace["trace_id"]]
+    assert (batch_trace["name"], batch_trace["attributes"]["source"]) == ("recommend", "text")
+    # user ids only leave the process hashed
+    assert batch_trace["attributes"]["user_id"] == telemetry.anonymize("reader-42")
+    assert "reader-42" not in json.dumps(logged)
+    stages = [span["name"] for span in batch_trace["spans"]]
+    for stage in ("queue_wait", "model_build", "generate", "parse", "covers"):
+        assert stage in stages, stages
+    assert stages.count("cover_lookup") == 2
+    assert all(0 <= span["offset"] <= batch_trace["duration"] for span in batch_trace["spans"])
+
+    # a trace in an abandoned generator doesn't end the request current when it is closed
+    isolated = telemetry.Telemetry(trace_log_path=None, metrics_file=None)
+    def streamed_books():
+        with isolated.trace("stream"):
+            yield "book"
+    abandoned = streamed_books()
+    next(abandoned)
+    other = telemetry.Trace("other")
+    with isolated.use_trace(other):
+        abandoned.close()
+        assert isolated.current_trace() is other
+        isolated.record_span("render", time.perf_counter(), 0.001)
+    assert [span["name"] for span in other.to_dict()["spans"]] == ["render"]
+
+    # the streamed request ran on the scheduler and cover threads, its spans still land in its trace
+    spans = {span["name"]: span for span in stream_trace["spans"]}
+    assert "model_build" not in spans and spans["generate"]["streamed"] and spans["parse"]["streamed"]
+    assert spans["first_token"]["duration"] <= spans["generate"]["duration"]
+    assert [span["name"] for span in stream_trace["spans"]].count("cover_lookup") == 2
+
+    text = collected.prometheus_text()
+    assert 'novelquest_placeholder_covers_total{reason="not_found"} 1' in text
+    assert 'novelquest_parse_failures_total{output_format="text"} 1' in text
+    assert 'novelquest_cover_lookups_total{source="openlibrary"} 5' in text
+    assert 'novelquest_stage_seconds_count{stage="generate"} 2' in text
+    assert 'novelquest_stage_seconds_bucket{stage="generate",le="+Inf"} 2' in text
+    assert "novelquest_scheduler_completed 2" in text
+    # the file is rewritten as each trace finishes
+    assert 'novelquest_stage_seconds_count{stage="first_token"} 1' in exported
+
+def test_replay_round_trip():
+    """Recorded Gemini and OpenLibrary exchanges replay to the same books, with no network."""
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = start_fake_openlibrary(latency=0)
+        recorder = replay.GeminiRecorder(tmp, upstream=replay.FakeGemini())
+        replay.use_upstreams(recorder, replay.OpenLibraryRecorder(tmp))
+        try:
+            _, recorded = book_recommender.recommend_books("gothic novels set in old houses", "key", num_results=3)
+            recorded_followup = list(book_recommender.RecommendationStream(
+                "shorter ones", "key", num_results=2, context="User asked for gothic novels"
+            ))
+        finally:
+            stop_fake_openlibrary(server)
+
+        # the fake server is gone and the caches are empty: only the fixtures can answer
+        cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+        gemini, openlibrary = replay.GeminiReplayer(tmp), replay.OpenLibraryReplayer(tmp)
+        replay.use_upstreams(gemini, openlibrary)
+        try:
+            _, replayed = book_recommender.recommend_books("gothic novels set in old houses", "key", num_results=3,
+                                                           use_cache=False)
+            replayed_followup = list(book_recommender.RecommendationStream(
+                "shorter ones", "key", num_results=2, context="User asked for gothic novels", use_cache=False
+            ))
+            try:
+                book_recommender.get_book_recommendations("never recorded", "key", num_results=3)
+                assert False, "an unrecorded request should not be answered"
+            except Exception as e:
+                assert isinstance(e.__cause__, replay.ReplayMiss), e
+        finally:
+            replay.use_upstreams(None, None)
+
+    assert len(recorder.store) == 2 and len(openlibrary.store) == 5
+    assert [(b["name"], b["cover_url"]) for b in replayed] == [(b["name"], b["cover_url"]) for b in recorded]
+    assert [b["name"] for b in replayed_followup] == [b["name"] for b in recorded_followup]
+    assert (gemini.hits, gemini.misses, openlibrary.hits, openlibrary.misses) == (2, 1, 5, 0)
+
+def test_speculative_followups():
+    """Likely follow-ups are prefetched within budget; matching ones hit, unused ones count as wasted."""
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    speculation.set_speculation_stats(speculation.SpeculationStats())
+    replay.use_upstreams(replay.FakeGemini(), replay.FakeOpenLibrary())
+    try:
+        session = conversation.ConversationSession()
+        response, books = book_recommender.recommend_books("cozy village mysteries", "key", num_results=3)
+        session.record_turn("cozy village mysteries", response, books)
+        prefetcher = speculation.FollowupPrefetcher(session, books, "key", num_results=3).start()
+        prefetcher.wait(timeout=10)
+        # the speculation ran on a copy of the conversation
+        assert session.last_context_stats is None and len(session) == 1
+        assert prefetcher.serves(books, 3, None, True)
+        assert not prefetcher.serves(books, 5, None, True)
+        assert not prefetcher.serves(books, 3, book_filters.BookFilter(max_pages=300), True)
+
+        assert prefetcher.take("more like #2") is None
+        hit = prefetcher.take("Shorter, please!")
+        assert hit is not None and len(hit[1]) == 3 and hit[2]["turns"] == 1
+        prefetcher.discard()
+        stats = speculation.get_speculation_stats().stats()
+        assert (stats["requests"], stats["hits"], stats["misses"], stats["hit_rate"]) == (3, 1, 1, 0.5), stats
+        spent = sum(s.tokens for s in prefetcher.speculations)
+        assert stats["tokens_used"] > 0 and stats["tokens_used"] + stats["tokens_wasted"] == spent, stats
+
+        # the token budget stops speculation after the first fresh request
+        capped = speculation.FollowupPrefetcher(session, books, "key", num_results=3, use_cache=False,
+                                                token_budget=1).start()
+        capped.wait(timeout=10)
+        assert [s.started for s in capped.speculations] == [True, False, False]
+        assert speculation.get_speculation_stats().stats()["skipped_budget"] == 2
+
+        # filter refills spend from the same budget: one goes out, the next would be over it
+        speculation.set_speculation_stats(speculation.SpeculationStats())
+        filtered = speculation.FollowupPrefetcher(session, books, "key", num_results=3, use_cache=False,
+                                                  book_filter=book_filters.BookFilter(max_pages=1),
+                                                  token_budget=1).start()
+        filtered.wait(timeout=10)
+        stats = speculation.get_speculation_stats().stats()
+        assert (stats["requests"], stats["refills"], stats["skipped_refills"]) == (1, 1, 1), stats
+        assert [s.started for s in filtered.speculations] == [True, False, False]
+        assert filtered.tokens_spent == filtered.speculations[0].tokens > spent / 3
+
+        # speculation only runs on spare rate limit tokens: with the bucket empty it is skipped, not queued
+        speculation.set_speculation_stats(speculation.SpeculationStats())
+        drained = scheduler.RequestScheduler(requests_per_minute=1, burst=1)
+        scheduler.set_scheduler(drained)
+        assert drained.try_acquire() and not drained.try_acquire()
+        start = time.perf_counter()
+        starved = speculation.FollowupPrefetcher(session, books, "key", num_results=3, use_cache=False).start()
+        starved.wait(timeout=10)
+        stats = speculation.get_speculation_stats().stats()
+        assert (stats["skipped_no_token"], stats["requests"]) == (3, 0), stats
+        assert time.perf_counter() - start < 5 and not any(s.books for s in starved.speculations)
+        use_fast_scheduler()
+    finally:
+        replay.use_upstreams(None, None)
+
+SHARED_PROMPTS = ("cozy village mysteries", "hard science fiction about first contact",
+                  "gothic novels in old houses", "heist thrillers")
+
+def shared_state_worker(db_path, prompts, save_session_id=None, load_session_id=None, tokens=0, use_cache=True):
+    """
+    One app worker process (run in a spawned pool child): the prompts through
+    caches in the shared SQLite file, optionally saving or loading a
+    conversation, then tokens from the shared rate limiter.
+    """
+    # pool processes run several of these, so count from here
+    telemetry.set_telemetry(telemetry.Telemetry(trace_log_path=None, metrics_file=None))
+    backend = shared_state.SQLiteBackend(db_path)
+    shared_state.set_state_backend(backend)
+    response_cache.set_response_cache(response_cache.ResponseCache(backend=backend))
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None, backend=backend))
+    book_filters.set_metadata_cache(book_filters.MetadataCache(db_path=None, backend=backend))
+    scheduler.set_scheduler(scheduler.RequestScheduler(requests_per_minute=60000, burst=100, backend=backend))
+    catalog.set_catalog(None)
+    retrieval.set_retrieval_index(None)
+    replay.use_upstreams(replay.FakeGemini(), replay.FakeOpenLibrary())
+    result = {"pid": os.getpid(), "session": None}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for prompt in prompts:
+            response, books = book_recommender.recommend_books(prompt, "key", num_results=3, use_cache=use_cache)
+            if save_session_id:
+                session = conversation.ConversationSession()
+                session.record_turn(prompt, response, books)
+                conversation.save_session(backend, save_session_id, session, books, shared=True)
+        if load_session_id:
+            session, books = conversation.load_session(backend, load_session_id, shared_only=True)
+            result["session"] = (len(session), session.turns[0]["titles"], [book["name"] for book in books])
+    # 2 tokens of burst, then 10 per second, for all the workers together
+    bucket = scheduler.SharedTokenBucket(backend, 600, 2, key="ratelimit:test")
+    result["token_times"] = []
+    for _ in range(tokens):
+        bucket.acquire()
+        result["token_times"].append(time.time())
+    result["generated"] = telemetry.get_telemetry().snapshot()["stages"].get("generate", {}).get("count", 0)
+    result["response_cache"] = response_cache.get_response_cache().stats()
+    result["cover_cache"] = cover_cache.get_cover_cache().stats()
+    backend.close()
+    return result
+
+def test_shared_state_across_workers():
+    """Worker processes on one SQLite backend reuse each other's results and sessions and share one quota."""
+    # only a conversation the user shared can be opened by its id, and the id itself isn't shown
+    backend = shared_state.MemoryBackend()
+    conversation.save_session(backend, "private", conversation.ConversationSession(), [])
+    assert conversation.load_session(backend, "private", shared_only=True) is None
+    assert conversation.load_session(backend, "private") is not None
+    user_id = conversation.hash_session_id("private")
+    assert user_id == conversation.hash_session_id("private") and "private" not in user_id
+
+    # a backend missing one of the primitives can't be created
+    class Incomplete(shared_state.StateBackend):
+        def get(self, key):
             return None
+    try:
+        Incomplete()
+        assert False, "Incomplete has no set/delete/incr/take_token"
+    except TypeError:
+        pass
 
-        doc = docs[0]
-        # 1) Try cover_i
-        if doc.get("cover_i"):
-            cover_id = doc["cover_i"]
-            return f"https://covers.openlibrary.org/b/id/{cover_id}-M.jpg"
-        # 2) Fallback to ISBN
-        if doc.get("isbn"):
-            isbn = doc["isbn"][0]
-            return f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg"
-    except Exception as e:
-        print(f"[fetch_cover] error: {e}")
-    return None
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp, context.Pool(3) as pool:
+        db_path = os.path.join(tmp, "shared.sqlite3")
+        pool.apply(shared_state_worker, (db_path, SHARED_PROMPTS[:1]), {"save_session_id": "browser-1"})
+        first = pool.apply(shared_state_worker, (db_path, SHARED_PROMPTS))
+        others = pool.starmap(shared_state_worker, [(db_path, SHARED_PROMPTS[::-1], None, "browser-1"),
+                                                    (db_path, SHARED_PROMPTS)], chunksize=1)
+        uncached = pool.apply(shared_state_worker, (db_path, SHARED_PROMPTS), {"use_cache": False})
+        limited = pool.starmap(shared_state_worker, [(db_path, (), None, None, 4)] * 3, chunksize=1)
 
-def generate_amazon_in_link(book_title, author):
-    query = f"{book_title} {author} book"
-    encoded_query = urllib.parse.quote(query)
-    return f"https://www.amazon.in/s?k={encoded_query}"
+    # results generated once are hits in every other worker, covers included
+    assert first["generated"] == 3 and first["response_cache"]["shared_hits"] == 1, first
+    for worker in others:
+        assert worker["generated"] == 0, worker
+        assert worker["response_cache"]["shared_hits"] == len(SHARED_PROMPTS), worker
+    # a fresh generation still finds every cover the other workers looked up
+    assert uncached["generated"] == len(SHARED_PROMPTS)
+    assert uncached["cover_cache"]["shared_hits"] == 3 * len(SHARED_PROMPTS), uncached["cover_cache"]
+    turns, titles, names = others[0]["session"]
+    assert turns == 1 and len(titles) == 3 and [title[0] for title in titles] == names
+
+    # never more than the burst plus the refill, across all workers
+    times = sorted(t for worker in limited for t in worker["token_times"])
+    assert len(times) == 12
+    for i, t in enumerate(times):
+        assert t - times[0] >= (i + 1 - 2) / 10 - 0.02, (i, t - times[0])
+
+class RoutedModel:
+    """
+    Fake model that is slow, fast or hung by name; a hung one answers only
+    when its timeout passes. Streams record when they get closed.
+    """
+    SLOW_SECONDS = 0.5
+    HUNG_SECONDS = 30
+    closed = []
+
+    def __init__(self, model_name, generation_config=None, system_instruction=None):
+        self.model_name = model_name
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        if self.model_name == "slow":
+            time.sleep(self.SLOW_SECONDS)
+        if self.model_name == "hung":
+            timeout = (request_options or {}).get("timeout", self.HUNG_SECONDS)
+            time.sleep(timeout)
+            raise replay.UpstreamTimeout(timeout)
+        if stream:
+            return self._stream()
+        return replay._Response(f"answer from {self.model_name}")
+
+    def _stream(self):
+        try:
+            for word in ("answer", "from", self.model_name):
+                yield replay._Response(word + " ")
+        finally:
+            RoutedModel.closed.append(self.model_name)
+
+def routed(models, **settings):
+    """A router over the RoutedModel models that hedges right away and never steps down."""
+    options = dict(default_hedge_delays={"response": 0.05, "first_token": 0.05, "rerank": 0.05},
+                   min_hedge_delay=0.0, max_hedge_rate=1.0, step_down_queue_depth=0, spare_token=lambda: True)
+    options.update(settings)
+    router = routing.ModelRouter(models=models, **options)
+    routing.set_router(router)
+    return router
+
+def test_model_routing():
+    """Slow calls are hedged on the next model and the loser cancelled; deadlines fail fast."""
+    book_recommender.set_model_factory(RoutedModel)
+    try:
+        router = routed(["slow", "fast"])
+        assert book_recommender.get_book_recommendations("cozy mysteries", "key") == "answer from fast"
+        text = "".join(book_recommender.stream_book_recommendations("cozy mysteries", "key"))
+        assert text == "answer from fast ", text
+        stats = router.stats()
+        assert stats["requests"] == 2 and stats["hedged"] == 2 and stats["hedge_wins"] == 2, stats
+        # the slow answers still arrive and count towards the latency percentiles
+        time.sleep(RoutedModel.SLOW_SECONDS + 0.2)
+        report = router.latency.report()
+        assert report["slow"]["response"]["count"] == 1 and report["fast"]["first_token"]["count"] == 1, report
+        assert report["slow"]["response"]["p50_ms"] >= RoutedModel.SLOW_SECONDS * 1000
+        # the losing stream was closed after its first chunk, not read to the end
+        assert "slow" in RoutedModel.closed
+
+        # no spare rate limit token: no hedge, the slow model answers
+        router = routed(["slow", "fast"], spare_token=lambda: False)
+        assert book_recommender.get_book_recommendations("cozy mysteries", "key") == "answer from slow"
+        assert router.stats()["hedged"] == 0 and router.stats()["hedges_skipped"] == 1
+
+        # nothing within the deadline: an error well before the slow model answers
+        router = routed(["slow"], deadline=0.1, hedging=False)
+        start = time.perf_counter()
+        try:
+            book_recommender.get_book_recommendations("cozy mysteries", "key")
+            assert False, "the deadline passes first"
+        except Exception as e:
+            assert "request deadline" in str(e) and not scheduler.is_retryable(e), e
+        assert time.perf_counter() - start < RoutedModel.SLOW_SECONDS
+        assert router.stats()["deadline_exceeded"] == 1
+
+        # hung calls stop at the deadline too, so they don't keep every worker busy
+        router = routed(["hung"], deadline=0.1, hedging=False)
+        for _ in range(routing.WORKERS + 2):
+            try:
+                book_recommender.get_book_recommendations("cozy mysteries", "key")
+                assert False, "a hung model never answers"
+            except Exception as e:
+                assert "request deadline" in str(e) and not scheduler.is_retryable(e), e
+        router.primary = "fast"
+        assert book_recommender.get_book_recommendations("cozy mysteries", "key") == "answer from fast"
+
+        # the hedge delay follows the observed latency once there are enough samples
+        router = routed(["fast"], hedge_min_samples=10)
+        for i in range(10):
+            router.latency.record("fast", "response", (i + 1) / 10)
+        assert router.hedge_delay("fast", "response") == 1.0
+        assert router.hedge_delay("fast", "first_token") == 0.05
+    finally:
+        book_recommender.set_model_factory(None)
+        routing.set_router(None)
+
+def test_step_down_under_load():
+    """A backed-up scheduler gets smaller requests, except from callers that opt out."""
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    router = routed(["gemini-2.0-flash"], step_down_queue_depth=4, load=lambda: 6)
+    assert router.step_down(10) == (routing.STEP_DOWN_RESULTS, routing.STEP_DOWN_MAX_OUTPUT_TOKENS)
+    assert router.step_down(2) == (2, None)
+    replay.use_upstreams(replay.FakeGemini(), replay.FakeOpenLibrary())
+    try:
+        _, books = book_recommender.recommend_books("space operas", "key", num_results=8)
+        assert len(books) == routing.STEP_DOWN_RESULTS, len(books)
+        stream = book_recommender.RecommendationStream("sea stories", "key", num_results=8)
+        assert len(list(stream)) == routing.STEP_DOWN_RESULTS and stream.stepped_down_from == 8
+        _, books = book_recommender.recommend_books("space operas", "key", num_results=8, step_down=False)
+        assert len(books) == 8, len(books)
+    finally:
+        replay.use_upstreams(None, None)
+        routing.set_router(None)
+    assert router.stats()["step_downs"] == 3
+
+# heavy modules the app must not load before the first search
+DEFERRED_MODULES = ["google.generativeai", "numpy", "PIL", "requests"]
+
+def import_times(module):
+    """Cumulative import time (microseconds) per module for a cold import of module."""
+    env = dict(os.environ, GEMINI_API_KEY=os.getenv("GEMINI_API_KEY") or "test-key")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr[-2000:]
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative)
+    return times
+
+def test_lazy_startup():
+    for module in ["app", "book_recommender"]:
+        times = import_times(module)
+        loaded = [name for name in DEFERRED_MODULES if name in times]
+        print(f"import {module}: {times[module] / 1000:.0f} ms")
+        assert not loaded, f"import {module} loads {loaded}"
+
+def test_warm_up():
+    # a fresh process, so the once-per-process warm-up hasn't run yet
+    script = (
+        "import sys, book_recommender\n"
+        "thread = book_recommender.warm_up('test-key')\n"
+        "thread.join(60)\n"
+        "assert book_recommender.genai is not None and 'requests' in sys.modules\n"
+        "assert book_recommender._models and book_recommender._http_session is not None\n"
+        "assert book_recommender.warm_up('test-key') is None\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr[-2000:]
+
+def test_app_reruns():
+    """Filter tweaks keep the cards, and a follow-up renders its books in one script run."""
+    from streamlit.testing.v1 import AppTest
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    telemetry.set_telemetry(telemetry.Telemetry(trace_log_path=None, metrics_file=None))
+    replay.use_upstreams(replay.FakeGemini(), replay.FakeOpenLibrary())
+    previous_key = os.environ.get("GEMINI_API_KEY")
+    os.environ["GEMINI_API_KEY"] = "test-key"
+    card_names = lambda app: [m.value.split("<h3>")[1].split("</h3>")[0] for m in app.markdown if "<h3>" in m.value]
+    script_runs = lambda: telemetry.get_telemetry().snapshot()["stages"]["script_run"]["count"]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            thumbnails = cover_images.ThumbnailCache(tmp)
+            cover_images.set_thumbnail_cache(thumbnails)
+            app = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                                    default_timeout=30)
+            app.run()
+            app.text_area[0].input("cozy village mysteries")
+            next(button for button in app.button if button.label == "Find Books").click().run()
+            found = card_names(app)
+            assert len(found) == 5 and not app.exception
+
+            # filters only apply on the next search
+            next(s for s in app.slider if s.label == "Year Published:").set_value((1990, 2025)).run()
+            assert card_names(app) == found
+
+            runs = script_runs()
+            app.text_input(key="followup").input("shorter ones")
+            app.button(key="send_followup").click().run()
+            assert script_runs() == runs + 1, "the follow-up should not trigger a second run"
+            assert card_names(app) and card_names(app) != found
+            assert app.caption[0].value.startswith("Last follow-up sent 1 of 1")
+            assert all("data:image/webp;base64," in m.value for m in app.markdown if "<h3>" in m.value)
+
+            # with speculation on, a common refinement is answered from the prefetched result
+            app.checkbox(key="speculative").check()
+            app.text_area[0].input("gothic novels in old houses")
+            next(button for button in app.button if button.label == "Find Books").click().run()
+            app.session_state["prefetcher"].wait(timeout=10)
+            app.text_input(key="followup").input("something shorter")
+            app.button(key="send_followup").click().run()
+            assert "answered from a prefetched result" in app.caption[0].value
+            followup = next(t for t in telemetry.get_telemetry().recent_traces() if t["name"] == "followup")
+            assert followup["attributes"]["source"] == "prefetched"
+            assert not any(span["name"] == "generate" for span in followup["spans"])
+            # the new results got their own speculation; let it finish while the fakes are still in place
+            app.session_state["prefetcher"].discard()
+            app.session_state["prefetcher"].wait(timeout=10)
+            thumbnails.close()
+    finally:
+        cover_images.set_thumbnail_cache(None)
+        replay.use_upstreams(None, None)
+        if previous_key is None:
+            os.environ.pop("GEMINI_API_KEY", None)
+        else:
+            os.environ["GEMINI_API_KEY"] = previous_key
+
+def test_app_session_sharing():
+    """?sid= only opens a copy of a conversation its owner shared; traces carry the hashed id."""
+    from streamlit.testing.v1 import AppTest
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    use_fast_scheduler()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    telemetry.set_telemetry(telemetry.Telemetry(trace_log_path=None, metrics_file=None))
+    replay.use_upstreams(replay.FakeGemini(), replay.FakeOpenLibrary())
+    backend = shared_state.MemoryBackend()
+    shared_state.set_state_backend(backend)
+    previous_key = os.environ.get("GEMINI_API_KEY")
+    os.environ["GEMINI_API_KEY"] = "test-key"
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    # cards are rendered, so thumbnails go to a temporary cache, not the checkout's
+    tmp = tempfile.TemporaryDirectory()
+    thumbnails = cover_images.ThumbnailCache(tmp.name)
+    cover_images.set_thumbnail_cache(thumbnails)
+    try:
+        session = conversation.ConversationSession()
+        session.record_turn("private request", make_response(1), [])
+        conversation.save_session(backend, "guessed-id", session, [])
+        app = AppTest.from_file(app_path, default_timeout=30)
+        app.query_params["sid"] = "guessed-id"
+        app.run()
+        assert app.session_state["session_id"] != "guessed-id" and not len(app.session_state["conversation"])
+
+        app.text_area[0].input("cozy village mysteries")
+        next(button for button in app.button if button.label == "Find Books").click().run()
+        session_id = app.session_state["session_id"]
+        # nothing is stored or put in the URL until the user shares
+        assert conversation.load_session(backend, session_id) is None and "sid" not in app.query_params
+        app.button(key="share").click().run()
+        assert app.query_params["sid"] in (session_id, [session_id])
+        search = next(t for t in telemetry.get_telemetry().recent_traces() if t["name"] == "search")
+        assert search["attributes"]["user_id"] == telemetry.anonymize(conversation.hash_session_id(session_id))
+
+        # the shared link opens a copy of the conversation in a new browser session
+        other = AppTest.from_file(app_path, default_timeout=30)
+        other.query_params["sid"] = session_id
+        other.run()
+        assert len(other.session_state["conversation"]) == 1 and other.session_state["books"]
+        assert other.session_state["session_id"] != session_id and not other.session_state["shared"]
+        assert other.session_state["user_id"] != app.session_state["user_id"]
+
+        # the viewer's follow-up continues their fork, the owner's conversation is untouched
+        owner_books = conversation.load_session(backend, session_id)[1]
+        other.text_input(key="followup").input("shorter ones")
+        other.button(key="send_followup").click().run()
+        assert len(other.session_state["conversation"]) == 2 and not other.exception
+        stored, stored_books = conversation.load_session(backend, session_id)
+        assert len(stored) == 1 and stored_books == owner_books
+        assert conversation.load_session(backend, other.session_state["session_id"]) is None
+    finally:
+        cover_images.set_thumbnail_cache(None)
+        thumbnails.close()
+        tmp.cleanup()
+        shared_state.set_state_backend(None)
+        replay.use_upstreams(None, None)
+        if previous_key is None:
+            os.environ.pop("GEMINI_API_KEY", None)
+        else:
+            os.environ["GEMINI_API_KEY"] = previous_key
+
+def test_upstream_profiles():
+    """Injected Gemini errors are retried by the scheduler; slow or failing OpenLibrary gets placeholders."""
+    response_cache.set_response_cache(response_cache.ResponseCache())
+    fast = use_fast_scheduler()
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    replay.use_upstreams(replay.FakeGemini(replay.UpstreamProfile(error_rate=1.0, error_status=429)),
+                         replay.FakeOpenLibrary(replay.UpstreamProfile(latency=0.2)))
+    real_timeout = book_recommender.COVER_LOOKUP_TIMEOUT
+    book_recommender.COVER_LOOKUP_TIMEOUT = 0.05
+    try:
+        try:
+            book_recommender.recommend_books("anything", "key", num_results=2)
+            assert False, "every Gemini call fails"
+        except Exception as e:
+            assert "429" in str(e)
+        assert fast.metrics()["retries"] == fast.max_retries
+
+        # OpenLibrary answers slower than the lookup timeout
+        assert book_recommender.fetch_cover_via_openlibrary("Slow Book", "A") is None
+        replay.use_upstreams(replay.FakeGemini(replay.UpstreamProfile(latency=0.01, tokens_per_second=20000)),
+                             replay.FakeOpenLibrary(replay.UpstreamProfile(error_rate=1.0)))
+        start = time.perf_counter()
+        _, books = book_recommender.recommend_books("anything", "key", num_results=2)
+        elapsed = time.perf_counter() - start
+    finally:
+        book_recommender.COVER_LOOKUP_TIMEOUT = real_timeout
+        replay.use_upstreams(None, None)
+
+    assert len(books) == 2 and all(b["cover_url"] == book_recommender.PLACEHOLDER_COVER_URL for b in books)
+    # ~1800 characters at 20000 tokens/s plus the first-byte latency
+    assert 0.03 < elapsed < 1.0, elapsed
+
+class ChunkedSession:
+    """Answers every GET with body, streamed like a network read: never more than 16 KiB per chunk."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def get(self, url, **kwargs):
+        return self
+
+    def __enter__(self):
+        self.status_code = 200
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        chunk_size = min(chunk_size, 16 * 2 ** 10)
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+def test_cover_thumbnails():
+    """Covers are downloaded once into 150x225 thumbnails, evicted by size and served with long cache headers."""
+    session = replay.FakeOpenLibrary().session()
+    urls = [f"https://covers.openlibrary.org/b/id/{i}-M.jpg" for i in range(4)]
+    with tempfile.TemporaryDirectory() as tmp:
+        thumbnails = cover_images.ThumbnailCache(os.path.join(tmp, "a"))
+        src = thumbnails.src(urls[0], session=session)
+        assert src.startswith("data:image/webp;base64,")
+        with Image.open(io.BytesIO(base64.b64decode(src.split(",", 1)[1]))) as image:
+            assert image.size == (150, 225)
+        assert thumbnails.src(urls[0], session=session) == src
+        # prefetching what is already cached does nothing, and isn't a hit
+        assert thumbnails.prefetch(urls[0], session) is None
+        stats = thumbnails.stats()
+        assert (stats["downloads"], stats["files"], stats["hits"]) == (1, 1, 1)
+        size = stats["bytes"]
+        assert thumbnails.src("", session=session) == cover_images.PLACEHOLDER_COVER_URL
+        assert thumbnails.src(book_recommender.PLACEHOLDER_COVER_URL) == cover_images.PLACEHOLDER_COVER_URL
+        assert cover_images.PLACEHOLDER_COVER_URL.startswith("data:image/svg+xml;base64,")
+        thumbnails.close()
+
+        # room for two thumbnails: the least recently used ones go
+        thumbnails = cover_images.ThumbnailCache(os.path.join(tmp, "b"), max_bytes=int(size * 2.5))
+        for url in urls:
+            thumbnails.prefetch(url, session).result()
+        stats = thumbnails.stats()
+        assert (stats["files"], stats["evictions"]) == (2, 2) and stats["bytes"] <= size * 2.5
+        assert thumbnails.lookup(urls[0]) is None and thumbnails.lookup(urls[3]) is not None
+        assert len(glob.glob(os.path.join(tmp, "b", "*", "*.webp"))) == 2
+        thumbnails.close()
+
+        # served by digest, cacheable for a year
+        thumbnails = cover_images.ThumbnailCache(os.path.join(tmp, "c"), base_url="http://127.0.0.1")
+        cover_images.set_thumbnail_cache(thumbnails)
+        try:
+            server = cover_images.start_cover_server(port="0", host="127.0.0.1")
+            served = thumbnails.src(urls[1], session=session)
+            assert served.startswith("http://127.0.0.1/covers/") and served.endswith(".webp")
+            url = f"http://127.0.0.1:{server.server_port}{served[len('http://127.0.0.1'):]}"
+            resp = requests.get(url, timeout=5)
+            assert resp.status_code == 200 and resp.headers["Content-Type"] == "image/webp"
+            assert "immutable" in resp.headers["Cache-Control"]
+            assert requests.get(url, headers={"If-None-Match": resp.headers["ETag"]}, timeout=5).status_code == 304
+            assert requests.get(f"http://127.0.0.1:{server.server_port}/covers/nope.webp", timeout=5).status_code == 404
+        finally:
+            cover_images.set_thumbnail_cache(None)
+            thumbnails.close()
+
+        # bodies arrive in many chunks: all of them are read, and too big is no image
+        image = io.BytesIO()
+        Image.effect_noise((400, 600), 64).save(image, format="PNG")
+        assert len(image.getvalue()) > 2 * 16 * 2 ** 10
+        thumbnails = cover_images.ThumbnailCache(os.path.join(tmp, "d"))
+        assert thumbnails.prefetch(urls[0], ChunkedSession(image.getvalue())).result()[0]
+        real_limit = cover_images.MAX_SOURCE_BYTES
+        cover_images.MAX_SOURCE_BYTES = len(image.getvalue()) - 1
+        try:
+            assert thumbnails.prefetch(urls[1], ChunkedSession(image.getvalue())).result() == ("", None)
+        finally:
+            cover_images.MAX_SOURCE_BYTES = real_limit
+        assert thumbnails.stats()["missing"] == 1
+        thumbnails.close()
+
+    # OpenLibrary's 1x1 "no cover" image isn't a thumbnail
+    pixel = io.BytesIO()
+    Image.new("RGB", (1, 1)).save(pixel, format="GIF")
+    assert cover_images.make_thumbnail(pixel.getvalue()) is None
 
 def main():
+    # a catalog built locally would change which lookups hit the fake server
+    catalog.set_catalog(None)
+    retrieval.set_retrieval_index(None)
+    book_filters.set_metadata_cache(book_filters.MetadataCache(db_path=None))
+
     title = "The Silent Patient"
     author = "Alex Michaelides"
 
     print("Testing fetch_cover_via_openlibrary...")
-    cover_url = fetch_cover_via_openlibrary(title, author)
+    # against a fake OpenLibrary, the tests don't need the network
+    cover_cache.set_cover_cache(cover_cache.CoverCache(db_path=None))
+    replay.use_upstreams(None, replay.FakeOpenLibrary())
+    try:
+        cover_url = book_recommender.fetch_cover_via_openlibrary(title, author)
+    finally:
+        replay.use_upstreams(None, None)
     print(f"Cover URL: {cover_url}")
-    assert cover_url is None or cover_url.startswith("https://covers.openlibrary.org/"), \
-        "Invalid cover URL"
+    assert cover_url.startswith("https://covers.openlibrary.org/b/id/"), "Invalid cover URL"
 
     print("Testing generate_amazon_in_link...")
     amzn_link = generate_amazon_in_link(title, author)
     print(f"Amazon Link: {amzn_link}")
     assert "amazon.in/s?k=" in amzn_link, "Invalid Amazon India link"
 
+    print("Testing concurrent cover lookups against a fake OpenLibrary...")
+    test_concurrent_cover_lookups()
+    test_cover_lookup_deadline()
+    test_missing_cover_placeholder()
+    test_cover_thumbnails()
+
+    print("Testing the cover cache...")
+    test_cover_cache_keys()
+    test_cover_cache_persistence()
+    test_cover_cache_eviction()
+    test_cover_cache_skips_network()
+
+    print("Testing the response cache...")
+    test_response_cache()
+
+    print("Testing streaming recommendations...")
+    test_incremental_parser_matches_batch()
+    test_streaming_time_to_first_book()
+
+    print("Testing the book parser...")
+    test_parser_loose_format_and_diagnostics()
+    test_parser_linear_on_adversarial_input()
+
+    print("Testing JSON output mode...")
+    test_json_output_mode()
+
+    print("Testing model and chat session reuse...")
+    test_model_and_session_reuse()
+    test_conversation_token_budget()
+
+    print("Testing the request scheduler...")
+    test_scheduler_retries()
+    test_scheduler_coalescing_and_fairness()
+    test_identical_streams_share_one_call()
+    test_token_bucket()
+
+    print("Testing the local catalog...")
+    test_catalog_ingest_and_lookup()
+    test_catalog_resolves_before_network()
+
+    print("Testing page and year filters...")
+    test_book_filter_checks()
+    test_filters_refill_shortfall()
+
+    print("Testing retrieval over the local corpus...")
+    test_retrieval_index()
+    test_retrieval_fast_path()
+
+    print("Testing the batch runner...")
+    test_batch_run_and_resume()
+
+    print("Testing telemetry...")
+    test_telemetry_spans_and_export()
+
+    print("Testing record/replay and fake upstreams...")
+    test_replay_round_trip()
+    test_upstream_profiles()
+
+    print("Testing shared state across worker processes...")
+    test_shared_state_across_workers()
+
+    print("Testing speculative follow-ups...")
+    test_speculative_followups()
+
+    print("Testing model routing...")
+    test_model_routing()
+    test_step_down_under_load()
+
+    print("Testing startup...")
+    test_lazy_startup()
+    test_warm_up()
+
+    print("Testing Streamlit reruns...")
+    test_app_reruns()
+    test_app_session_sharing()
+
     print("All tests passed!")
 
 if __name__ == "__main__":